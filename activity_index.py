@@ -0,0 +1,161 @@
+# activity_index.py
+# Optional in-process cache of activity times, see FrequencyTracker.activity_index
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+# Rough cost of each array object and dict slot, and of the entry itself
+ENTRY_OVERHEAD = 200
+
+
+def to_epoch_us(timestamp: datetime):
+    # Whole microseconds, so times compare exactly like they do in Postgres
+    delta = timestamp - datetime(1970, 1, 1, tzinfo=timezone.utc)
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def from_epoch_us(epoch_us: int):
+    return datetime.fromtimestamp(epoch_us // 1000000, timezone.utc).replace(microsecond=epoch_us % 1000000)
+
+
+class ActivityIndex:
+    """Sorted activity times per user and type, in compact array('q') buffers of epoch microseconds.
+
+    A user's entry holds all of their types' times, loaded in one query together with the user's
+    data_version (see queries.BUMP_DATA_VERSION), and is only trusted at that version. A write from
+    this process moves the entry to the version its transaction bumped to with apply(), as long as
+    no other write came in between. Otherwise the entry is dropped and the next read reloads it,
+    which is how writes from other processes are picked up. The least recently used users are
+    evicted once memory_budget bytes are in use.
+    """
+
+    def __init__(self, memory_budget):
+        self.memory_budget = memory_budget
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "stale": 0, "applied": 0, "evictions": 0}
+
+    def _entry_size(self, types):
+        return sum(len(times) * times.itemsize for times in types.values()) + ENTRY_OVERHEAD * (len(types) + 1)
+
+    def _drop(self, user_id):
+        # Caller holds the lock
+        entry = self._entries.pop(user_id, None)
+        if entry is not None:
+            self._bytes -= self._entry_size(entry[1])
+
+    def _evict(self):
+        # Caller holds the lock
+        while self._bytes > self.memory_budget and self._entries:
+            self._drop(next(iter(self._entries)))
+            self._stats["evictions"] += 1
+
+    def _get(self, user_id, version):
+        # A user's types at version, dropping an entry from any other version. Caller holds the lock
+        entry = self._entries.get(user_id)
+        if entry is None or entry[0] != version:
+            if entry is not None:
+                self._stats["stale"] += 1
+                self._drop(user_id)
+            self._stats["misses"] += 1
+            return None
+        self._stats["hits"] += 1
+        self._entries.move_to_end(user_id)
+        return entry[1]
+
+    # Loading and updates
+
+    def store(self, user_id, version, epochs_by_type):
+        """Store a user's sorted times per type, as read at data_version version."""
+        types = {type_id: array('q', epochs_us) for type_id, epochs_us in epochs_by_type.items()}
+        size = self._entry_size(types)
+        with self._lock:
+            # A slower load must not replace one made at a later version
+            current = self._entries.get(user_id)
+            if current is not None and current[0] > version:
+                return False
+            self._drop(user_id)
+            if size > self.memory_budget:
+                return False
+            self._entries[user_id] = (version, types)
+            self._bytes += size
+            self._evict()
+            return True
+
+    def apply(self, user_id, version, added = (), removed = ()):
+        """Apply a committed write's (type_id, time) rows, given the version its transaction bumped to."""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or entry[0] >= version:
+                # Nothing cached, or a load made after the write already has it
+                return
+            if entry[0] != version - 1:
+                # Another write came in between that this process hasn't seen
+                self._drop(user_id)
+                return
+
+            types = entry[1]
+            for type_id, timestamp in removed:
+                times = types.get(type_id)
+                if times is None:
+                    continue
+                epoch_us = to_epoch_us(timestamp)
+                position = bisect_left(times, epoch_us)
+                if position < len(times) and times[position] == epoch_us:
+                    del times[position]
+                    self._bytes -= times.itemsize
+            for type_id, timestamp in added:
+                if type_id not in types:
+                    types[type_id] = array('q')
+                    self._bytes += ENTRY_OVERHEAD
+                times = types[type_id]
+                epoch_us = to_epoch_us(timestamp)
+                position = bisect_left(times, epoch_us)
+                if position == len(times) or times[position] != epoch_us:
+                    times.insert(position, epoch_us)
+                    self._bytes += times.itemsize
+            self._entries[user_id] = (version, types)
+            self._stats["applied"] += 1
+            self._evict()
+
+    def invalidate(self, user_id):
+        # Frees a user's entry early, the version check alone already keeps reads correct
+        with self._lock:
+            self._drop(user_id)
+
+    # Queries, None unless the user is cached at version
+
+    def last_times(self, user_id, version):
+        """Each type's most recent activity time, types without activities left out."""
+        with self._lock:
+            types = self._get(user_id, version)
+            if types is None:
+                return None
+            return {type_id: from_epoch_us(times[-1]) for type_id, times in types.items() if times}
+
+    def first(self, user_id, type_id, version):
+        # The earliest activity time, -1 for a type without activities
+        with self._lock:
+            types = self._get(user_id, version)
+            if types is None:
+                return None
+            times = types.get(type_id)
+            return from_epoch_us(times[0]) if times else -1
+
+    def count_since(self, user_id, type_id, version, since: datetime = None):
+        # Activities strictly after since, like the thirty and season counts, all of them without since
+        with self._lock:
+            types = self._get(user_id, version)
+            if types is None:
+                return None
+            times = types.get(type_id, ())
+            if since is None:
+                return len(times)
+            return len(times) - bisect_right(times, to_epoch_us(since))
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self._stats, entries=len(self._entries), bytes=self._bytes, memory_budget=self.memory_budget)
@@ -0,0 +1,210 @@
+import os
+from psycopg_pool import AsyncConnectionPool
+
+from dotenv import load_dotenv
+import queries
+
+load_dotenv()
+
+class AsyncDatabaseHandler:
+    """Async counterpart of DatabaseHandler for the hot request paths, on psycopg 3 with its own pool.
+
+    The schema is owned by DatabaseHandler, this class only runs queries against it.
+    The pool has to be opened from a running event loop, see open().
+    """
+
+    db_url = ''
+
+    def __init__(self, db_url = '', pool_min_size = None, pool_max_size = None, pool_timeout = None):
+
+        self.db_url = db_url
+        if db_url == '':
+            self.db_url = os.environ.get("DATABASE_URL")
+
+        if pool_min_size is None:
+            pool_min_size = int(os.environ.get("DB_ASYNC_POOL_MIN_SIZE", 1))
+        if pool_max_size is None:
+            pool_max_size = int(os.environ.get("DB_ASYNC_POOL_MAX_SIZE", 20))
+        if pool_timeout is None:
+            pool_timeout = float(os.environ.get("DB_POOL_TIMEOUT", 30))
+
+        self._pool = AsyncConnectionPool(
+            self.db_url,
+            min_size=pool_min_size,
+            max_size=pool_max_size,
+            timeout=pool_timeout,
+            check=AsyncConnectionPool.check_connection,
+            open=False
+        )
+
+    async def open(self):
+        await self._pool.open()
+
+    async def close(self):
+        await self._pool.close()
+
+    def _get_connection(self):
+        # Commits on success, rolls back on error and returns the connection to the pool
+        return self._pool.connection()
+
+    def _get_pool_stats(self):
+        return self._pool.get_stats()
+
+    # User table methods
+
+    async def _get_user_timezone(self, id):
+        try:
+            async with self._get_connection() as conn:
+                cursor = await conn.execute(queries.SELECT_USER_TIMEZONE, (id,))
+                return (await cursor.fetchone())[0]
+        except Exception as e:
+            print(f"DATABASE ERROR in _get_user_timezone: {str(e)}")
+            return None
+
+    async def _get_user_profile(self, id):
+        async with self._get_connection() as conn:
+            cursor = await conn.execute(queries.SELECT_USER_PROFILE, (id,))
+            row = await cursor.fetchone()
+            return {"name": row[0], "timezone": row[1]} if row else None
+
+    async def _get_data_version(self, id):
+        async with self._get_connection() as conn:
+            cursor = await conn.execute(queries.SELECT_DATA_VERSION, (id,))
+            row = await cursor.fetchone()
+            return {"version": row[0], "timezone": row[1]} if row else None
+
+    # Activity types table methods
+
+    async def _get_activity_type_id(self, user_id, type):
+        async with self._get_connection() as conn:
+            cursor = await conn.execute(queries.SELECT_ACTIVITY_TYPE_ID, (user_id, type))
+            result = await cursor.fetchone()
+            return result[0] if result else -1
+
+    # Activity table methods
+
+    async def _add_activity(self, user_id, type_id, time):
+        params = queries.activity_params(user_id, [(type_id, time)])
+        values = queries.values_placeholder(queries.ACTIVITY_ROW_TEMPLATE, 1)
+        async with self._get_connection() as conn:
+            cursor = await conn.execute(queries.insert_activities(values), params[0])
+            inserted = await cursor.fetchall()
+            version = None
+            if inserted:
+                await conn.execute(queries.calculation_deltas(1, values), params[0])
+                await conn.execute(queries.daily_count_deltas(1, values), params[0])
+                cursor = await conn.execute(queries.BUMP_DATA_VERSION, (user_id,))
+                version = (await cursor.fetchone())[0]
+        return inserted, version
+
+    async def _get_user_activity_epochs(self, user_id):
+        async with self._get_connection() as conn:
+            cursor = await conn.execute(queries.SELECT_USER_ACTIVITY_EPOCHS, (user_id,))
+            return queries.activity_epochs(await cursor.fetchall())
+
+    async def _get_activities(self, user_id):
+        async with self._get_connection() as conn:
+            cursor = await conn.execute(queries.SELECT_ACTIVITIES, (user_id,))
+            return [queries.activity_row(row) for row in await cursor.fetchall()]
+
+    async def _get_activities_page(self, user_id, filters, limit):
+        params = dict(filters, user_id=user_id, limit=limit)
+        async with self._get_connection() as conn:
+            cursor = await conn.execute(queries.select_activities_page(filters), params)
+            return [queries.activity_row(row) for row in await cursor.fetchall()]
+
+    async def _stream_activities(self, user_id, filters, batch_size = 2000):
+        # Like DatabaseHandler._stream_activities, holding a pooled connection until the generator is done
+        params = dict(filters, user_id=user_id)
+        async with self._get_connection() as conn:
+            async with conn.cursor(name="stream_activities") as cursor:
+                await cursor.execute(queries.select_activities_page(filters, limit=False), params)
+                while True:
+                    rows = await cursor.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    yield [queries.activity_row(row) for row in rows]
+
+    # CSV import and export methods, streamed through COPY, see DatabaseHandler for the file based versions
+
+    async def _import_activities_csv(self, user_id, chunks):
+        params = {"user_id": user_id}
+        async with self._get_connection() as conn:
+            await conn.execute(queries.SET_UTC)
+            await conn.execute(queries.CREATE_ACTIVITY_STAGING)
+            async with conn.cursor() as cursor:
+                async with cursor.copy(queries.COPY_ACTIVITIES_IN) as copy:
+                    async for chunk in chunks:
+                        await copy.write(chunk)
+            await conn.execute(queries.CREATE_ACTIVITY_STAGING_INSERTED)
+            await conn.execute(queries.MERGE_ACTIVITY_STAGING, params)
+            await conn.execute(queries.calculation_deltas(1, None, source=queries.ACTIVITY_STAGING_INSERTED))
+            await conn.execute(queries.daily_count_deltas(1, None, source=queries.ACTIVITY_STAGING_INSERTED))
+            cursor = await conn.execute(queries.ACTIVITY_IMPORT_SUMMARY, params)
+            summary = queries.activity_import_summary(await cursor.fetchone())
+            if summary["imported"]:
+                await conn.execute(queries.BUMP_DATA_VERSION, (user_id,))
+        return summary
+
+    async def _import_activity_types_csv(self, user_id, chunks):
+        async with self._get_connection() as conn:
+            await conn.execute(queries.CREATE_ACTIVITY_TYPE_STAGING)
+            async with conn.cursor() as cursor:
+                async with cursor.copy(queries.COPY_ACTIVITY_TYPES_IN) as copy:
+                    async for chunk in chunks:
+                        await copy.write(chunk)
+            cursor = await conn.execute(queries.MERGE_ACTIVITY_TYPE_STAGING, {"user_id": user_id})
+            created, updated = await cursor.fetchone()
+            if created or updated:
+                await conn.execute(queries.BUMP_DATA_VERSION, (user_id,))
+        return created, updated
+
+    async def _export_csv(self, copy_out):
+        # Yields the CSV as COPY sends it, holding a pooled connection until done
+        async with self._get_connection() as conn:
+            await conn.execute(queries.SET_UTC)
+            async with conn.cursor() as cursor:
+                async with cursor.copy(copy_out) as copy:
+                    async for data in copy:
+                        yield bytes(data)
+
+    # User calculations table methods
+
+    async def _get_user_calculations(self, user_id):
+        async with self._get_connection() as conn:
+            cursor = await conn.execute(queries.SELECT_USER_CALCULATIONS, (user_id,))
+            return [queries.calculation_row(row) for row in await cursor.fetchall()]
+
+    async def _get_frequency_rows(self, user_id, with_last_time = True):
+        query = queries.SELECT_FREQUENCY_ROWS if with_last_time else queries.SELECT_FREQUENCY_ROWS_WITHOUT_LAST_TIME
+        async with self._get_connection() as conn:
+            cursor = await conn.execute(query, (user_id,))
+            return [queries.frequency_row(row) for row in await cursor.fetchall()]
+
+    async def _refresh_user_calculations(self, user_id, thirty_cutoff, season_start):
+        params = {"user_id": user_id, "thirty_cutoff": thirty_cutoff, "season_start": season_start}
+        async with self._get_connection() as conn:
+            await conn.execute(queries.REBUILD_USER_CALCULATIONS, params)
+            await conn.execute(queries.ROLL_USER_CALCULATION_WINDOWS, params)
+
+    async def _store_calculation_counts(self, user_id, version, rows):
+        # See DatabaseHandler._store_calculation_counts
+        values = queries.values_placeholder(queries.COUNTS_ROW_TEMPLATE, len(rows))
+        params = [value for row in rows for value in (user_id,) + tuple(row)]
+        async with self._get_connection() as conn:
+            await conn.execute(queries.LOCK_USER_CALCULATIONS, (user_id,))
+            cursor = await conn.execute(queries.SELECT_DATA_VERSION, (user_id,))
+            row = await cursor.fetchone()
+            if row is None or row[0] != version:
+                return False
+            await conn.execute(queries.update_calculation_counts(values), params)
+            return True
+
+    async def _update_user_calculations_bulk(self, user_id, rows):
+        # rows are (type_id, total, thirty, season) tuples, all marked valid
+        if not rows:
+            return
+        values = queries.values_placeholder(queries.AVERAGES_ROW_TEMPLATE, len(rows))
+        params = [value for row in rows for value in (user_id,) + tuple(row)]
+        async with self._get_connection() as conn:
+            await conn.execute(queries.update_calculation_averages(values), params)
@@ -1,24 +1,75 @@
 from datetime import datetime, timezone, timedelta
 import math
 import bcrypt
+import numpy as np
 import pytz
 
+class ClockContext:
+    """A time zone resolved once, with the day boundaries every calculation needs.
+
+    Everything here only changes at local midnight, so one context serves all of a
+    user's calculations until next_midnight, see CalculationHandler._clock_context.
+    """
+
+    def __init__(self, user_timezone: str, now: datetime = None):
+        if now is None:
+            now = datetime.now(timezone.utc)
+        self.timezone_name = user_timezone
+        self.tz = pytz.timezone(user_timezone)
+
+        # Day boundaries as aware UTC datetimes
+        local_date = now.astimezone(self.tz).date()
+        self.local_date = local_date
+        self.local_midnight = self._localize(datetime(local_date.year, local_date.month, local_date.day))
+        next_date = local_date + timedelta(days=1)
+        self.next_midnight = self._localize(datetime(next_date.year, next_date.month, next_date.day))
+        # Thirty local days back, not 720 hours, so it stays a midnight across DST changes
+        thirty_date = local_date - timedelta(days=30)
+        self.thirty_cutoff = self._localize(datetime(thirty_date.year, thirty_date.month, thirty_date.day))
+
+        # Determine current season and set season start date
+        month = local_date.month
+        if 3 <= month < 6:  # Spring (March-May)
+            self.season, season_start = "spring", datetime(local_date.year, 3, 1)
+        elif 6 <= month < 9:  # Summer (June-August)
+            self.season, season_start = "summer", datetime(local_date.year, 6, 1)
+        elif 9 <= month < 12:  # Fall (September-November)
+            self.season, season_start = "fall", datetime(local_date.year, 9, 1)
+        elif month == 12:  # Winter (December-February)
+            self.season, season_start = "winter", datetime(local_date.year, 12, 1)
+        else:  # Winter that started last December
+            self.season, season_start = "winter", datetime(local_date.year - 1, 12, 1)
+        self.season_start = self._localize(season_start)
+
+    def _localize(self, local_time: datetime):
+        # Midnight can fall in a DST gap or overlap in a few zones, take the standard time reading
+        return self.tz.localize(local_time, is_dst=False).astimezone(timezone.utc)
+
+    def is_current(self, now: datetime = None):
+        if now is None:
+            now = datetime.now(timezone.utc)
+        return self.local_midnight <= now < self.next_midnight
+
+
 class CalculationHandler:
 
     def __init__(self):
-        self
+        # ClockContexts by time zone name, replaced once their day is over
+        self._clock_contexts = {}
 
-    def _days_ago(self, timestamp: datetime, user_timezone: str):
+    def _clock_context(self, user_timezone: str):
+        clock = self._clock_contexts.get(user_timezone)
+        if clock is None or not clock.is_current():
+            clock = ClockContext(user_timezone)
+            self._clock_contexts[user_timezone] = clock
+        return clock
 
-        today = datetime.now(timezone.utc)
-        difference = today - timestamp
+    def _days_ago(self, timestamp: datetime, clock: ClockContext):
 
         # What 'today' and 'yesterday' are, is relative to the users time zone and specfically time since midnight last night
-        local_timestamp = datetime.now(pytz.timezone(user_timezone))
-        rollback = local_timestamp.hour * 3600 + local_timestamp.minute*60 + local_timestamp.second
-        hours_difference =  (difference.total_seconds() - rollback) / 3600
-
-        return math.ceil(hours_difference /  24)
+        # Anything since local midnight is 0 days ago, anything the local day before is 1, and so on
+        difference = clock.local_midnight - timestamp
+        return math.floor(difference.total_seconds() / 86400) + 1
     
     def _get_season(self, timestamp: datetime):
         month = timestamp.month
@@ -32,18 +83,79 @@ class CalculationHandler:
             return "fall"
         
     def _get_season_start(self, user_timezone: str):
-        current_date = datetime.now(pytz.timezone(user_timezone))
-        current_month = current_date.month
-        
-        if 3 <= current_month < 6:  # Spring (March-May)
-            return pytz.timezone(user_timezone).localize(datetime(current_date.year, 3, 1), is_dst=None)
-        elif 6 <= current_month < 9:  # Summer (June-August)
-            return pytz.timezone(user_timezone).localize(datetime(current_date.year, 6, 1), is_dst=None)
-        elif 9 <= current_month < 12:  # Fall (September-November)
-            return pytz.timezone(user_timezone).localize(datetime(current_date.year, 9, 1), is_dst=None)
-        else:  # Winter (December-February)
-            return pytz.timezone(user_timezone).localize(datetime(current_date.year, 12, 1), is_dst=None)
+        return self._clock_context(user_timezone).season_start
         
+    def _frequency_averages(self, total_count, first_time, thirty_count, season_count, clock: ClockContext):
+
+        # Average number of days between activities over the whole history, the last 30 days, and this season
+        total_frequency = -1
+        if total_count > 0:
+            total_frequency = round(self._days_ago(first_time, clock) / total_count, 2)
+        thirty_frequency = -1
+        if thirty_count > 0:
+            thirty_frequency = round(30 / thirty_count, 2)
+        season_frequency = -1
+        if season_count > 0:
+            season_frequency = round(self._days_ago(clock.season_start, clock) / season_count, 2)
+
+        return total_frequency, thirty_frequency, season_frequency
+
+    def _frequency_stats(self, type_ids, times, local_midnight, thirty_cutoff, season_start):
+        """Counts and averages for every type at once, from parallel arrays of activities.
+
+        type_ids and times (epoch seconds, fractions kept, or datetime64) describe one activity per element, in any order.
+        The window boundaries are epoch seconds too, either one value for all activities or one per activity,
+        which lets a batch hold many users with different time zones since type ids are unique across users.
+        Returns a dict of arrays with one element per type, matching what _frequency_averages and
+        _days_ago give per type, with -1 where there is nothing to average.
+        """
+        type_ids = np.asarray(type_ids, dtype=np.int64)
+        times = np.asarray(times)
+        if np.issubdtype(times.dtype, np.datetime64):
+            times = times.astype('datetime64[us]').astype(np.int64) / 1000000
+        times = times.astype(np.float64)
+        local_midnight, thirty_cutoff, season_start = (
+            np.broadcast_to(np.asarray(value, dtype=np.float64), times.shape) for value in (local_midnight, thirty_cutoff, season_start)
+        )
+
+        # Group by type with each group in time order, so firsts and lasts sit at the group edges
+        order = np.lexsort((times, type_ids))
+        type_ids, times = type_ids[order], times[order]
+        local_midnight, thirty_cutoff, season_start = local_midnight[order], thirty_cutoff[order], season_start[order]
+
+        groups, starts, total_count = np.unique(type_ids, return_index=True, return_counts=True)
+        if groups.size == 0:
+            empty = np.array([], dtype=np.int64)
+            return {key: empty for key in ("type_ids", "total_count", "thirty_count", "season_count", "first_time", "last_time", "total", "thirty", "season", "current")}
+        ends = starts + total_count - 1
+        first_time, last_time = times[starts], times[ends]
+        midnight = local_midnight[starts]
+
+        thirty_count = np.add.reduceat(times > thirty_cutoff, starts)
+        season_count = np.add.reduceat(times > season_start, starts)
+
+        # Whole days back from local midnight, like _days_ago
+        def days_ago(timestamps):
+            return np.floor((midnight - timestamps) / 86400) + 1
+
+        def days_per_activity(days, counts):
+            averages = np.full(counts.shape, -1.0)
+            np.divide(days, counts, out=averages, where=counts > 0)
+            return np.where(counts > 0, np.round(averages, 2), -1.0)
+
+        return {
+            "type_ids": groups,
+            "total_count": total_count,
+            "thirty_count": thirty_count,
+            "season_count": season_count,
+            "first_time": first_time,
+            "last_time": last_time,
+            "total": days_per_activity(days_ago(first_time), total_count),
+            "thirty": days_per_activity(np.full(groups.shape, 30.0), thirty_count),
+            "season": days_per_activity(days_ago(season_start[starts]), season_count),
+            "current": days_ago(last_time).astype(np.int64)
+        }
+
     def hash_password(self, plain_password: str) -> str:
         salt = bcrypt.gensalt()
         hashed = bcrypt.hashpw(plain_password.encode('utf-8'), salt)
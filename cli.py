@@ -0,0 +1,78 @@
+# cli.py
+# Maintenance commands run against DATABASE_URL, e.g.
+#   python cli.py backfill-daily-counts
+#   python cli.py backfill-daily-counts --user-id 12 --user-id 40
+#   python cli.py recompute-averages --user-id 12
+#   python cli.py export-activities --user-id 12 > activities.csv
+#   python cli.py import-activities --user-id 12 activities.csv
+import argparse
+import sys
+
+from frequency_tracker import FrequencyTracker
+
+
+def backfill_daily_counts(frequency_tracker, args):
+    recounted = frequency_tracker.backfill_daily_counts(args.user_id, args.batch_size)
+    print(f"Recounted daily activity counts for {recounted} users")
+
+
+def recompute_averages(frequency_tracker, args):
+    stored = frequency_tracker.compute_frequency_averages_batch(args.user_id, args.batch_size)
+    print(f"Recomputed {stored} activity type calculations")
+
+
+def import_csv(frequency_tracker, args):
+    if args.file == "-":
+        result = frequency_tracker.import_csv(args.user_id, args.kind, sys.stdin)
+    else:
+        with open(args.file, newline="") as file:
+            result = frequency_tracker.import_csv(args.user_id, args.kind, file)
+    print(result)
+    if not result["success"]:
+        sys.exit(1)
+
+
+def export_csv(frequency_tracker, args):
+    if args.output == "-":
+        frequency_tracker.export_csv(args.user_id, args.kind, sys.stdout)
+    else:
+        with open(args.output, "w", newline="") as file:
+            frequency_tracker.export_csv(args.user_id, args.kind, file)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Frequency tracker maintenance commands")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    backfill = commands.add_parser("backfill-daily-counts", help="recount activity_daily_counts from the activities")
+    backfill.add_argument("--user-id", type=int, action="append", help="only this user, can be repeated")
+    backfill.add_argument("--batch-size", type=int, default=500, help="users recounted per transaction")
+    backfill.set_defaults(handler=backfill_daily_counts)
+
+    recompute = commands.add_parser("recompute-averages", help="recount and average user_calculations from the activities")
+    recompute.add_argument("--user-id", type=int, action="append", help="only this user, can be repeated")
+    recompute.add_argument("--batch-size", type=int, default=500, help="users recomputed per transaction")
+    recompute.set_defaults(handler=recompute_averages)
+
+    # Activities are type,time rows, activity types are type,winter,spring,summer,fall rows, both with a header
+    for kind, name in (("activities", "activities"), ("activity_types", "activity-types")):
+        import_command = commands.add_parser(f"import-{name}", help=f"import {kind} from a CSV file through COPY")
+        import_command.add_argument("--user-id", type=int, required=True)
+        import_command.add_argument("file", help="CSV file, - for stdin")
+        import_command.set_defaults(handler=import_csv, kind=kind)
+
+        export_command = commands.add_parser(f"export-{name}", help=f"export {kind} to a CSV file through COPY")
+        export_command.add_argument("--user-id", type=int, required=True)
+        export_command.add_argument("--output", default="-", help="CSV file, - for stdout")
+        export_command.set_defaults(handler=export_csv, kind=kind)
+
+    args = parser.parse_args()
+    frequency_tracker = FrequencyTracker()
+    try:
+        args.handler(frequency_tracker, args)
+    finally:
+        frequency_tracker.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+import threading
+import time
+
+
+class PoolTimeoutError(Exception):
+    pass
+
+
+class ConnectionPool:
+    """Thread-safe pool of database connections.
+
+    Connections are created lazily up to max_size. Callers wait up to timeout
+    seconds for a free connection, and connections that sat idle longer than
+    health_check_interval are pinged before being handed out.
+    """
+
+    def __init__(self, connect, min_size = 1, max_size = 10, timeout = 30.0, health_check_interval = 30.0):
+
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError(f"Invalid pool size: min_size={min_size}, max_size={max_size}")
+
+        self._connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+
+        self._condition = threading.Condition()
+        self._idle = []  # (connection, time it was returned)
+        self._size = 0
+        self._closed = False
+
+        self._stats = {
+            "connections_created": 0,
+            "connections_discarded": 0,
+            "checkouts": 0,
+            "waits": 0,
+            "timeouts": 0,
+            "failed_health_checks": 0
+        }
+
+        for _ in range(min_size):
+            self._size += 1
+            self._idle.append((self._new_connection(), time.monotonic()))
+
+    def _new_connection(self):
+        try:
+            conn = self._connect()
+        except Exception:
+            with self._condition:
+                self._size -= 1
+                self._condition.notify()
+            raise
+        with self._condition:
+            self._stats["connections_created"] += 1
+        return conn
+
+    def _is_healthy(self, conn, returned_at):
+        if conn.closed:
+            return False
+        if time.monotonic() - returned_at < self.health_check_interval:
+            return True
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.fetchone()
+            cursor.close()
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _close_quietly(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def getconn(self):
+        deadline = time.monotonic() + self.timeout
+        with self._condition:
+            while True:
+                if self._closed:
+                    raise PoolTimeoutError("Connection pool is closed")
+                if self._idle:
+                    conn, returned_at = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    conn, returned_at = None, None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats["timeouts"] += 1
+                    raise PoolTimeoutError(f"Timed out after {self.timeout}s waiting for a database connection")
+                self._stats["waits"] += 1
+                self._condition.wait(remaining)
+            self._stats["checkouts"] += 1
+
+        if conn is None:
+            return self._new_connection()
+
+        if not self._is_healthy(conn, returned_at):
+            # Replace the broken connection, keeping its slot in the pool
+            self._close_quietly(conn)
+            with self._condition:
+                self._stats["failed_health_checks"] += 1
+                self._stats["connections_discarded"] += 1
+            return self._new_connection()
+
+        return conn
+
+    def putconn(self, conn, discard = False):
+        with self._condition:
+            if discard or conn.closed or self._closed:
+                self._size -= 1
+                self._stats["connections_discarded"] += 1
+                self._close_quietly(conn)
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._condition.notify()
+
+    def closeall(self):
+        with self._condition:
+            self._closed = True
+            for conn, _ in self._idle:
+                self._close_quietly(conn)
+            self._size -= len(self._idle)
+            self._idle = []
+            self._condition.notify_all()
+
+    def get_stats(self):
+        with self._condition:
+            stats = dict(self._stats)
+            stats["min_size"] = self.min_size
+            stats["max_size"] = self.max_size
+            stats["size"] = self._size
+            stats["idle"] = len(self._idle)
+            stats["in_use"] = self._size - len(self._idle)
+        return stats
@@ -1,50 +1,114 @@
 import os
 import psycopg2
+from psycopg2.extras import execute_values
+from contextlib import contextmanager
 
 from dotenv import load_dotenv
+from connection_pool import ConnectionPool
+from migrations import MIGRATIONS
+import queries
 
 load_dotenv()
 
+# Arbitrary key for the advisory lock held while migrating
+MIGRATION_LOCK_ID = 720431
+
 class DatabaseHandler:
 
     db_url = ''
 
-    def __init__(self, db_url = ''):
+    def __init__(self, db_url = '', pool_min_size = None, pool_max_size = None, pool_timeout = None, pool_health_check_interval = None):
 
         self.db_url = db_url
         if db_url == '':
             self.db_url = os.environ.get("DATABASE_URL")
+
+        # Pool settings fall back to the environment, then to defaults
+        if pool_min_size is None:
+            pool_min_size = int(os.environ.get("DB_POOL_MIN_SIZE", 1))
+        if pool_max_size is None:
+            pool_max_size = int(os.environ.get("DB_POOL_MAX_SIZE", 10))
+        if pool_timeout is None:
+            pool_timeout = float(os.environ.get("DB_POOL_TIMEOUT", 30))
+        if pool_health_check_interval is None:
+            pool_health_check_interval = float(os.environ.get("DB_POOL_HEALTH_CHECK_INTERVAL", 30))
+
+        self._pool = ConnectionPool(
+            lambda: psycopg2.connect(self.db_url),
+            min_size=pool_min_size,
+            max_size=pool_max_size,
+            timeout=pool_timeout,
+            health_check_interval=pool_health_check_interval
+        )
         self._initialize_tables()
 
+    @contextmanager
     def _get_connection(self):
-        return psycopg2.connect(self.db_url)
+        # Borrow a pooled connection, commit on success, roll back on error, and always hand it back
+        conn = self._pool.getconn()
+        discard = False
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            try:
+                conn.rollback()
+            except Exception:
+                discard = True
+            raise
+        finally:
+            self._pool.putconn(conn, discard=discard)
+
+    def _get_pool_stats(self):
+        return self._pool.get_stats()
+
+    def _close_pool(self):
+        self._pool.closeall()
 
     def _initialize_tables(self):
-        self._create_user_table()
-        self._create_activity_types_table()
-        self._create_activities_table()
-        self._create_user_calculations_table()
+        self._apply_migrations()
 
-    # User table methods
+    # Schema migration methods
+
+    def _get_schema_version(self, cursor):
+        cursor.execute("SELECT to_regclass('schema_migrations') IS NOT NULL")
+        if not cursor.fetchone()[0]:
+            return 0
+        cursor.execute("SELECT COALESCE(MAX(version), 0) FROM schema_migrations")
+        return cursor.fetchone()[0]
 
-    def _create_user_table(self):
+    def _apply_migrations(self):
+        latest_version = MIGRATIONS[-1]["version"]
         with self._get_connection() as conn:
             cursor = conn.cursor()
+
+            # Nothing to do, and no DDL issued, once the schema is current
+            if self._get_schema_version(cursor) >= latest_version:
+                return
+
+            # Serialize concurrent workers starting up against the same database
+            cursor.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATION_LOCK_ID,))
             cursor.execute("""
-                CREATE TABLE IF NOT EXISTS users (
-                    id INTEGER GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
-                    email TEXT UNIQUE NOT NULL,
-                    password TEXT NOT NULL,
-                    name TEXT,
-                    timezone TEXT,
-                    strava_athlete_id INTEGER,
-                    strava_access_token TEXT,
-                    strava_refresh_token TEXT,
-                    strava_token_expires_at INTEGER
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INTEGER PRIMARY KEY,
+                    description TEXT NOT NULL,
+                    applied_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW()
                 )
             """)
+            current_version = self._get_schema_version(cursor)
+
+            for migration in MIGRATIONS:
+                if migration["version"] <= current_version:
+                    continue
+                print(f"Applying migration {migration['version']}: {migration['description']}")
+                cursor.execute(migration["sql"])
+                cursor.execute("""
+                    INSERT INTO schema_migrations (version, description) VALUES (%s, %s)
+                """, (migration["version"], migration["description"]))
             conn.commit()
 
+    # User table methods
+
     def _create_user(self, email, password, name, timezone):
         with self._get_connection() as conn:
             cursor = conn.cursor()
@@ -63,12 +127,11 @@ class DatabaseHandler:
             
     def _sign_in(self, email, password):
         try:
-            conn = self._get_connection()
-            cur = conn.cursor()
-            cur.execute("SELECT id, password FROM users WHERE email = %s", (email,))
-            user_data = cur.fetchone()
-            cur.close()
-            conn.close()
+            with self._get_connection() as conn:
+                cur = conn.cursor()
+                cur.execute("SELECT id, password FROM users WHERE email = %s", (email,))
+                user_data = cur.fetchone()
+                cur.close()
 
             if user_data:
                 user_id, hashed_password = user_data
@@ -86,41 +149,78 @@ class DatabaseHandler:
             with self._get_connection() as conn:
                 cursor = conn.cursor()
                 cursor.execute("""
-                DELETE FROM users WHERE id = %s
-            """, (id,))
-            conn.commit()
+                    DELETE FROM users WHERE id = %s
+                """, (id,))
+                conn.commit()
             return {"success": True, "message": "User deleted"}
         except Exception as e:
             return {"success": False, "message": str(e)}
 
     def _get_user_timezone(self, id):
         try:
-            conn = self._get_connection()
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT timezone FROM users WHERE id = %s
-            """, (id,))
-            return cursor.fetchone()[0]
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(queries.SELECT_USER_TIMEZONE, (id,))
+                return cursor.fetchone()[0]
         except Exception as e:
             print(f"DATABASE ERROR in _get_user_timezone: {str(e)}")
             return None
         
     def _set_user_timezone(self, id, timezone):
+        # The daily counts are bucketed by time zone, so they move with it
         with self._get_connection() as conn:
             cursor = conn.cursor()
+            self._lock_users(cursor, [id])
             cursor.execute("""
                 UPDATE users SET timezone = %s WHERE id = %s
             """, (timezone, id))
+            cursor.execute(queries.REBUILD_DAILY_COUNTS, {"user_ids": [id]})
+            self._bump_data_version(id, cursor)
             conn.commit()
 
+    def _get_data_version(self, id):
+        # The user's data version and time zone, None for an unknown user
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(queries.SELECT_DATA_VERSION, (id,))
+            row = cursor.fetchone()
+            return {"version": row[0], "timezone": row[1]} if row else None
+
+    def _bump_data_version(self, id, cursor = None):
+        # Inside a write's transaction when given its cursor, otherwise on its own after the write committed.
+        # Returns the new version
+        if cursor is not None:
+            cursor.execute(queries.BUMP_DATA_VERSION, (id,))
+            return cursor.fetchone()[0]
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(queries.BUMP_DATA_VERSION, (id,))
+            version = cursor.fetchone()[0]
+            conn.commit()
+            return version
+
+    def _lock_users(self, cursor, user_ids):
+        # Waits out, then holds off, activity inserts for these users, their foreign key locks the users row
+        cursor.execute("""
+            SELECT id FROM users WHERE id = ANY(%s) ORDER BY id FOR UPDATE
+        """, (list(user_ids),))
+
+    def _get_user_ids(self, after_id = 0, limit = 500):
+        # Every user, a page at a time in id order
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT id FROM users WHERE id > %s ORDER BY id LIMIT %s
+            """, (after_id, limit))
+            return [row[0] for row in cursor.fetchall()]
+
     def _get_user_name(self, id):
         try:
-            conn = self._get_connection()
-            cur = conn.cursor()
-            cur.execute("SELECT name FROM users WHERE id = %s", (id,))
-            user_data = cur.fetchone()
-            cur.close()
-            conn.close()
+            with self._get_connection() as conn:
+                cur = conn.cursor()
+                cur.execute("SELECT name FROM users WHERE id = %s", (id,))
+                user_data = cur.fetchone()
+                cur.close()
             if user_data:
                 return user_data[0]
             return None
@@ -205,25 +305,73 @@ class DatabaseHandler:
             print(f"DATABASE ERROR in _get_strava_tokens: {str(e)}")
             return None
 
-    # Activity types table methods
+    def _find_user_by_strava_athlete_id(self, athlete_id):
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT id FROM users WHERE strava_athlete_id = %s
+            """, (athlete_id,))
+            row = cursor.fetchone()
+            return row[0] if row else None
 
-    def _create_activity_types_table(self):
+    def _clear_strava_tokens(self, user_id):
+        # The athlete revoked access, keep the athlete id so their activities stay linked
         with self._get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("""
-                CREATE TABLE IF NOT EXISTS activity_types (
-                    id INTEGER GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
-                    user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
-                    type TEXT NOT NULL,
-                    winter INTEGER NOT NULL,
-                    summer INTEGER NOT NULL,
-                    spring INTEGER NOT NULL,
-                    fall INTEGER NOT NULL,
-                    UNIQUE(user_id, type)
-                )
-            """)
+                UPDATE users
+                SET strava_access_token = NULL, strava_refresh_token = NULL, strava_token_expires_at = NULL
+                WHERE id = %s
+            """, (user_id,))
+            conn.commit()
+
+    def _get_strava_sync_state(self, user_id):
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT strava_sync_watermark, strava_last_synced_at FROM users WHERE id = %s
+            """, (user_id,))
+            row = cursor.fetchone()
+            if row:
+                return {"watermark": row[0], "last_synced_at": row[1]}
+            return None
+
+    def _set_strava_sync_state(self, user_id, watermark, last_synced_at = None):
+        # The watermark only moves forward, a sync of an older range never rewinds it
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                UPDATE users
+                SET strava_sync_watermark = GREATEST(strava_sync_watermark, %s),
+                    strava_last_synced_at = COALESCE(%s, strava_last_synced_at)
+                WHERE id = %s
+            """, (watermark, last_synced_at, user_id))
+            conn.commit()
+
+    def _get_strava_sync_candidates(self, synced_before, limit):
+        # Linked users not synced since synced_before, the longest waiting (or expired token) first
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT id, strava_last_synced_at, strava_token_expires_at
+                FROM users
+                WHERE strava_refresh_token IS NOT NULL
+                  AND (strava_last_synced_at IS NULL OR strava_last_synced_at < %s)
+                ORDER BY LEAST(COALESCE(strava_last_synced_at, 0), COALESCE(strava_token_expires_at, 0)), id
+                LIMIT %s
+            """, (synced_before, limit))
+            return [{"user_id": row[0], "last_synced_at": row[1], "token_expires_at": row[2]} for row in cursor.fetchall()]
+
+    def _reset_strava_sync_watermark(self, user_id):
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                UPDATE users SET strava_sync_watermark = NULL WHERE id = %s
+            """, (user_id,))
             conn.commit()
 
+    # Activity types table methods
+
     def _create_activity_type(self, user_id, type, winter, spring, summer, fall):
         with self._get_connection() as conn:
             cursor = conn.cursor()
@@ -273,65 +421,187 @@ class DatabaseHandler:
             cursor.execute("""
                 DELETE FROM activity_types WHERE user_id = %s AND type = %s
             """, (user_id, type))
+            if cursor.rowcount:
+                self._bump_data_version(user_id, cursor)
             conn.commit()
 
-    def _get_activity_type_id(self, user_id, type):
+    def _get_activity_type_ids(self, user_id, types):
+        # Type names to ids in one query, names the user doesn't track are left out
         with self._get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("""
-                SELECT id FROM activity_types WHERE user_id = %s AND type = %s
-            """, (user_id, type))
+                SELECT type, id FROM activity_types WHERE user_id = %s AND type = ANY(%s)
+            """, (user_id, list(types)))
+            return dict(cursor.fetchall())
+
+    def _get_activity_type_id(self, user_id, type):
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(queries.SELECT_ACTIVITY_TYPE_ID, (user_id, type))
             result = cursor.fetchone()
             conn.commit()
             return result[0] if result else -1
 
     # Activity table methods
 
-    def _create_activities_table(self):
+    def _add_activity(self, user_id, type_id, time):
+        # Returns the inserted rows and the data version the insert bumped to, None when it was a repeat
+        version = None
         with self._get_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS activities (
-                    id INTEGER GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
-                    user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
-                    type_id INTEGER REFERENCES activity_types(id) ON DELETE CASCADE,
-                    time TIMESTAMP WITH TIME ZONE NOT NULL,
-                    UNIQUE(user_id, type_id, time)
-                )
-            """)
+            inserted = self._insert_activities(cursor, user_id, [(type_id, time)])
+            self._apply_calculation_deltas(cursor, user_id, inserted, 1)
+            self._apply_daily_count_deltas(cursor, user_id, inserted, 1)
+            if inserted:
+                version = self._bump_data_version(user_id, cursor)
             conn.commit()
+        return inserted, version
 
-    def _add_activity(self, user_id, type_id, time):
+    def _insert_activities(self, cursor, user_id, rows):
+        # Insert (type_id, time) rows in as few statements as possible, returning the rows that were new
+        if not rows:
+            return []
+        return execute_values(cursor, queries.insert_activities("%s"), queries.activity_params(user_id, rows),
+                              template=queries.ACTIVITY_ROW_TEMPLATE, page_size=1000, fetch=True)
+
+    def _add_activities_bulk(self, user_id, rows):
+        """Insert many (type_id, time) rows in one transaction and update each affected calculation once"""
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            inserted = self._insert_activities(cursor, user_id, rows)
+            self._apply_calculation_deltas(cursor, user_id, inserted, 1)
+            self._apply_daily_count_deltas(cursor, user_id, inserted, 1)
+            if inserted:
+                self._bump_data_version(user_id, cursor)
+            conn.commit()
+        return len(inserted)
+
+    def _apply_activity_batch(self, user_id, add_rows, delete_rows):
+        """Delete, then insert, (type_id, time) rows in one transaction.
+
+        Each affected calculation and day is updated once per kind of change, however many rows touch it.
+        Returns the (inserted, deleted) rows that took effect and the data version the batch bumped to.
+        """
+        version = None
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            deleted = self._delete_activities(cursor, user_id, delete_rows)
+            self._apply_calculation_deltas(cursor, user_id, deleted, -1)
+            self._apply_daily_count_deltas(cursor, user_id, deleted, -1)
+            inserted = self._insert_activities(cursor, user_id, add_rows)
+            self._apply_calculation_deltas(cursor, user_id, inserted, 1)
+            self._apply_daily_count_deltas(cursor, user_id, inserted, 1)
+            if inserted or deleted:
+                version = self._bump_data_version(user_id, cursor)
+            conn.commit()
+        return inserted, deleted, version
+
+    def _add_strava_activities_bulk(self, user_id, rows):
+        """Like _add_activities_bulk for (type_id, time, strava_id) rows, also linking each activity to its Strava id"""
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            inserted = self._insert_activities(cursor, user_id, [(type_id, time) for type_id, time, _ in rows])
+            self._apply_calculation_deltas(cursor, user_id, inserted, 1)
+            self._apply_daily_count_deltas(cursor, user_id, inserted, 1)
+            self._link_strava_ids(cursor, user_id, rows)
+            if inserted:
+                self._bump_data_version(user_id, cursor)
+            conn.commit()
+        return len(inserted)
+
+    def _link_strava_ids(self, cursor, user_id, rows):
+        # Ids already held by another row are left alone, that row is the newer copy from a webhook
+        if not rows:
+            return
+        execute_values(cursor, """
+            UPDATE activities a
+            SET strava_id = v.strava_id
+            FROM (VALUES %s) AS v(user_id, type_id, time, strava_id)
+            WHERE a.user_id = v.user_id AND a.type_id = v.type_id AND a.time = v.time
+              AND a.strava_id IS DISTINCT FROM v.strava_id
+              AND NOT EXISTS (SELECT 1 FROM activities o WHERE o.user_id = v.user_id AND o.strava_id = v.strava_id)
+        """, [(user_id, type_id, time, strava_id) for type_id, time, strava_id in rows],
+            template="(%s::integer, %s::integer, %s::timestamptz, %s::bigint)", page_size=1000)
+
+    def _upsert_strava_activity(self, user_id, strava_id, type_id, time):
+        """Store a Strava activity under its current type and time, replacing the row stored for it before.
+
+        A type_id of None only removes it, for activities whose sport type isn't tracked.
+        Returns how many activities were (inserted, removed).
+        """
         with self._get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("""
-                INSERT INTO activities (user_id, type_id, time)
-                VALUES (%s, %s, %s)
-                ON CONFLICT (user_id, type_id, time) DO NOTHING
-            """, (user_id, type_id, time))
+                DELETE FROM activities
+                WHERE user_id = %s AND strava_id = %s AND (type_id, time) IS DISTINCT FROM (%s::integer, %s::timestamptz)
+                RETURNING type_id, time
+            """, (user_id, strava_id, type_id, time))
+            deleted = cursor.fetchall()
+            self._apply_calculation_deltas(cursor, user_id, deleted, -1)
+            self._apply_daily_count_deltas(cursor, user_id, deleted, -1)
+
+            inserted = []
+            if type_id is not None:
+                inserted = self._insert_activities(cursor, user_id, [(type_id, time)])
+                self._apply_calculation_deltas(cursor, user_id, inserted, 1)
+                self._apply_daily_count_deltas(cursor, user_id, inserted, 1)
+                self._link_strava_ids(cursor, user_id, [(type_id, time, strava_id)])
+            if inserted or deleted:
+                self._bump_data_version(user_id, cursor)
             conn.commit()
+        return len(inserted), len(deleted)
+
+    def _remove_strava_activity(self, user_id, strava_id):
+        return self._upsert_strava_activity(user_id, strava_id, None, None)[1]
+
+    def _delete_activities(self, cursor, user_id, rows):
+        # Delete (type_id, time) rows, returning the rows that actually existed
+        if not rows:
+            return []
+        return execute_values(cursor, queries.delete_activities("%s"), queries.activity_params(user_id, rows),
+                              template=queries.ACTIVITY_ROW_TEMPLATE, page_size=1000, fetch=True)
 
     def _get_activities(self, user_id):
-        activities = []
         with self._get_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("""
-                SELECT a.id, a.user_id, at.type, a.time 
-                FROM activities a
-                JOIN activity_types at ON a.type_id = at.id
-                WHERE a.user_id = %s
-                ORDER BY a.time ASC
-            """, (user_id,))
-            rows = cursor.fetchall()
-            for row in rows:
-                activities.append({
-                    "id": row[0],
-                    "user_id": row[1],
-                    "type": row[2],
-                    "time": row[3]
-                })
-        return activities
+            cursor.execute(queries.SELECT_ACTIVITIES, (user_id,))
+            return [queries.activity_row(row) for row in cursor.fetchall()]
         
+    def _get_activities_page(self, user_id, filters, limit):
+        params = dict(filters, user_id=user_id, limit=limit)
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(queries.select_activities_page(filters), params)
+            return [queries.activity_row(row) for row in cursor.fetchall()]
+
+    def _stream_activities(self, user_id, filters, batch_size = 2000):
+        """Yield every matching activity in (time, id) order, batch_size rows at a time.
+
+        Rows come through a server-side cursor, so memory stays flat however long the history is.
+        The pooled connection is held until the generator is exhausted or closed.
+        """
+        params = dict(filters, user_id=user_id)
+        with self._get_connection() as conn:
+            cursor = conn.cursor(name="stream_activities")
+            try:
+                cursor.execute(queries.select_activities_page(filters, limit=False), params)
+                while True:
+                    rows = cursor.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    yield [queries.activity_row(row) for row in rows]
+            finally:
+                # Also when the reader stopped early, so the connection goes back without an open transaction
+                cursor.close()
+                conn.rollback()
+
+    def _get_user_activity_epochs(self, user_id):
+        # (data_version, {type_id: sorted epoch microseconds}) in one query
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(queries.SELECT_USER_ACTIVITY_EPOCHS, (user_id,))
+            return queries.activity_epochs(cursor.fetchall())
+
     def _get_activities_by_type(self, user_id, type_id):
         activities = []
         with self._get_connection() as conn:
@@ -359,32 +629,96 @@ class DatabaseHandler:
             return cursor.fetchone()
         
     def _remove_activity(self, user_id, type_id, time):
+        # Returns the deleted rows and the data version the delete bumped to, like _add_activity
+        version = None
         with self._get_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("""
-                DELETE FROM activities WHERE user_id = %s AND type_id = %s AND time = %s
-            """, (user_id, type_id, time))
+            deleted = self._delete_activities(cursor, user_id, [(type_id, time)])
+            self._apply_calculation_deltas(cursor, user_id, deleted, -1)
+            self._apply_daily_count_deltas(cursor, user_id, deleted, -1)
+            if deleted:
+                version = self._bump_data_version(user_id, cursor)
             conn.commit()
+        return deleted, version
 
-    # User calculations table methods
+    # CSV import and export methods
+
+    def _import_activities_csv(self, user_id, file):
+        """COPY (type, time) CSV rows from file into a staging table, and merge them in, all in one transaction.
+
+        The new activities update the calculations and daily counts with one set based delta each.
+        """
+        params = {"user_id": user_id}
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(queries.SET_UTC)
+            cursor.execute(queries.CREATE_ACTIVITY_STAGING)
+            cursor.copy_expert(queries.COPY_ACTIVITIES_IN, file)
+            cursor.execute(queries.CREATE_ACTIVITY_STAGING_INSERTED)
+            cursor.execute(queries.MERGE_ACTIVITY_STAGING, params)
+            cursor.execute(queries.calculation_deltas(1, None, source=queries.ACTIVITY_STAGING_INSERTED))
+            cursor.execute(queries.daily_count_deltas(1, None, source=queries.ACTIVITY_STAGING_INSERTED))
+            cursor.execute(queries.ACTIVITY_IMPORT_SUMMARY, params)
+            summary = queries.activity_import_summary(cursor.fetchone())
+            if summary["imported"]:
+                self._bump_data_version(user_id, cursor)
+            conn.commit()
+        return summary
+
+    def _import_activity_types_csv(self, user_id, file):
+        """COPY (type, winter, spring, summer, fall) CSV rows from file and merge them in, returning the (created, updated) counts"""
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(queries.CREATE_ACTIVITY_TYPE_STAGING)
+            cursor.copy_expert(queries.COPY_ACTIVITY_TYPES_IN, file)
+            cursor.execute(queries.MERGE_ACTIVITY_TYPE_STAGING, {"user_id": user_id})
+            created, updated = cursor.fetchone()
+            if created or updated:
+                self._bump_data_version(user_id, cursor)
+            conn.commit()
+        return created, updated
 
-    def _create_user_calculations_table(self):
+    def _export_csv(self, copy_out, file):
+        # copy_out is one of the queries.copy_*_out statements
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(queries.SET_UTC)
+            cursor.copy_expert(copy_out, file)
+
+    # Daily counts table methods
+
+    def _apply_daily_count_deltas(self, cursor, user_id, rows, sign):
+        # Count inserted (sign 1) or deleted (sign -1) (type_id, time) rows on their local days
+        if not rows:
+            return
+        execute_values(cursor, queries.daily_count_deltas(sign, "%s"), queries.activity_params(user_id, rows),
+                       template=queries.ACTIVITY_ROW_TEMPLATE, page_size=1000)
+        if sign < 0:
+            cursor.execute(queries.DELETE_EMPTY_DAILY_COUNTS, (user_id,))
+
+    def _get_daily_counts(self, user_id):
         with self._get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("""
-                CREATE TABLE IF NOT EXISTS user_calculations (
-                    id INTEGER GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
-                    user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
-                    type_id INTEGER REFERENCES activity_types(id) ON DELETE CASCADE,
-                    total FLOAT,
-                    thirty FLOAT,
-                    season FLOAT,
-                    valid BOOLEAN DEFAULT FALSE,
-                    UNIQUE(user_id, type_id)
-                )
-            """)
+                SELECT type_id, local_day, count FROM activity_daily_counts
+                WHERE user_id = %s ORDER BY type_id, local_day
+            """, (user_id,))
+            return cursor.fetchall()
+
+    def _rebuild_daily_counts(self, user_ids):
+        """Recount the users' daily counts from their activities, and have their calculations rebuilt from them"""
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            self._lock_users(cursor, user_ids)
+            cursor.execute(queries.REBUILD_DAILY_COUNTS, {"user_ids": list(user_ids)})
+            cursor.execute("""
+                UPDATE user_calculations SET valid = FALSE WHERE user_id = ANY(%s)
+            """, (list(user_ids),))
+            cursor.execute(queries.BUMP_DATA_VERSIONS, (list(user_ids),))
             conn.commit()
 
+    # User calculations table methods
+
     def _add_user_calculation(self, user_id, type_id, total = 0, thirty = 0, season = 0, valid = False):
         with self._get_connection() as conn:
             cursor = conn.cursor()
@@ -396,44 +730,81 @@ class DatabaseHandler:
             conn.commit()
 
     def _get_user_calculations(self, user_id):
-        calculations = []
         with self._get_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("""
-                SELECT * FROM user_calculations WHERE user_id = %s
-            """, (user_id,))
-            rows = cursor.fetchall()
-            for row in rows:
-                calculations.append({
-                    "id": row[0],
-                    "user_id": row[1],
-                    "type_id": row[2],
-                    "total": row[3],
-                    "thirty": row[4],
-                    "season": row[5],
-                    "valid": row[6]
-                })
-        return calculations
+            cursor.execute(queries.SELECT_USER_CALCULATIONS, (user_id,))
+            return [queries.calculation_row(row) for row in cursor.fetchall()]
     
     def _get_invalid_user_calculations(self, user_id):
-        calculations = []
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(queries.SELECT_USER_CALCULATIONS + " AND valid = FALSE", (user_id,))
+            return [queries.calculation_row(row) for row in cursor.fetchall()]
+
+    def _get_frequency_rows(self, user_id, with_last_time = True):
+        """Each type's name, seasonal targets, stored averages and last activity time, in one query"""
+        query = queries.SELECT_FREQUENCY_ROWS if with_last_time else queries.SELECT_FREQUENCY_ROWS_WITHOUT_LAST_TIME
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(query, (user_id,))
+            return [queries.frequency_row(row) for row in cursor.fetchall()]
+
+    def _apply_calculation_deltas(self, cursor, user_id, rows, sign):
+        # Fold inserted (sign 1) or deleted (sign -1) (type_id, time) rows into the running aggregates
+        if not rows:
+            return
+        execute_values(cursor, queries.calculation_deltas(sign, "%s"), queries.activity_params(user_id, rows),
+                       template=queries.ACTIVITY_ROW_TEMPLATE, page_size=1000)
+
+    def _refresh_user_calculations(self, user_id, thirty_cutoff, season_start):
+        """Bring the running aggregates of a user up to date with the given window boundaries"""
+        params = {"user_id": user_id, "thirty_cutoff": thirty_cutoff, "season_start": season_start}
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(queries.REBUILD_USER_CALCULATIONS, params)
+            cursor.execute(queries.ROLL_USER_CALCULATION_WINDOWS, params)
+            conn.commit()
+
+    def _rebuild_user_calculations_bulk(self, user_ids, compute_rows):
+        """Recount many users' calculations from their activities in one transaction.
+
+        compute_rows(calculations, activities) gets the (user_id, type_id, timezone) calculation rows
+        and the (user_id, type_id, epoch seconds) activity rows, and returns (user_id, type_id,
+        total_count, first_time, thirty_count, season_count, thirty_cutoff, season_start, total,
+        thirty, season) rows to store. The calculations are locked first, so adds and deletes that
+        land meanwhile apply their deltas on top of the rebuilt counts.
+        """
         with self._get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("""
-                SELECT * FROM user_calculations WHERE user_id = %s AND valid = FALSE
-            """, (user_id,))
-            rows = cursor.fetchall()
-            for row in rows:
-                calculations.append({
-                    "id": row[0],
-                    "user_id": row[1],
-                    "type_id": row[2],
-                    "total": row[3],
-                    "thirty": row[4],
-                    "season": row[5],
-                    "valid": row[6]
-                })
-        return calculations
+                SELECT uc.user_id, uc.type_id, u.timezone
+                FROM user_calculations uc
+                JOIN users u ON u.id = uc.user_id
+                WHERE uc.user_id = ANY(%s)
+                FOR UPDATE OF uc
+            """, (list(user_ids),))
+            calculations = cursor.fetchall()
+            cursor.execute("""
+                SELECT user_id, type_id, EXTRACT(EPOCH FROM time)::float8
+                FROM activities WHERE user_id = ANY(%s)
+            """, (list(user_ids),))
+            activities = cursor.fetchall()
+
+            rows = compute_rows(calculations, activities)
+            execute_values(cursor, """
+                UPDATE user_calculations uc
+                SET total_count = v.total_count, first_time = v.first_time,
+                    thirty_count = v.thirty_count, season_count = v.season_count,
+                    thirty_cutoff = v.thirty_cutoff, season_start = v.season_start,
+                    total = v.total, thirty = v.thirty, season = v.season, valid = TRUE
+                FROM (VALUES %s) AS v(user_id, type_id, total_count, first_time, thirty_count, season_count,
+                                      thirty_cutoff, season_start, total, thirty, season)
+                WHERE uc.user_id = v.user_id AND uc.type_id = v.type_id
+            """, rows, template="""(%s::integer, %s::integer, %s::integer, %s::timestamptz, %s::integer, %s::integer,
+                                    %s::timestamptz, %s::timestamptz, %s::float, %s::float, %s::float)""", page_size=1000)
+            cursor.execute(queries.BUMP_DATA_VERSIONS, (list(user_ids),))
+            conn.commit()
+        return len(rows)
 
     def _invalidate_user_calculation(self, user_id, type_id):
         with self._get_connection() as conn:
@@ -449,4 +820,35 @@ class DatabaseHandler:
             cursor.execute("""
                 UPDATE user_calculations SET total = %s, thirty = %s, season = %s, valid = %s WHERE user_id = %s AND type_id = %s
             """, (total, thirty, season, valid, user_id, type_id))
-            conn.commit()
\ No newline at end of file
+            conn.commit()
+
+    def _store_calculation_counts(self, user_id, version, rows):
+        """Store (type_id, total_count, first_time, thirty_count, season_count, thirty_cutoff, season_start) rows
+        counted at data_version version, like _refresh_user_calculations does from the daily counts.
+
+        The calculations are locked first, in the same order writes take their locks, so a write either
+        committed before and moved the version on, or applies its deltas on top of these counts after.
+        Returns False, storing nothing, when the version moved on.
+        """
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(queries.LOCK_USER_CALCULATIONS, (user_id,))
+            cursor.execute(queries.SELECT_DATA_VERSION, (user_id,))
+            row = cursor.fetchone()
+            if row is None or row[0] != version:
+                conn.rollback()
+                return False
+            execute_values(cursor, queries.update_calculation_counts("%s"), [(user_id,) + tuple(row) for row in rows],
+                           template=queries.COUNTS_ROW_TEMPLATE)
+            conn.commit()
+            return True
+
+    def _update_user_calculations_bulk(self, user_id, rows):
+        # rows are (type_id, total, thirty, season) tuples, all marked valid
+        if not rows:
+            return
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            execute_values(cursor, queries.update_calculation_averages("%s"), [(user_id,) + tuple(row) for row in rows],
+                           template=queries.AVERAGES_ROW_TEMPLATE)
+            conn.commit()
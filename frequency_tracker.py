@@ -1,10 +1,17 @@
+import base64
 import csv
+import json
+import os
 from pydantic import BaseModel
 from rich import print as rprint
-from strava_handler import StravaHandler
+from strava_handler import StravaHandler, StravaTokenManager, StravaTokenError
 from database_handler import DatabaseHandler
+from async_database_handler import AsyncDatabaseHandler
 from calculation_handler import CalculationHandler
+from activity_index import ActivityIndex, to_epoch_us, from_epoch_us
+import queries
 from datetime import datetime, timezone, timedelta
+import numpy as np
 import pytz
 import requests
 
@@ -42,100 +49,396 @@ class Activity(BaseModel):
     time: str  # format: YYYY-MM-DDTHH:MM:SSZ example : 2025-02-24T20:16:13Z
 
 
+class ActivityBatch(BaseModel):
+
+    # Applied in one transaction, deletes first so an activity can be moved within a batch
+    add: list[Activity] = []
+    delete: list[Activity] = []
+
+
+class StravaEvent(BaseModel):
+
+    # https://developers.strava.com/docs/webhooks/
+    object_type: str  # "activity" or "athlete"
+    object_id: int
+    aspect_type: str  # "create", "update" or "delete"
+    owner_id: int
+    subscription_id: int
+    event_time: int
+    updates: dict = {}
+
+
 class FrequencyTracker(DatabaseHandler, StravaHandler, CalculationHandler):
 
-    current_user_id = -1
+    # Most activities apply_activity_batch takes at once
+    max_batch_size = 5000
 
     # Create access token on construction
     def __init__(self, db_url = ''):
         DatabaseHandler.__init__(self, db_url)
         StravaHandler.__init__(self)
         CalculationHandler.__init__(self)
+        self.async_db = AsyncDatabaseHandler(self.db_url)
+        self.token_manager = StravaTokenManager(self._get_strava_tokens, self._update_strava_tokens, self.refresh_access_token)
+
+        # In-memory activity times, off unless given a memory budget
+        self.activity_index = None
+        activity_index_memory_mb = float(os.environ.get("ACTIVITY_INDEX_MEMORY_MB", 0))
+        if activity_index_memory_mb > 0:
+            self.activity_index = ActivityIndex(int(activity_index_memory_mb * 1024 * 1024))
 
-    def ensure_valid_user(self):
-        return self.current_user_id != -1
+    def ensure_valid_user(self, user_id):
+        return user_id != -1
 
-    def sync_strava(self, since: str = None):
+    def sync_strava(self, user_id, since: str = None, progress = None, max_pages: int = None):
 
-        if not self.ensure_valid_user():
+        if not self.ensure_valid_user(user_id):
             return {"success": False, "message": "No user is signed in"}
 
-        # Get the user's Strava tokens
-        tokens = self.get_strava_tokens()
-        if not tokens:
-            return {"success": False, "message": "No Strava account linked. Please link your Strava account first."}
+        # Make sure a Strava account is linked, refreshing the token now if it is about to expire
+        try:
+            if self.token_manager.get_access_token(user_id) is None:
+                return {"success": False, "message": "No Strava account linked. Please link your Strava account first."}
+        except StravaTokenError as e:
+            print(f"Error refreshing token: {e}")
+            return {"success": False, "message": "Failed to refresh Strava access token. Please re-link your Strava account."}
+
+        # By default only ask Strava for activities newer than the last one we ingested
+        if since is None:
+            sync_state = self._get_strava_sync_state(user_id)
+            if sync_state and sync_state["watermark"]:
+                since = datetime.fromtimestamp(sync_state["watermark"], timezone.utc).isoformat()
+
+        # Counts passed to progress after every committed page, resume_since is where a retry picks up
+        sync_progress = {
+            "phase": "fetching",
+            "pages_fetched": 0,
+            "activities_fetched": 0,
+            "activities_inserted": 0,
+            "resume_since": since
+        }
+
+        def get_access_token(rejected_token = None):
+            return self.token_manager.get_access_token(user_id, rejected_token=rejected_token)
 
         try:
-            # This function does not attempt to trim the activities to only new ones
             # Duplicates are handled on the sql end
-            activities = self._fetch_strava_activities(tokens["access_token"], since)
-
-            for strava_activity in activities:
-                activity = Activity(type=strava_activity['sport_type'], time=strava_activity['start_date'])
-                self.add_activity(activity)
-            print(f"Synced {len(activities)} activities from Strava")
-            self.compute_frequency_averages()
-            return {"success": True, "message": f"Successfully synced {len(activities)} activities from Strava"}
-        except requests.exceptions.HTTPError as e:
-            if e.response.status_code == 401:
-                # Token has expired, try to refresh it
-                try:
-                    print("Access token expired, attempting to refresh...")
-                    refresh_result = self.refresh_access_token(tokens["refresh_token"])
-                    
-                    if refresh_result["success"]:
-                        new_tokens = refresh_result["data"]
-                        # Update the database with new tokens
-                        self.update_strava_tokens(
-                            new_tokens["access_token"],
-                            new_tokens["refresh_token"],
-                            new_tokens.get("expires_at")
-                        )
-                        
-                        # Retry the sync with the new token
-                        print("Token refreshed successfully, retrying sync...")
-                        activities = self._fetch_strava_activities(new_tokens["access_token"], since)
-                        
-                        for strava_activity in activities:
-                            activity = Activity(type=strava_activity['sport_type'], time=strava_activity['start_date'])
-                            self.add_activity(activity)
-                        print(f"Synced {len(activities)} activities from Strava")
-                        self.compute_frequency_averages()
-                        return {"success": True, "message": f"Successfully synced {len(activities)} activities from Strava"}
-                    else:
-                        return {"success": False, "message": "Failed to refresh Strava access token. Please re-link your Strava account."}
-                except Exception as refresh_error:
-                    print(f"Error refreshing token: {refresh_error}")
-                    return {"success": False, "message": "Failed to refresh Strava access token. Please re-link your Strava account."}
-            else:
-                return {"success": False, "message": f"Error syncing Strava activities: {str(e)}"}
+            return self._ingest_strava_activities(user_id, get_access_token, sync_progress, progress, max_pages)
+        except StravaTokenError as e:
+            print(f"Error refreshing token: {e}")
+            return {"success": False, "message": "Failed to refresh Strava access token. Please re-link your Strava account.", **self._sync_counts(sync_progress)}
         except Exception as e:
-            return {"success": False, "message": f"Error syncing Strava activities: {str(e)}"}
+            return {"success": False, "message": f"Error syncing Strava activities: {str(e)}", **self._sync_counts(sync_progress)}
+
+    def _sync_counts(self, sync_progress):
+        return {
+            "pages_fetched": sync_progress["pages_fetched"],
+            "activities_fetched": sync_progress["activities_fetched"],
+            "activities_inserted": sync_progress["activities_inserted"]
+        }
+
+    def _ingest_strava_activities(self, user_id, get_access_token, sync_progress, progress = None, max_pages = None):
+
+        # Resolve every type name once
+        type_ids = {activity_type["type"]: activity_type["id"] for activity_type in self._get_user_activity_types(user_id)}
+
+        # Insert and commit each page as it arrives, so a failure only loses the page in flight
+        fetch_state = {}
+        for page in self._fetch_strava_activity_pages(get_access_token, sync_progress["resume_since"], max_pages, fetch_state):
+            rows = []
+            watermark = 0
+            for strava_activity in page:
+                start_date = self._parse_activity_time(strava_activity['start_date'])
+                watermark = max(watermark, int(start_date.timestamp()))
+                type_id = type_ids.get(strava_activity['sport_type'])
+                if type_id is not None:
+                    rows.append((type_id, start_date, strava_activity['id']))
+
+            sync_progress["activities_inserted"] += self._add_strava_activities_bulk(user_id, rows)
+            self._invalidate_activity_index(user_id)
+            self._set_strava_sync_state(user_id, watermark)
+
+            sync_progress["pages_fetched"] += 1
+            sync_progress["activities_fetched"] += len(page)
+            sync_progress["resume_since"] = datetime.fromtimestamp(watermark, timezone.utc).isoformat()
+            if progress:
+                progress(dict(sync_progress))
+
+        sync_progress["phase"] = "computing"
+        if progress:
+            progress(dict(sync_progress))
+        # A sync cut short by max_pages stays due, so the next one carries on from the watermark
+        complete = not fetch_state["truncated"]
+        if complete:
+            self._set_strava_sync_state(user_id, None, int(datetime.now(timezone.utc).timestamp()))
+        self.compute_frequency_averages(user_id)
+
+        activities_fetched = sync_progress["activities_fetched"]
+        print(f"Synced {activities_fetched} activities from Strava{'' if complete else ', more are left for the next sync'}")
+        return {"success": True, "message": f"Successfully synced {activities_fetched} activities from Strava", "complete": complete, **self._sync_counts(sync_progress)}
+
+    def validate_strava_webhook(self, mode, verify_token, challenge):
+        return self._validate_webhook_subscription(mode, verify_token, challenge)
+
+    def accepts_strava_event(self, event: StravaEvent):
+        return self._is_webhook_event_accepted(event.subscription_id)
+
+    def handle_strava_event(self, event: StravaEvent):
+        """Apply one webhook event, fetching at most the one activity it is about."""
+
+        if not self.accepts_strava_event(event):
+            return {"success": False, "message": "Unknown webhook subscription"}
+
+        user_id = self._find_user_by_strava_athlete_id(event.owner_id)
+        if user_id is None:
+            return {"success": False, "message": "No user is linked to this Strava athlete"}
+
+        if event.object_type == "athlete":
+            # The only athlete event is a revoked authorization
+            if event.updates.get("authorized") == "false":
+                self._clear_strava_tokens(user_id)
+                self.token_manager.invalidate(user_id)
+                return {"success": True, "message": "Strava account unlinked"}
+            return {"success": True, "message": "Nothing to update"}
+
+        if event.object_type != "activity":
+            return {"success": True, "message": "Nothing to update"}
+
+        if event.aspect_type == "delete":
+            removed = self._remove_strava_activity(user_id, event.object_id)
+            self._invalidate_activity_index(user_id)
+            return {"success": True, "message": f"Removed {removed} activities", "inserted": 0, "removed": removed}
+
+        # Updates only report title, type and privacy changes, a new title changes nothing we store
+        if event.aspect_type == "update" and "type" not in event.updates:
+            return {"success": True, "message": "Nothing to update"}
+
+        def get_access_token(rejected_token = None):
+            return self.token_manager.get_access_token(user_id, rejected_token=rejected_token)
 
-    def get_activities(self):
-        return self._get_activities(self.current_user_id)
+        try:
+            strava_activity = self._fetch_strava_activity(get_access_token, event.object_id)
+        except StravaTokenError as e:
+            print(f"Error refreshing token: {e}")
+            return {"success": False, "message": "Failed to refresh Strava access token"}
+        except Exception as e:
+            return {"success": False, "message": f"Error fetching Strava activity: {str(e)}"}
+
+        if strava_activity is None:
+            removed = self._remove_strava_activity(user_id, event.object_id)
+            self._invalidate_activity_index(user_id)
+            return {"success": True, "message": "Activity is no longer visible on Strava", "inserted": 0, "removed": removed}
+
+        # Untracked sport types are removed, in case the activity was retyped away from a tracked one
+        type_id = self._get_activity_type_id(user_id, strava_activity['sport_type'])
+        if type_id == -1:
+            type_id = None
+        start_date = self._parse_activity_time(strava_activity['start_date'])
+        inserted, removed = self._upsert_strava_activity(user_id, event.object_id, type_id, start_date)
+        self._invalidate_activity_index(user_id)
+        return {"success": True, "message": f"Stored Strava activity {event.object_id}", "inserted": inserted, "removed": removed}
+
+    def get_strava_sync_candidates(self, synced_before, limit):
+        return self._get_strava_sync_candidates(synced_before, limit)
+
+    def get_activities(self, user_id):
+        return self._get_activities(user_id)
+
+    # Activity table pages and exports
+
+    def _activity_filters(self, activity_type = None, since: str = None, until: str = None, cursor: str = None):
+        # Query filters for select_activities_page, raises ValueError for unparseable times or cursors
+        filters = {"activity_type": activity_type, "since": None, "until": None, "after_time": None, "after_id": None}
+        for key, value in (("since", since), ("until", until)):
+            if value:
+                timestamp = datetime.fromisoformat(value)
+                filters[key] = timestamp if timestamp.tzinfo else timestamp.replace(tzinfo=timezone.utc)
+        if cursor:
+            filters["after_time"], filters["after_id"] = self._decode_activity_cursor(cursor)
+        return filters
+
+    def _encode_activity_cursor(self, activity):
+        # Opaque to clients, the (time, id) of the last activity on a page
+        position = f"{to_epoch_us(activity['time'])}:{activity['id']}"
+        return base64.urlsafe_b64encode(position.encode()).decode().rstrip("=")
+
+    def _decode_activity_cursor(self, cursor: str):
+        try:
+            position = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+            epoch_us, activity_id = position.split(":")
+            return from_epoch_us(int(epoch_us)), int(activity_id)
+        except Exception:
+            raise ValueError("Invalid cursor")
 
-    def add_activity(self, activity: Activity):  
+    async def get_activities_page_async(self, user_id, limit = 100, cursor: str = None, activity_type: str = None, since: str = None, until: str = None):
+        """A page of activities in time order, and the cursor of the page after it (None on the last page)"""
 
-        if not self.ensure_valid_user():
+        if not self.ensure_valid_user(user_id):
             return
-        # Ensure we have a UTC time
-        
-        timestamp = datetime.fromisoformat(activity.time)
+
+        filters = self._activity_filters(activity_type, since, until, cursor)
+        activities = await self.async_db._get_activities_page(user_id, filters, limit + 1)
+        next_cursor = None
+        if len(activities) > limit:
+            activities = activities[:limit]
+            next_cursor = self._encode_activity_cursor(activities[-1])
+        return {"activities": activities, "next_cursor": next_cursor}
+
+    def stream_activities_async(self, user_id, activity_type: str = None, since: str = None, until: str = None):
+        """Every matching activity as NDJSON, one chunk of lines per batch read from the async pool.
+
+        The filters are checked here, before anything is streamed, the rows are only read as the chunks are consumed.
+        """
+        filters = self._activity_filters(activity_type, since, until)
+
+        async def ndjson_chunks():
+            async for activities in self.async_db._stream_activities(user_id, filters):
+                yield "".join(json.dumps(dict(activity, time=activity["time"].isoformat())) + "\n" for activity in activities)
+
+        return ndjson_chunks()
+
+    # CSV import and export, activities as (type, time) rows and activity types as
+    # (type, winter, spring, summer, fall) rows, both with a header row
+
+    csv_kinds = ("activities", "activity_types")
+
+    def _csv_copy_out(self, user_id, kind):
+        if kind == "activities":
+            return queries.copy_activities_out(user_id)
+        return queries.copy_activity_types_out(user_id)
+
+    def _csv_imported(self, user_id, kind, result):
+        # Caches the import went around
+        if kind == "activities":
+            self._invalidate_activity_index(user_id)
+            return {"success": True, **result}
+        created, updated = result
+        if created:
+            # Like add_activity_type, Strava activities of the new types were skipped before
+            self._reset_strava_sync_watermark(user_id)
+        return {"success": True, "created": created, "updated": updated}
+
+    def import_csv(self, user_id, kind, file):
+        """Import a CSV file of activities or activity types in one transaction, through COPY"""
+
+        if not self.ensure_valid_user(user_id):
+            return {"success": False, "message": "No user is signed in"}
+        if kind not in self.csv_kinds:
+            return {"success": False, "message": f"Unknown CSV kind {kind}"}
+
+        try:
+            if kind == "activities":
+                result = self._import_activities_csv(user_id, file)
+            else:
+                result = self._import_activity_types_csv(user_id, file)
+        except Exception as e:
+            return {"success": False, "message": f"Error importing {kind}: {str(e)}"}
+        return self._csv_imported(user_id, kind, result)
+
+    async def import_csv_async(self, user_id, kind, chunks):
+        """Like import_csv, for CSV arriving as an async iterator of byte chunks, e.g. a request body"""
+
+        if not self.ensure_valid_user(user_id):
+            return {"success": False, "message": "No user is signed in"}
+        if kind not in self.csv_kinds:
+            return {"success": False, "message": f"Unknown CSV kind {kind}"}
+
+        try:
+            if kind == "activities":
+                result = await self.async_db._import_activities_csv(user_id, chunks)
+            else:
+                result = await self.async_db._import_activity_types_csv(user_id, chunks)
+        except Exception as e:
+            return {"success": False, "message": f"Error importing {kind}: {str(e)}"}
+        return self._csv_imported(user_id, kind, result)
+
+    def export_csv(self, user_id, kind, file):
+        # Writes the user's activities or activity types to file, through COPY
+        self._export_csv(self._csv_copy_out(user_id, kind), file)
+
+    def export_csv_async(self, user_id, kind):
+        # The same CSV as export_csv, as an async iterator of byte chunks
+        return self.async_db._export_csv(self._csv_copy_out(user_id, kind))
+
+    def _parse_activity_time(self, time: str):
+        # Ensure we have a UTC time, converting rather than relabelling other offsets
+        timestamp = datetime.fromisoformat(time)
         if timestamp.utcoffset() is not None:
-            timestamp = timestamp.replace(tzinfo=timezone.utc)
+            timestamp = timestamp.astimezone(timezone.utc)
+        return timestamp
+
+    def add_activity(self, user_id, activity: Activity):  
+
+        if not self.ensure_valid_user(user_id):
+            return
+
+        timestamp = self._parse_activity_time(activity.time)
 
-        activity_type_id = self._get_activity_type_id(self.current_user_id, activity.type)
+        activity_type_id = self._get_activity_type_id(user_id, activity.type)
         if activity_type_id == -1:
             return
 
-        self._add_activity(self.current_user_id, activity_type_id, timestamp)
-        self._invalidate_user_calculation(self.current_user_id, activity_type_id)
+        inserted, version = self._add_activity(user_id, activity_type_id, timestamp)
+        self._index_activities(user_id, version, added=inserted)
 
         
-    def delete_activity(self, activity: Activity):
+    def apply_activity_batch(self, user_id, batch: ActivityBatch):
+        """Add and delete many activities in one transaction, with a status for each of them.
+
+        Statuses are added or duplicate for adds, deleted or not_found for deletes, and unknown_type
+        or invalid_time for activities that couldn't be applied. Times without an offset are UTC.
+        """
+
+        if not self.ensure_valid_user(user_id):
+            return {"success": False, "message": "No user is signed in"}
+        if len(batch.add) + len(batch.delete) > self.max_batch_size:
+            return {"success": False, "message": f"A batch holds at most {self.max_batch_size} activities"}
+
+        # Every type name resolved once for the whole batch
+        type_ids = self._get_activity_type_ids(user_id, {activity.type for activity in batch.add + batch.delete})
+
+        def resolve(activity):
+            # The (type_id, time) row for an activity, or why it can't be applied
+            if activity.type not in type_ids:
+                return None, "unknown_type"
+            try:
+                timestamp = self._parse_activity_time(activity.time)
+            except ValueError:
+                return None, "invalid_time"
+            if timestamp.tzinfo is None:
+                timestamp = timestamp.replace(tzinfo=timezone.utc)
+            return (type_ids[activity.type], timestamp), None
+
+        adds = [resolve(activity) for activity in batch.add]
+        deletes = [resolve(activity) for activity in batch.delete]
+        inserted, deleted, version = self._apply_activity_batch(user_id, [row for row, _ in adds if row], [row for row, _ in deletes if row])
+        self._index_activities(user_id, version, added=inserted, removed=deleted)
+
+        def item_results(activities, resolved, applied, applied_status, skipped_status):
+            # A row that took effect is credited to its first activity, repeats within the batch were skipped
+            applied = {(type_id, time) for type_id, time in applied}
+            results = []
+            for activity, (row, error) in zip(activities, resolved):
+                status = error
+                if status is None:
+                    status = applied_status if row in applied else skipped_status
+                    applied.discard(row)
+                results.append({"type": activity.type, "time": activity.time, "status": status})
+            return results
+
+        return {
+            "success": True,
+            "added": len(inserted),
+            "deleted": len(deleted),
+            "results": {
+                "add": item_results(batch.add, adds, inserted, "added", "duplicate"),
+                "delete": item_results(batch.delete, deletes, deleted, "deleted", "not_found")
+            }
+        }
+
+    def delete_activity(self, user_id, activity: Activity):
         
-        if not self.ensure_valid_user():
+        if not self.ensure_valid_user(user_id):
             return
         
         # Ensure we have a UTC time
@@ -143,214 +446,240 @@ class FrequencyTracker(DatabaseHandler, StravaHandler, CalculationHandler):
         if timestamp.utcoffset() is not None:
             timestamp = timestamp.replace(tzinfo=None)
 
-        activity_type_id = self._get_activity_type_id(self.current_user_id, activity.type)
-        self._remove_activity(self.current_user_id, activity_type_id, timestamp)
-        self._invalidate_user_calculation(self.current_user_id, activity_type_id)
+        activity_type_id = self._get_activity_type_id(user_id, activity.type)
+        deleted, version = self._remove_activity(user_id, activity_type_id, timestamp)
+        self._index_activities(user_id, version, removed=deleted)
         
-    def time_of_last_activity(self, type_id):
+    def time_of_last_activity(self, user_id, type_id):
         
-        if not self.ensure_valid_user():
+        if not self.ensure_valid_user(user_id):
             return
         
-        most_recent_activity = self._get_most_recent_activity(self.current_user_id, type_id)
+        if self.activity_index is not None:
+            data_version = self._get_data_version(user_id)
+            if data_version is None:
+                return -1
+            last_time = self._indexed_last_times(user_id, data_version["version"]).get(type_id)
+            return -1 if last_time is None else self._days_ago(last_time, self._user_clock(user_id))
+
+        most_recent_activity = self._get_most_recent_activity(user_id, type_id)
         if most_recent_activity:
-            return self._days_ago(most_recent_activity[3], self._get_user_timezone(self.current_user_id))
+            return self._days_ago(most_recent_activity[3], self._user_clock(user_id))
         else:
             return -1
 
-    def get_user_timezone(self):
+    # Activity index upkeep. Writes that return the data version they bumped to are applied in place,
+    # any other write leaves a version gap and the user's times are reloaded on the next read
+
+    def _index_activities(self, user_id, version, added = (), removed = ()):
+        if self.activity_index is not None and version is not None:
+            self.activity_index.apply(user_id, version, added, removed)
+
+    def _invalidate_activity_index(self, user_id):
+        if self.activity_index is not None:
+            self.activity_index.invalidate(user_id)
+
+    def _indexed_last_times(self, user_id, version):
+        # Each type's last activity time from the index, reloading the user's times in one query when not cached at version
+        last_times = self.activity_index.last_times(user_id, version)
+        if last_times is None:
+            version, epochs_by_type = self._get_user_activity_epochs(user_id)
+            self.activity_index.store(user_id, version, epochs_by_type)
+            last_times = {type_id: from_epoch_us(epochs[-1]) for type_id, epochs in epochs_by_type.items()}
+        return last_times
+
+    async def _indexed_last_times_async(self, user_id, version):
+        last_times = self.activity_index.last_times(user_id, version)
+        if last_times is None:
+            version, epochs_by_type = await self.async_db._get_user_activity_epochs(user_id)
+            self.activity_index.store(user_id, version, epochs_by_type)
+            last_times = {type_id: from_epoch_us(epochs[-1]) for type_id, epochs in epochs_by_type.items()}
+        return last_times
+
+    def _indexed_calculation_counts(self, calculations, clock):
+        # Recounted (type_id, total_count, first_time, thirty_count, season_count, thirty_cutoff, season_start)
+        # rows from the index, None unless it holds the user at the calculations' data version
+        rows = []
+        for calculation in calculations:
+            user_id, type_id, version = calculation["user_id"], calculation["type_id"], calculation["data_version"]
+            first_time = self.activity_index.first(user_id, type_id, version)
+            if first_time is None:
+                return None
+            total_count = self.activity_index.count_since(user_id, type_id, version)
+            thirty_count = self.activity_index.count_since(user_id, type_id, version, clock.thirty_cutoff)
+            season_count = self.activity_index.count_since(user_id, type_id, version, clock.season_start)
+            if None in (first_time, total_count, thirty_count, season_count):
+                return None
+            first_time = None if first_time == -1 else first_time
+            rows.append((type_id, total_count, first_time, thirty_count, season_count, clock.thirty_cutoff, clock.season_start))
+        return rows
+
+    def _stale_calculations(self, calculations, clock):
+        # Calculations that were invalidated, never counted, or counted against windows that have since rolled over
+        return [
+            calculation for calculation in calculations
+            if not calculation["valid"] or calculation["thirty_cutoff"] != clock.thirty_cutoff or calculation["season_start"] != clock.season_start
+        ]
+
+    def _frequency_rows(self, user_id):
+        # Last activity times come from the index when it's on, instead of a MAX per type
+        if self.activity_index is None:
+            return self._get_frequency_rows(user_id)
+        frequency_rows = self._get_frequency_rows(user_id, with_last_time=False)
+        if frequency_rows:
+            last_times = self._indexed_last_times(user_id, frequency_rows[0]["data_version"])
+            for row in frequency_rows:
+                row["last_time"] = last_times.get(row["type_id"])
+        return frequency_rows
+
+    async def _frequency_rows_async(self, user_id):
+        if self.activity_index is None:
+            return await self.async_db._get_frequency_rows(user_id)
+        frequency_rows = await self.async_db._get_frequency_rows(user_id, with_last_time=False)
+        if frequency_rows:
+            last_times = await self._indexed_last_times_async(user_id, frequency_rows[0]["data_version"])
+            for row in frequency_rows:
+                row["last_time"] = last_times.get(row["type_id"])
+        return frequency_rows
+
+    def get_user_timezone(self, user_id):
                 
-        if not self.ensure_valid_user():
+        if not self.ensure_valid_user(user_id):
             return
         
-        return self._get_user_timezone(self.current_user_id)
-
-    def set_user_timezone(self, timezone: str):
-        self._set_user_timezone(self.current_user_id, timezone)
-
-    def get_current_user_id(self):
-        return self.current_user_id
+        return self._get_user_timezone(user_id)
 
     def sign_in(self, email, password):
-        result = self._sign_in(email, password)
-        if result["success"]:
-            self.current_user_id = result["id"]
-        return result
+        return self._sign_in(email, password)
 
     def sign_out(self):
-        self.current_user_id = -1
         return {"success": True, "message": "User signed out"}
 
     def create_user(self, email, password, name, timezone):
         hashed_password = self.hash_password(password)
         result = self._create_user(email, hashed_password, name, timezone)
         if result["success"]:
-            self.current_user_id = result["id"]
-            print(f"Created user {self.current_user_id}")
+            print(f"Created user {result['id']}")
         return result
 
-    def delete_user(self):
-        if not self.ensure_valid_user():
+    def delete_user(self, user_id):
+        if not self.ensure_valid_user(user_id):
             return {"success": False, "message": "No user is signed in."}
         
-        user_id_to_delete = self.current_user_id
-        # Sign the user out first
-        self.current_user_id = -1
-        
-        return self._remove_user(user_id_to_delete)
+        result = self._remove_user(user_id)
+        self._invalidate_activity_index(user_id)
+        return result
 
-    def get_user_name(self):
-        if not self.ensure_valid_user():
+    def get_user_name(self, user_id):
+        if not self.ensure_valid_user(user_id):
             return None
-        return self._get_user_name(self.current_user_id)
+        return self._get_user_name(user_id)
 
-    def set_user_timezone(self, timezone: str):              
-        if not self.ensure_valid_user():
+    def set_user_timezone(self, user_id, timezone: str):              
+        if not self.ensure_valid_user(user_id):
             return
-        self._set_user_timezone(self.current_user_id, timezone)
+        self._set_user_timezone(user_id, timezone)
 
-    def add_activity_type(self, activity_type: str, winter: int, spring: int, summer: int, fall: int):
+    def add_activity_type(self, user_id, activity_type: str, winter: int, spring: int, summer: int, fall: int):
                 
-        if not self.ensure_valid_user():
+        if not self.ensure_valid_user(user_id):
             return
         
-        activity_type_id = self._create_activity_type(self.current_user_id, activity_type, winter, spring, summer, fall)
+        activity_type_id = self._create_activity_type(user_id, activity_type, winter, spring, summer, fall)
         if activity_type_id is not None:
-            self._add_user_calculation(self.current_user_id, activity_type_id, 0, 0, 0, True)
+            self._add_user_calculation(user_id, activity_type_id, 0, 0, 0, True)
+            # Only once the calculation exists, or a read in between could be cached as current
+            self._bump_data_version(user_id)
+            # Strava activities of this type from before the watermark were skipped, fetch them on the next sync
+            self._reset_strava_sync_watermark(user_id)
 
-    def delete_activity_type(self, activity_type: str):
+    def delete_activity_type(self, user_id, activity_type: str):
                 
-        if not self.ensure_valid_user():
+        if not self.ensure_valid_user(user_id):
             return
         
-        activity_type_id = self._get_activity_type_id(self.current_user_id, activity_type)
-        self._remove_activity_type(self.current_user_id, activity_type)
+        activity_type_id = self._get_activity_type_id(user_id, activity_type)
+        self._remove_activity_type(user_id, activity_type)
+        self._invalidate_activity_index(user_id)
 
-    def get_activity_types(self):
-        return self._get_user_activity_types(self.current_user_id)
+    def get_activity_types(self, user_id):
+        return self._get_user_activity_types(user_id)
 
     def store_strava_tokens(self, user_id, athlete_id, access_token, refresh_token, expires_at):
+        self.token_manager.invalidate(user_id)
         return self._store_strava_tokens(user_id, athlete_id, access_token, refresh_token, expires_at)
 
-    def update_strava_tokens(self, access_token, refresh_token, expires_at):
-        if not self.ensure_valid_user():
+    def update_strava_tokens(self, user_id, access_token, refresh_token, expires_at):
+        if not self.ensure_valid_user(user_id):
             return {"success": False, "message": "No user is signed in"}
-        return self._update_strava_tokens(self.current_user_id, access_token, refresh_token, expires_at)
+        self.token_manager.invalidate(user_id)
+        return self._update_strava_tokens(user_id, access_token, refresh_token, expires_at)
 
-    def get_strava_tokens(self):
-        if not self.ensure_valid_user():
+    def get_strava_tokens(self, user_id):
+        if not self.ensure_valid_user(user_id):
             return None
-        return self._get_strava_tokens(self.current_user_id)
-
-    def compute_frequency_averages(self):
-                
-        if not self.ensure_valid_user():
-            return
-        
-        # 30 Days ago
-        local_timestamp = datetime.now()
-        rollback = local_timestamp.hour * 3600 + local_timestamp.minute*60 + local_timestamp.second
-        difference = timedelta(seconds=(30*24*3600 + rollback))
-        thirty_days_ago = datetime.now(timezone.utc) - difference
-        
-        # Determine current season and set season start date
-        user_timezone = self._get_user_timezone(self.current_user_id)
-        season_start = self._get_season_start(user_timezone)
-
-        # Setup a counter container for each invalid type in the calculations table
-        invalid_calculations = self._get_invalid_user_calculations(self.current_user_id)
-        for calculation in invalid_calculations:
-
-            # Get all activities for this type
-            total_activity_span = 0
-            total_activity_count = 0
-            thirty_day_activity_count = 0
-            seasonal_activity_count = 0
-
-            activities = self._get_activities_by_type(self.current_user_id, calculation["type_id"])
-            for activity in activities:
-
-                # Calculate the total span of the activities
-                if total_activity_span == 0:
-                    total_activity_span = self._days_ago(activity["time"], user_timezone)
-
-                total_activity_count += 1
-                if activity["time"] > thirty_days_ago:
-                    thirty_day_activity_count += 1
-                if activity["time"] > season_start:
-                    seasonal_activity_count += 1
-
-            # Calculate the averages
-            total_frequency = -1
-            if(total_activity_count > 0):
-                total_frequency = round(total_activity_span / total_activity_count, 2)
-            thirty_frequency = -1
-            if(thirty_day_activity_count > 0):
-                thirty_frequency = round(30 / thirty_day_activity_count, 2)
-            season_frequency = -1
-            if(seasonal_activity_count > 0):
-                season_frequency = round(self._days_ago(season_start, user_timezone) / seasonal_activity_count, 2)
-
-            # Update out the averages calculated
-            self._update_user_calculation(self.current_user_id, calculation["type_id"], total_frequency, thirty_frequency, season_frequency)
-     
-    def get_frequencies(self):
-                
-        if not self.ensure_valid_user():
-            return
-        
-        # Ensure we have the latest averages
-        self.compute_frequency_averages()
+        return self._get_strava_tokens(user_id)
+
+    def get_pool_stats(self):
+        stats = {"sync": self._get_pool_stats(), "async": self.async_db._get_pool_stats(), "strava_http": self._get_http_stats()}
+        if self.activity_index is not None:
+            stats["activity_index"] = self.activity_index.get_stats()
+        return stats
+
+    def close(self):
+        self._close_pool()
+        self._close_session()
+
+    def _user_clock(self, user_id):
+        # The user's time zone and day boundaries, resolved once per request
+        return self._clock_context(self._get_user_timezone(user_id))
+
+    def _average_updates(self, calculations, clock):
+
+        # Averages derived from the running counts, for the calculations whose stored values changed
+        updates = []
+        for calculation in calculations:
+            averages = self._frequency_averages(
+                calculation["total_count"],
+                calculation["first_time"],
+                calculation["thirty_count"],
+                calculation["season_count"],
+                clock
+            )
+            if averages != (calculation["total"], calculation["thirty"], calculation["season"]):
+                updates.append((calculation["type_id"],) + averages)
+        return updates
+
+    def _build_frequencies(self, frequency_rows, clock):
+
+        season = clock.season
 
         frequencies = []
-        activity_types = self._get_user_activity_types(self.current_user_id)
-        season = self._get_season(datetime.now(pytz.timezone(self._get_user_timezone(self.current_user_id) )))
-
-        for user_calculation in self._get_user_calculations(self.current_user_id):
-
-            type_id = user_calculation["id"]
-            total_frequency = user_calculation["total"]
-            thirty_frequency = user_calculation["thirty"]
-            season_frequency = user_calculation["season"]
-
-            # Find expected frequency
-            expected_average_frequency = 0
-            expected_frequency = 0
-
-            for activity_type in activity_types:
-                if activity_type["id"] == type_id:
-                    expected_frequency = activity_type[season]
-                    expected_average_frequency = (activity_type["winter"] + activity_type["spring"] + activity_type["summer"] + activity_type["fall"]) / 4
-                    break
-  
-            current_frequency = self.time_of_last_activity(type_id)
-            type_name = self._get_activity_type_name(type_id)
-            
+        for row in frequency_rows:
+
+            # Days since the last activity of this type
+            current_frequency = -1
+            if row["last_time"] is not None:
+                current_frequency = self._days_ago(row["last_time"], clock)
+
             frequency = {
-                "name": type_name,
+                "name": row["type"],
                 "current_frequency": current_frequency,
-                "expected_frequency": expected_frequency,
-                "expected_average_frequency": expected_average_frequency,
-                "thirty_day_average": thirty_frequency,
-                "season_average": season_frequency,
-                "running_average": total_frequency
+                "expected_frequency": row[season],
+                "expected_average_frequency": (row["winter"] + row["spring"] + row["summer"] + row["fall"]) / 4,
+                "thirty_day_average": row["thirty"],
+                "season_average": row["season"],
+                "running_average": row["total"]
             }
             frequencies.append(frequency)
                 
         return {"activities": frequencies}
 
-    def get_recommendations(self):
-        
-        if not self.ensure_valid_user():
-            return
-        
-        # Ensure we have the latest averages
-        self.compute_frequency_averages()
+    def _build_recommendations(self, frequencies):
 
         today = []
         tomorrow = []
 
-        frequencies = self.get_frequencies()
         for frequency in frequencies["activities"]:
             if frequency["current_frequency"] >= frequency["expected_frequency"] or frequency["current_frequency"] < 0:
                 today.append(frequency)
@@ -361,3 +690,221 @@ class FrequencyTracker(DatabaseHandler, StravaHandler, CalculationHandler):
             "today": today,
             "tomorrow": tomorrow
         }
+
+    def compute_frequency_averages(self, user_id, clock = None):
+                
+        if not self.ensure_valid_user(user_id):
+            return
+        
+        if clock is None:
+            clock = self._user_clock(user_id)
+
+        # The counts are maintained on every add and delete, so only rolled over windows need work here,
+        # recounted with the activity index when it holds the user, otherwise from the daily counts
+        calculations = self._get_user_calculations(user_id)
+        stale = self._stale_calculations(calculations, clock)
+        if stale:
+            rows = self._indexed_calculation_counts(stale, clock) if self.activity_index is not None else None
+            if rows is None or not self._store_calculation_counts(user_id, stale[0]["data_version"], rows):
+                self._refresh_user_calculations(user_id, clock.thirty_cutoff, clock.season_start)
+            calculations = self._get_user_calculations(user_id)
+
+        # Update out the averages that changed
+        self._update_user_calculations_bulk(user_id, self._average_updates(calculations, clock))
+     
+    def compute_frequency_averages_batch(self, user_ids = None, batch_size = 500):
+        """Recount and average every calculation of the given users, or everyone, from their raw activities.
+
+        For batch jobs such as repairs and backfills, the request paths keep counts up to date incrementally.
+        Returns how many calculations were stored.
+        """
+        if user_ids is not None:
+            user_ids = list(user_ids)
+            stored = 0
+            for start in range(0, len(user_ids), batch_size):
+                stored += self._rebuild_user_calculations_bulk(user_ids[start:start + batch_size], self._batch_calculation_rows)
+            return stored
+
+        stored = 0
+        batch = self._get_user_ids(0, batch_size)
+        while batch:
+            stored += self._rebuild_user_calculations_bulk(batch, self._batch_calculation_rows)
+            batch = self._get_user_ids(batch[-1], batch_size)
+        return stored
+
+    def backfill_daily_counts(self, user_ids = None, batch_size = 500):
+        """Recount activity_daily_counts from the activities, for the given users or everyone.
+
+        Each batch of users is recounted in one transaction and their calculations are rebuilt from the
+        new counts on their next read. Returns how many users were recounted.
+        """
+        if user_ids is not None:
+            user_ids = list(user_ids)
+            for start in range(0, len(user_ids), batch_size):
+                self._rebuild_daily_counts(user_ids[start:start + batch_size])
+            return len(user_ids)
+
+        recounted = 0
+        batch = self._get_user_ids(0, batch_size)
+        while batch:
+            self._rebuild_daily_counts(batch)
+            recounted += len(batch)
+            batch = self._get_user_ids(batch[-1], batch_size)
+        return recounted
+
+    def _batch_calculation_rows(self, calculations, activities):
+
+        # Window boundaries once per user, in epoch seconds
+        clocks = {user_id: self._clock_context(user_timezone) for user_id, _, user_timezone in calculations}
+        user_ids = np.array(sorted(clocks), dtype=np.int64)
+        epochs = np.array([
+            [clocks[user_id].local_midnight.timestamp(), clocks[user_id].thirty_cutoff.timestamp(), clocks[user_id].season_start.timestamp()]
+            for user_id in user_ids
+        ], dtype=np.float64).reshape(-1, 3)
+
+        # Every activity carries its user's boundaries, so one pass covers all users
+        activity_arrays = np.array(activities, dtype=np.float64).reshape(-1, 3)
+        activity_arrays = activity_arrays[np.isin(activity_arrays[:, 0], user_ids)]
+        activity_users = np.searchsorted(user_ids, activity_arrays[:, 0])
+        stats = self._frequency_stats(
+            activity_arrays[:, 1].astype(np.int64),
+            activity_arrays[:, 2],
+            epochs[activity_users, 0],
+            epochs[activity_users, 1],
+            epochs[activity_users, 2]
+        )
+        stats = {key: values.tolist() for key, values in stats.items()}
+        positions = {type_id: position for position, type_id in enumerate(stats["type_ids"])}
+
+        rows = []
+        for user_id, type_id, _ in calculations:
+            clock = clocks[user_id]
+            position = positions.get(type_id)
+            if position is None:
+                rows.append((user_id, type_id, 0, None, 0, 0, clock.thirty_cutoff, clock.season_start, -1, -1, -1))
+                continue
+            rows.append((
+                user_id,
+                type_id,
+                stats["total_count"][position],
+                datetime.fromtimestamp(stats["first_time"][position], timezone.utc),
+                stats["thirty_count"][position],
+                stats["season_count"][position],
+                clock.thirty_cutoff,
+                clock.season_start,
+                stats["total"][position],
+                stats["thirty"][position],
+                stats["season"][position]
+            ))
+        return rows
+
+    def get_frequencies(self, user_id):
+                
+        if not self.ensure_valid_user(user_id):
+            return
+        
+        # Ensure we have the latest averages
+        clock = self._user_clock(user_id)
+        self.compute_frequency_averages(user_id, clock)
+
+        return self._build_frequencies(self._frequency_rows(user_id), clock)
+
+    def get_recommendations(self, user_id):
+        
+        if not self.ensure_valid_user(user_id):
+            return
+        
+        # get_frequencies brings the averages up to date
+        return self._build_recommendations(self.get_frequencies(user_id))
+
+    # Async operations, served from the async database pool
+
+    async def add_activity_async(self, user_id, activity: Activity):
+
+        if not self.ensure_valid_user(user_id):
+            return
+
+        timestamp = self._parse_activity_time(activity.time)
+
+        activity_type_id = await self.async_db._get_activity_type_id(user_id, activity.type)
+        if activity_type_id == -1:
+            return
+
+        inserted, version = await self.async_db._add_activity(user_id, activity_type_id, timestamp)
+        self._index_activities(user_id, version, added=inserted)
+
+    async def get_activities_async(self, user_id):
+        return await self.async_db._get_activities(user_id)
+
+    async def compute_frequency_averages_async(self, user_id, clock):
+
+        if not self.ensure_valid_user(user_id):
+            return
+
+        calculations = await self.async_db._get_user_calculations(user_id)
+        stale = self._stale_calculations(calculations, clock)
+        if stale:
+            rows = self._indexed_calculation_counts(stale, clock) if self.activity_index is not None else None
+            if rows is None or not await self.async_db._store_calculation_counts(user_id, stale[0]["data_version"], rows):
+                await self.async_db._refresh_user_calculations(user_id, clock.thirty_cutoff, clock.season_start)
+            calculations = await self.async_db._get_user_calculations(user_id)
+
+        await self.async_db._update_user_calculations_bulk(user_id, self._average_updates(calculations, clock))
+
+    async def get_frequencies_async(self, user_id):
+
+        if not self.ensure_valid_user(user_id):
+            return
+
+        clock = self._clock_context(await self.async_db._get_user_timezone(user_id))
+        await self.compute_frequency_averages_async(user_id, clock)
+        return self._build_frequencies(await self._frequency_rows_async(user_id), clock)
+
+    async def get_recommendations_async(self, user_id):
+
+        if not self.ensure_valid_user(user_id):
+            return
+
+        return self._build_recommendations(await self.get_frequencies_async(user_id))
+
+    async def get_data_state_async(self, user_id):
+        """What the user's reads depend on: their data version and the local day, None without a user.
+
+        Every write bumps the version, and the averages and days since shift at local midnight.
+        """
+        if not self.ensure_valid_user(user_id):
+            return None
+
+        data_version = await self.async_db._get_data_version(user_id)
+        if data_version is None:
+            return None
+        local_date = self._clock_context(data_version["timezone"]).local_date
+        return {"version": data_version["version"], "local_day": local_date.isoformat()}
+
+    async def get_dashboard_async(self, user_id):
+        """The profile, frequencies, recommendations and activity types the main page shows, from one computation"""
+
+        if not self.ensure_valid_user(user_id):
+            return
+
+        profile = await self.async_db._get_user_profile(user_id)
+        if profile is None:
+            return
+
+        clock = self._clock_context(profile["timezone"])
+        await self.compute_frequency_averages_async(user_id, clock)
+        frequency_rows = await self._frequency_rows_async(user_id)
+        frequencies = self._build_frequencies(frequency_rows, clock)
+
+        # The frequency rows already carry every type and its seasonal goals
+        activity_types = [
+            {"id": row["type_id"], "type": row["type"], "winter": row["winter"], "spring": row["spring"], "summer": row["summer"], "fall": row["fall"]}
+            for row in sorted(frequency_rows, key=lambda row: row["type"])
+        ]
+
+        return {
+            "user": {"id": user_id, "name": profile["name"], "timezone": profile["timezone"]},
+            "frequencies": frequencies,
+            "recommendations": self._build_recommendations(frequencies),
+            "activity_types": activity_types
+        }
@@ -1,14 +1,19 @@
 # main.py
-from fastapi import FastAPI, HTTPException, Query, Request, Response
+from fastapi import FastAPI, HTTPException, Query, Request, Response, Cookie, Depends, BackgroundTasks, Header
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, RedirectResponse, FileResponse
+from fastapi.responses import JSONResponse, RedirectResponse, FileResponse, StreamingResponse
+from fastapi.encoders import jsonable_encoder
 from fastapi.staticfiles import StaticFiles
-from frequency_tracker import FrequencyTracker, Activity
+from frequency_tracker import FrequencyTracker, Activity, ActivityBatch, StravaEvent
+from sync_scheduler import StravaSyncScheduler
+from sync_jobs import SyncJobManager
+from response_cache import ResponseCache
 from typing import List
 import sqlite3
 from datetime import datetime, timezone, timedelta
 from email_validator import validate_email, EmailNotValidError
 import uvicorn
+import hmac
 import os
 
 app = FastAPI()
@@ -33,6 +38,66 @@ app.add_middleware(
 app.mount("/static", StaticFiles(directory="frequency-tracker-ui"), name="static")
 
 frequency_tracker = FrequencyTracker()
+sync_jobs = SyncJobManager(frequency_tracker)
+
+# Background Strava sync, off unless enabled here or run separately with `python sync_scheduler.py`
+sync_scheduler = None
+if os.environ.get("STRAVA_SYNC_SCHEDULER") == "1":
+    sync_scheduler = StravaSyncScheduler(frequency_tracker, sync_jobs=sync_jobs)
+
+# Serialized read responses, see cached_read
+response_cache = ResponseCache(int(float(os.environ.get("RESPONSE_CACHE_MEMORY_MB", 32)) * 1024 * 1024))
+
+def get_session_user_id(session: str = Cookie(None)):
+    # The session cookie holds the signed in user's id, resolved per request so workers share no state
+    if session is None:
+        return -1
+    try:
+        return int(session)
+    except ValueError:
+        return -1
+
+def etag_matches(request: Request, etag: str):
+    # If-None-Match compares weakly, and may list several tags or be *
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in tags or etag.removeprefix("W/") in tags
+
+async def cached_read(request: Request, user_id: int, endpoint: str, compute):
+    # Reads only change with the user's data version or local day, which key both the ETag and the cache
+    data_state = await frequency_tracker.get_data_state_async(user_id)
+    if data_state is None:
+        return await compute()
+
+    etag = f'W/"{user_id}-{data_state["version"]}-{data_state["local_day"]}"'
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+
+    key = (endpoint, user_id, data_state["version"], data_state["local_day"])
+    body = response_cache.get(key)
+    if body is None:
+        body = JSONResponse(jsonable_encoder(await compute())).body
+        response_cache.put(key, body)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+@app.on_event("startup")
+async def startup():
+    # The async pool has to be opened from inside the event loop
+    await frequency_tracker.async_db.open()
+    if sync_scheduler:
+        sync_scheduler.start()
+
+@app.on_event("shutdown")
+async def shutdown():
+    # Close every pooled database and Strava connection
+    if sync_scheduler:
+        sync_scheduler.stop()
+    sync_jobs.shutdown()
+    await frequency_tracker.async_db.close()
+    frequency_tracker.close()
 
 @app.get("/")
 def read_root():
@@ -46,37 +111,65 @@ if __name__ == "__main__":
 # ----------------------------- POST METHODS ----------------------------- 
 
 @app.post("/add_activity/")
-def add_activity(activity_type: str = Query(...), time: str = Query(None)):
+async def add_activity(activity_type: str = Query(...), time: str = Query(None), user_id: int = Depends(get_session_user_id)):
     try:
         activity_time = time if time else datetime.now(timezone.utc).isoformat()
-        return frequency_tracker.add_activity(Activity(type=activity_type, time=activity_time))
+        return await frequency_tracker.add_activity_async(user_id, Activity(type=activity_type, time=activity_time))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
     
-@app.post("/sync/")
-def sync_strava(since: str = Query(None)):
+@app.post("/activity_batch/")
+def apply_activity_batch(batch: ActivityBatch, user_id: int = Depends(get_session_user_id)):
+    # Many adds and deletes in one request and one transaction, see FrequencyTracker.apply_activity_batch
     try:
-        return frequency_tracker.sync_strava(since)
+        return frequency_tracker.apply_activity_batch(user_id, batch)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/import_activities/")
+async def import_activities(request: Request, user_id: int = Depends(get_session_user_id)):
+    # The body is a type,time CSV with a header row, streamed straight into COPY
+    return await frequency_tracker.import_csv_async(user_id, "activities", request.stream())
+
+@app.post("/import_activity_types/")
+async def import_activity_types(request: Request, user_id: int = Depends(get_session_user_id)):
+    # The body is a type,winter,spring,summer,fall CSV with a header row
+    return await frequency_tracker.import_csv_async(user_id, "activity_types", request.stream())
+
+@app.post("/sync/")
+def sync_strava(since: str = Query(None), user_id: int = Depends(get_session_user_id)):
+    # Starts the sync in the background, poll GET /sync/{job_id} for its progress
+    if not frequency_tracker.ensure_valid_user(user_id):
+        return {"success": False, "message": "No user is signed in"}
+    job = sync_jobs.submit(user_id, since)
+    message = "Strava sync already running" if job["coalesced"] else "Strava sync started"
+    return {**job, "success": True, "message": message}
+
+@app.get("/sync/{job_id}")
+def get_sync_job(job_id: str, user_id: int = Depends(get_session_user_id)):
+    job = sync_jobs.get(job_id)
+    if job is None or job["user_id"] != user_id:
+        raise HTTPException(status_code=404, detail="Sync job not found")
+    return job
+
 @app.post("/add_activity_type/")
 def add_activity_type(
     activity_type: str = Query(...),
     winter: int = Query(...),
     spring: int = Query(...),
     summer: int = Query(...),
-    fall: int = Query(...)
+    fall: int = Query(...),
+    user_id: int = Depends(get_session_user_id)
 ):
     try:
-        return frequency_tracker.add_activity_type(activity_type, winter, spring, summer, fall)
+        return frequency_tracker.add_activity_type(user_id, activity_type, winter, spring, summer, fall)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/update_timezone/")
-def update_timezone(timezone: str = Query(...)):
+def update_timezone(timezone: str = Query(...), user_id: int = Depends(get_session_user_id)):
     try:
-        return frequency_tracker.set_user_timezone(timezone)
+        return frequency_tracker.set_user_timezone(user_id, timezone)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
     
@@ -157,7 +250,6 @@ def check_auth(request: Request):
         if session_cookie:
             try:
                 user_id = int(session_cookie)
-                frequency_tracker.current_user_id = user_id
                 print(f"DEBUG: Restored session for user {user_id}")
                 return {"authenticated": True, "user_id": user_id}
             except ValueError:
@@ -171,57 +263,111 @@ def check_auth(request: Request):
         return {"authenticated": False}
 
 @app.get("/frequencies/")
-def get_frequencies():
-    return frequency_tracker.get_frequencies()
+async def get_frequencies(request: Request, user_id: int = Depends(get_session_user_id)):
+    return await cached_read(request, user_id, "frequencies", lambda: frequency_tracker.get_frequencies_async(user_id))
 
 @app.get("/activity_types/")
-def get_activity_types():
-    return frequency_tracker.get_activity_types()
+def get_activity_types(user_id: int = Depends(get_session_user_id)):
+    return frequency_tracker.get_activity_types(user_id)
 
 @app.get("/user_timezone/")
-def get_user_timezone():
+def get_user_timezone(user_id: int = Depends(get_session_user_id)):
     try:
-        return frequency_tracker.get_user_timezone()
+        return frequency_tracker.get_user_timezone(user_id)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/user_name/")
-def get_user_name():
-    return frequency_tracker.get_user_name()
+def get_user_name(user_id: int = Depends(get_session_user_id)):
+    return frequency_tracker.get_user_name(user_id)
 
 @app.get("/user_id/")
-def get_user_id():
-    return frequency_tracker.current_user_id
+def get_user_id(user_id: int = Depends(get_session_user_id)):
+    return user_id
+
+def require_stats_token(authorization: str = Header(None)):
+    # Operator endpoints want "Authorization: Bearer $STATS_TOKEN", and are closed while it is unset
+    stats_token = os.environ.get("STATS_TOKEN")
+    if not stats_token or not hmac.compare_digest(authorization or "", f"Bearer {stats_token}"):
+        raise HTTPException(status_code=403, detail="Invalid stats token")
+
+@app.get("/pool_stats/", dependencies=[Depends(require_stats_token)])
+def get_pool_stats():
+    return {**frequency_tracker.get_pool_stats(), "response_cache": response_cache.get_stats()}
 
 @app.get("/recommendations/")
-def get_recommendations():
-    return frequency_tracker.get_recommendations()
+async def get_recommendations(request: Request, user_id: int = Depends(get_session_user_id)):
+    return await cached_read(request, user_id, "recommendations", lambda: frequency_tracker.get_recommendations_async(user_id))
+
+@app.get("/dashboard/")
+async def get_dashboard(request: Request, user_id: int = Depends(get_session_user_id)):
+    # Everything /frequencies/, /recommendations/, /activity_types/, /user_name/ and /user_timezone/ return, in one go
+    try:
+        return await cached_read(request, user_id, "dashboard", lambda: frequency_tracker.get_dashboard_async(user_id))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/activity_table/")
-def get_activity_table():
+async def get_activity_table(
+    request: Request,
+    limit: int = Query(None, ge=1, le=1000),
+    cursor: str = Query(None),
+    activity_type: str = Query(None),
+    since: str = Query(None),
+    until: str = Query(None),
+    format: str = Query("json", pattern="^(json|ndjson)$"),
+    user_id: int = Depends(get_session_user_id)
+):
+    # Without paging or filters this is the whole history as one list, as it always was
     try:
-        return frequency_tracker.get_activities()
+        if format == "ndjson":
+            # The whole matching history streamed a line per activity, for exports
+            if not frequency_tracker.ensure_valid_user(user_id):
+                return None
+            return StreamingResponse(frequency_tracker.stream_activities_async(user_id, activity_type, since, until), media_type="application/x-ndjson")
+        if limit is None and not (cursor or activity_type or since or until):
+            return await cached_read(request, user_id, "activity_table", lambda: frequency_tracker.get_activities_async(user_id))
+        # A bad cursor or time is a 400 even when the client's ETag would match
+        frequency_tracker._activity_filters(activity_type, since, until, cursor)
+        return await cached_read(request, user_id, f"activity_table?{request.url.query}",
+                                 lambda: frequency_tracker.get_activities_page_async(user_id, limit or 100, cursor, activity_type, since, until))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+def csv_download(user_id: int, kind: str):
+    if not frequency_tracker.ensure_valid_user(user_id):
+        return None
+    headers = {"Content-Disposition": f'attachment; filename="{kind}.csv"'}
+    return StreamingResponse(frequency_tracker.export_csv_async(user_id, kind), media_type="text/csv", headers=headers)
+
+@app.get("/export_activities/")
+def export_activities(user_id: int = Depends(get_session_user_id)):
+    return csv_download(user_id, "activities")
+
+@app.get("/export_activity_types/")
+def export_activity_types(user_id: int = Depends(get_session_user_id)):
+    return csv_download(user_id, "activity_types")
+
 @app.delete("/delete_activity/")
-def delete_activity(activity_type: str = Query(...), time: str = Query(...)):
+def delete_activity(activity_type: str = Query(...), time: str = Query(...), user_id: int = Depends(get_session_user_id)):
     try:
-        return frequency_tracker.delete_activity(activity_type, time)
+        return frequency_tracker.delete_activity(user_id, Activity(type=activity_type, time=time))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.delete("/delete_activity_type/")
-def delete_activity_type(activity_type: str = Query(...)):
+def delete_activity_type(activity_type: str = Query(...), user_id: int = Depends(get_session_user_id)):
     try:
-        return frequency_tracker.delete_activity_type(activity_type)
+        return frequency_tracker.delete_activity_type(user_id, activity_type)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.delete("/delete_user")
-def delete_user(response: Response = None):
+def delete_user(response: Response = None, user_id: int = Depends(get_session_user_id)):
     try:
-        result = frequency_tracker.delete_user()
+        result = frequency_tracker.delete_user(user_id)
         if result["success"]:
             # Clear the cookie
             response.delete_cookie(key="session")
@@ -231,8 +377,7 @@ def delete_user(response: Response = None):
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/strava/authorize")
-async def strava_authorize(request: Request):
-    user_id = frequency_tracker.current_user_id
+async def strava_authorize(request: Request, user_id: int = Depends(get_session_user_id)):
     if user_id == -1:
         return JSONResponse(status_code=401, content={"message": "Not authenticated"})
     
@@ -274,13 +419,50 @@ async def strava_callback(request: Request, code: str = None, state: str = None,
     # Redirect user back to the main page with a success message
     return RedirectResponse(url="http://127.0.0.1:8000/?strava_link_success=true")
 
+@app.get("/strava/webhook")
+def validate_strava_webhook(
+    mode: str = Query(None, alias="hub.mode"),
+    verify_token: str = Query(None, alias="hub.verify_token"),
+    challenge: str = Query(None, alias="hub.challenge")
+):
+    # Strava calls this once when the push subscription is created
+    result = frequency_tracker.validate_strava_webhook(mode, verify_token, challenge)
+    if result is None:
+        raise HTTPException(status_code=403, detail="Invalid verify token")
+    return result
+
+def handle_strava_event(event: StravaEvent):
+    # Runs after the response is sent, so the outcome only shows up here
+    try:
+        result = frequency_tracker.handle_strava_event(event)
+    except Exception as e:
+        result = {"success": False, "message": f"Error handling Strava event: {str(e)}"}
+    print(f"Strava {event.object_type} {event.aspect_type} event for {event.object_id}: {result}")
+
+@app.post("/strava/webhook")
+def receive_strava_event(event: StravaEvent, background_tasks: BackgroundTasks):
+    # Events from anything but our own subscription are refused, see STRAVA_WEBHOOK_SUBSCRIPTION_ID
+    if not frequency_tracker.accepts_strava_event(event):
+        raise HTTPException(status_code=403, detail="Unknown webhook subscription")
+
+    # Strava wants a 200 within two seconds, so the activity is fetched after responding
+    background_tasks.add_task(handle_strava_event, event)
+    return {"success": True}
+
 #http://127.0.0.1:8000/
 #uvicorn main:app --reload  
 #npx tailwindcss -i ./input.css -o ./output.css --watch
 
 # curl -X POST "http://127.0.0.1:8000/activity/?activity_type=Chess"
 # curl -X POST "http://127.0.0.1:8000/sync/"
+# curl -X POST "http://127.0.0.1:8000/activity_batch/" -H "Content-Type: application/json" -d '{"add": [{"type": "Chess", "time": "2025-02-24T20:16:13Z"}]}'
 # curl -X GET "http://127.0.0.1:8000/frequencies/"
 # curl -X GET "http://127.0.0.1:8000/recommendations/"
+# curl -X GET "http://127.0.0.1:8000/dashboard/"
+# curl -X GET "http://127.0.0.1:8000/pool_stats/" -H "Authorization: Bearer $STATS_TOKEN"
+# curl -X GET "http://127.0.0.1:8000/activity_table/?limit=100&activity_type=Run"
+# curl -X GET "http://127.0.0.1:8000/activity_table/?format=ndjson" > activities.ndjson
+# curl -X GET "http://127.0.0.1:8000/export_activities/" > activities.csv
+# curl -X POST "http://127.0.0.1:8000/import_activities/" -H "Content-Type: text/csv" --data-binary @activities.csv
 # curl -X DELETE http://127.0.0.1:8000/activity/424
 
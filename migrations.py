@@ -0,0 +1,139 @@
+# Versioned schema migrations, applied in order by DatabaseHandler._apply_migrations
+# Never edit a migration that has shipped, add a new one with the next version instead
+
+MIGRATIONS = [
+    {
+        "version": 1,
+        "description": "Create users, activity_types, activities and user_calculations",
+        "sql": """
+            CREATE TABLE IF NOT EXISTS users (
+                id INTEGER GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+                email TEXT UNIQUE NOT NULL,
+                password TEXT NOT NULL,
+                name TEXT,
+                timezone TEXT,
+                strava_athlete_id INTEGER,
+                strava_access_token TEXT,
+                strava_refresh_token TEXT,
+                strava_token_expires_at INTEGER
+            );
+
+            CREATE TABLE IF NOT EXISTS activity_types (
+                id INTEGER GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+                user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
+                type TEXT NOT NULL,
+                winter INTEGER NOT NULL,
+                summer INTEGER NOT NULL,
+                spring INTEGER NOT NULL,
+                fall INTEGER NOT NULL,
+                UNIQUE(user_id, type)
+            );
+
+            CREATE TABLE IF NOT EXISTS activities (
+                id INTEGER GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+                user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
+                type_id INTEGER REFERENCES activity_types(id) ON DELETE CASCADE,
+                time TIMESTAMP WITH TIME ZONE NOT NULL,
+                UNIQUE(user_id, type_id, time)
+            );
+
+            CREATE TABLE IF NOT EXISTS user_calculations (
+                id INTEGER GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+                user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
+                type_id INTEGER REFERENCES activity_types(id) ON DELETE CASCADE,
+                total FLOAT,
+                thirty FLOAT,
+                season FLOAT,
+                valid BOOLEAN DEFAULT FALSE,
+                UNIQUE(user_id, type_id)
+            );
+        """
+    },
+    {
+        "version": 2,
+        "description": "Running aggregates on user_calculations",
+        "sql": """
+            ALTER TABLE user_calculations
+                ADD COLUMN IF NOT EXISTS first_time TIMESTAMP WITH TIME ZONE,
+                ADD COLUMN IF NOT EXISTS total_count INTEGER NOT NULL DEFAULT 0,
+                ADD COLUMN IF NOT EXISTS thirty_count INTEGER NOT NULL DEFAULT 0,
+                ADD COLUMN IF NOT EXISTS season_count INTEGER NOT NULL DEFAULT 0,
+                ADD COLUMN IF NOT EXISTS thirty_cutoff TIMESTAMP WITH TIME ZONE,
+                ADD COLUMN IF NOT EXISTS season_start TIMESTAMP WITH TIME ZONE;
+        """
+    },
+    {
+        "version": 3,
+        "description": "Indexes for the activity table and stale calculation lookups",
+        "sql": """
+            -- Per type last/first activity lookups are served by the UNIQUE(user_id, type_id, time) index
+            CREATE INDEX IF NOT EXISTS activities_user_id_time_idx ON activities (user_id, time);
+
+            -- Calculations that need a rebuild, see DatabaseHandler._refresh_user_calculations
+            CREATE INDEX IF NOT EXISTS user_calculations_stale_idx ON user_calculations (user_id)
+                WHERE valid = FALSE OR thirty_cutoff IS NULL;
+        """
+    },
+    {
+        "version": 4,
+        "description": "Strava sync watermark on users",
+        "sql": """
+            -- Epoch seconds, like strava_token_expires_at
+            ALTER TABLE users
+                ADD COLUMN IF NOT EXISTS strava_sync_watermark INTEGER,
+                ADD COLUMN IF NOT EXISTS strava_last_synced_at INTEGER;
+        """
+    },
+    {
+        "version": 5,
+        "description": "Strava activity ids for webhook updates and deletes",
+        "sql": """
+            -- Strava activity ids outgrow INTEGER
+            ALTER TABLE activities ADD COLUMN IF NOT EXISTS strava_id BIGINT;
+            CREATE UNIQUE INDEX IF NOT EXISTS activities_user_id_strava_id_idx ON activities (user_id, strava_id)
+                WHERE strava_id IS NOT NULL;
+
+            -- Webhook events only carry the athlete id
+            CREATE INDEX IF NOT EXISTS users_strava_athlete_id_idx ON users (strava_athlete_id);
+        """
+    },
+    {
+        "version": 6,
+        "description": "Daily activity counts per user and type",
+        "sql": """
+            -- Activities per day in the user's time zone, kept in step by every activity write
+            CREATE TABLE IF NOT EXISTS activity_daily_counts (
+                user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
+                type_id INTEGER REFERENCES activity_types(id) ON DELETE CASCADE,
+                local_day DATE NOT NULL,
+                count INTEGER NOT NULL,
+                PRIMARY KEY (user_id, type_id, local_day)
+            );
+
+            -- Existing activities, python cli.py backfill-daily-counts recounts them later if needed
+            INSERT INTO activity_daily_counts (user_id, type_id, local_day, count)
+            SELECT a.user_id, a.type_id, (a.time AT TIME ZONE COALESCE(u.timezone, 'UTC'))::date, COUNT(*)
+            FROM activities a
+            JOIN users u ON u.id = a.user_id
+            GROUP BY 1, 2, 3
+            ON CONFLICT DO NOTHING;
+        """
+    },
+    {
+        "version": 7,
+        "description": "Per user data version for conditional reads",
+        "sql": """
+            -- Bumped with every change to a user's activities, types or time zone
+            ALTER TABLE users ADD COLUMN IF NOT EXISTS data_version BIGINT NOT NULL DEFAULT 0;
+        """
+    },
+    {
+        "version": 8,
+        "description": "Keyset pagination index for the activity table",
+        "sql": """
+            -- Pages are read in (time, id) order, this covers the old (user_id, time) index too
+            CREATE INDEX IF NOT EXISTS activities_user_id_time_id_idx ON activities (user_id, time, id);
+            DROP INDEX IF EXISTS activities_user_id_time_idx;
+        """
+    }
+]
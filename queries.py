@@ -0,0 +1,429 @@
+# SQL shared by DatabaseHandler and AsyncDatabaseHandler
+# Both drivers use the same %s paramstyle, so only the plumbing around these statements differs.
+# Statements over a list of rows take the VALUES placeholder to use: "%s" for psycopg2's
+# execute_values, or one explicit template per row (see values_placeholder) for psycopg 3.
+
+ACTIVITY_ROW_TEMPLATE = "(%s::integer, %s::integer, %s::timestamptz)"
+AVERAGES_ROW_TEMPLATE = "(%s::integer, %s::integer, %s::float, %s::float, %s::float)"
+COUNTS_ROW_TEMPLATE = "(%s::integer, %s::integer, %s::integer, %s::timestamptz, %s::integer, %s::integer, %s::timestamptz, %s::timestamptz)"
+
+def values_placeholder(template, count):
+    return ", ".join([template] * count)
+
+def activity_params(user_id, rows):
+    # Flatten (type_id, time) rows into parameters for ACTIVITY_ROW_TEMPLATE
+    return [(user_id, type_id, time) for type_id, time in rows]
+
+# User table
+
+SELECT_USER_TIMEZONE = """
+    SELECT timezone FROM users WHERE id = %s
+"""
+
+SELECT_USER_PROFILE = """
+    SELECT name, timezone FROM users WHERE id = %s
+"""
+
+SELECT_DATA_VERSION = """
+    SELECT data_version, timezone FROM users WHERE id = %s
+"""
+
+# Run in the same transaction as the write it covers, so a reader never sees the new version without the data
+BUMP_DATA_VERSION = """
+    UPDATE users SET data_version = data_version + 1 WHERE id = %s RETURNING data_version
+"""
+
+BUMP_DATA_VERSIONS = """
+    UPDATE users SET data_version = data_version + 1 WHERE id = ANY(%s)
+"""
+
+# Activity types table
+
+SELECT_ACTIVITY_TYPE_ID = """
+    SELECT id FROM activity_types WHERE user_id = %s AND type = %s
+"""
+
+# Activity table
+
+SELECT_ACTIVITIES = """
+    SELECT a.id, a.user_id, at.type, a.time
+    FROM activities a
+    JOIN activity_types at ON a.type_id = at.id
+    WHERE a.user_id = %s
+    ORDER BY a.time ASC
+"""
+
+def activity_row(row):
+    return {
+        "id": row[0],
+        "user_id": row[1],
+        "type": row[2],
+        "time": row[3]
+    }
+
+def select_activities_page(filters, limit = True):
+    """Activities in (time, id) order for keyset pagination, matching the filters that are set.
+
+    filters may hold activity_type, since (inclusive), until (exclusive) and after_time with after_id,
+    the last row of the previous page. Without limit every match is selected, for streaming.
+    """
+    conditions = ["a.user_id = %(user_id)s"]
+    if filters.get("activity_type") is not None:
+        conditions.append("at.type = %(activity_type)s")
+    if filters.get("since") is not None:
+        conditions.append("a.time >= %(since)s")
+    if filters.get("until") is not None:
+        conditions.append("a.time < %(until)s")
+    if filters.get("after_time") is not None:
+        conditions.append("(a.time, a.id) > (%(after_time)s, %(after_id)s)")
+    return f"""
+        SELECT a.id, a.user_id, at.type, a.time
+        FROM activities a
+        JOIN activity_types at ON a.type_id = at.id
+        WHERE {" AND ".join(conditions)}
+        ORDER BY a.time, a.id
+        {"LIMIT %(limit)s" if limit else ""}
+    """
+
+# All of a user's activity times as exact epoch microseconds, for ActivityIndex. One statement,
+# so the data version is the one the times were read at. A user without activities gets one NULL row
+SELECT_USER_ACTIVITY_EPOCHS = """
+    SELECT u.data_version, a.type_id, (EXTRACT(EPOCH FROM a.time) * 1000000)::bigint
+    FROM users u LEFT JOIN activities a ON a.user_id = u.id
+    WHERE u.id = %s
+    ORDER BY a.type_id, a.time
+"""
+
+def activity_epochs(rows):
+    # (data_version, {type_id: sorted epochs}) from SELECT_USER_ACTIVITY_EPOCHS rows
+    epochs_by_type = {}
+    for _, type_id, epoch_us in rows:
+        if type_id is not None:
+            epochs_by_type.setdefault(type_id, []).append(epoch_us)
+    return (rows[0][0] if rows else None), epochs_by_type
+
+def insert_activities(values):
+    # Returns the (type_id, time) of the rows that were new
+    return f"""
+        INSERT INTO activities (user_id, type_id, time)
+        VALUES {values}
+        ON CONFLICT (user_id, type_id, time) DO NOTHING
+        RETURNING type_id, time
+    """
+
+def delete_activities(values):
+    # Returns the (type_id, time) of the rows that existed
+    return f"""
+        DELETE FROM activities a
+        USING (VALUES {values}) AS v(user_id, type_id, time)
+        WHERE a.user_id = v.user_id AND a.type_id = v.type_id AND a.time = v.time
+        RETURNING a.type_id, a.time
+    """
+
+# Daily rollup table
+
+def local_day(time, user_timezone):
+    # The day a time falls on in the user's time zone, how activity_daily_counts buckets activities
+    return f"({time} AT TIME ZONE COALESCE({user_timezone}, 'UTC'))::date"
+
+def daily_count_deltas(sign, values, source = None):
+    # Add inserted (sign 1) or deleted (sign -1) activity rows to their local day's count,
+    # the rows come from VALUES or from a source query of (user_id, type_id, time)
+    return f"""
+        INSERT INTO activity_daily_counts AS dc (user_id, type_id, local_day, count)
+        SELECT v.user_id, v.type_id, {local_day("v.time", "u.timezone")}, {sign} * COUNT(*)
+        FROM {source or f"(VALUES {values})"} AS v(user_id, type_id, time)
+        JOIN users u ON u.id = v.user_id
+        GROUP BY 1, 2, 3
+        ORDER BY 1, 2, 3
+        ON CONFLICT (user_id, type_id, local_day) DO UPDATE SET count = dc.count + EXCLUDED.count
+    """
+
+DELETE_EMPTY_DAILY_COUNTS = """
+    DELETE FROM activity_daily_counts WHERE user_id = %s AND count <= 0
+"""
+
+# Recount users' days from their activities, e.g. after a time zone change. Adds that commit
+# meanwhile land on top of the recount, so callers lock the users rows first (see
+# DatabaseHandler._rebuild_daily_counts)
+REBUILD_DAILY_COUNTS = f"""
+    DELETE FROM activity_daily_counts WHERE user_id = ANY(%(user_ids)s);
+    INSERT INTO activity_daily_counts AS dc (user_id, type_id, local_day, count)
+    SELECT a.user_id, a.type_id, {local_day("a.time", "u.timezone")}, COUNT(*)
+    FROM activities a
+    JOIN users u ON u.id = a.user_id
+    WHERE a.user_id = ANY(%(user_ids)s)
+    GROUP BY 1, 2, 3
+    ON CONFLICT (user_id, type_id, local_day) DO UPDATE SET count = dc.count + EXCLUDED.count;
+"""
+
+def window_day_end(time, user_timezone):
+    # The local midnight ending the day a time falls on, as a timestamptz
+    return f"(({local_day(time, user_timezone)} + 1)::timestamp AT TIME ZONE COALESCE({user_timezone}, 'UTC'))"
+
+# The local days the window boundaries fall on, and where those days end
+WINDOW_DAYS = f"""
+    SELECT {local_day("%(thirty_cutoff)s::timestamptz", "timezone")} AS thirty_day,
+           {window_day_end("%(thirty_cutoff)s::timestamptz", "timezone")} AS thirty_day_end,
+           {local_day("%(season_start)s::timestamptz", "timezone")} AS season_day,
+           {window_day_end("%(season_start)s::timestamptz", "timezone")} AS season_day_end
+    FROM users WHERE id = %(user_id)s
+"""
+
+def window_count(window, boundary, calculation):
+    # Activities strictly after a window boundary: the daily counts of the days after its day,
+    # plus the raw activities on its day that come after it, so boundaries needn't be midnights
+    return f"""(
+        COALESCE((SELECT SUM(d.count) FROM activity_daily_counts d
+                  WHERE d.user_id = {calculation}.user_id AND d.type_id = {calculation}.type_id AND d.local_day > w.{window}_day), 0)
+        + (SELECT COUNT(*) FROM activities a
+           WHERE a.user_id = {calculation}.user_id AND a.type_id = {calculation}.type_id
+             AND a.time > {boundary} AND a.time < w.{window}_day_end)
+    )"""
+
+# User calculations table
+
+SELECT_USER_CALCULATIONS = """
+    SELECT id, user_id, type_id, total, thirty, season, valid,
+           first_time, total_count, thirty_count, season_count,
+           thirty_cutoff, season_start,
+           (SELECT data_version FROM users WHERE id = user_calculations.user_id)
+    FROM user_calculations WHERE user_id = %s
+"""
+
+def calculation_row(row):
+    return {
+        "id": row[0],
+        "user_id": row[1],
+        "type_id": row[2],
+        "total": row[3],
+        "thirty": row[4],
+        "season": row[5],
+        "valid": row[6],
+        "first_time": row[7],
+        "total_count": row[8],
+        "thirty_count": row[9],
+        "season_count": row[10],
+        "thirty_cutoff": row[11],
+        "season_start": row[12],
+        "data_version": row[13]
+    }
+
+def calculation_deltas(sign, values, source = None):
+    # Fold inserted (sign 1) or deleted (sign -1) activity rows into the running aggregates,
+    # the rows come from VALUES or from a source query of (user_id, type_id, time)
+    if sign > 0:
+        first_time = "LEAST(uc.first_time, d.first_time)"
+    else:
+        # Only look up the new first activity when the old one was deleted
+        first_time = """CASE WHEN d.first_time <= uc.first_time
+                THEN (SELECT MIN(a.time) FROM activities a WHERE a.user_id = uc.user_id AND a.type_id = uc.type_id)
+                ELSE uc.first_time END"""
+    return f"""
+        UPDATE user_calculations uc
+        SET total_count = uc.total_count + {sign} * d.total_count,
+            thirty_count = uc.thirty_count + {sign} * d.thirty_count,
+            season_count = uc.season_count + {sign} * d.season_count,
+            first_time = {first_time}
+        FROM (
+            SELECT v.user_id, v.type_id,
+                   COUNT(*) AS total_count,
+                   MIN(v.time) AS first_time,
+                   COUNT(*) FILTER (WHERE v.time > c.thirty_cutoff) AS thirty_count,
+                   COUNT(*) FILTER (WHERE v.time > c.season_start) AS season_count
+            FROM {source or f"(VALUES {values})"} AS v(user_id, type_id, time)
+            JOIN user_calculations c ON c.user_id = v.user_id AND c.type_id = v.type_id
+            GROUP BY v.user_id, v.type_id
+        ) d
+        WHERE uc.user_id = d.user_id AND uc.type_id = d.type_id
+    """
+
+# Rows that were invalidated, or never counted, are rebuilt from the daily counts
+REBUILD_USER_CALCULATIONS = f"""
+    WITH window_days AS ({WINDOW_DAYS})
+    UPDATE user_calculations uc
+    SET total_count = COALESCE((SELECT SUM(d.count) FROM activity_daily_counts d
+                                WHERE d.user_id = uc.user_id AND d.type_id = uc.type_id), 0),
+        first_time = (SELECT MIN(a.time) FROM activities a WHERE a.user_id = uc.user_id AND a.type_id = uc.type_id),
+        thirty_count = {window_count("thirty", "%(thirty_cutoff)s", "uc")},
+        season_count = {window_count("season", "%(season_start)s", "uc")},
+        thirty_cutoff = %(thirty_cutoff)s,
+        season_start = %(season_start)s,
+        valid = TRUE
+    FROM window_days w
+    WHERE uc.user_id = %(user_id)s AND (uc.valid = FALSE OR uc.thirty_cutoff IS NULL)
+"""
+
+# Windows that rolled over since they were counted only need their own days summed
+ROLL_USER_CALCULATION_WINDOWS = f"""
+    WITH window_days AS ({WINDOW_DAYS})
+    UPDATE user_calculations uc
+    SET thirty_count = {window_count("thirty", "%(thirty_cutoff)s", "uc")},
+        season_count = {window_count("season", "%(season_start)s", "uc")},
+        thirty_cutoff = %(thirty_cutoff)s,
+        season_start = %(season_start)s
+    FROM window_days w
+    WHERE uc.user_id = %(user_id)s
+      AND (uc.thirty_cutoff IS DISTINCT FROM %(thirty_cutoff)s OR uc.season_start IS DISTINCT FROM %(season_start)s)
+"""
+
+# Taken before storing counts, in the order writes lock calculations and then the users row
+LOCK_USER_CALCULATIONS = """
+    SELECT id FROM user_calculations WHERE user_id = %s ORDER BY id FOR UPDATE
+"""
+
+def update_calculation_counts(values):
+    # Rows are (user_id, type_id, total_count, first_time, thirty_count, season_count, thirty_cutoff, season_start)
+    return f"""
+        UPDATE user_calculations uc
+        SET total_count = v.total_count, first_time = v.first_time,
+            thirty_count = v.thirty_count, season_count = v.season_count,
+            thirty_cutoff = v.thirty_cutoff, season_start = v.season_start, valid = TRUE
+        FROM (VALUES {values}) AS v(user_id, type_id, total_count, first_time, thirty_count, season_count, thirty_cutoff, season_start)
+        WHERE uc.user_id = v.user_id AND uc.type_id = v.type_id
+    """
+
+def update_calculation_averages(values):
+    # Rows are (user_id, type_id, total, thirty, season), all marked valid
+    return f"""
+        UPDATE user_calculations uc
+        SET total = v.total, thirty = v.thirty, season = v.season, valid = TRUE
+        FROM (VALUES {values}) AS v(user_id, type_id, total, thirty, season)
+        WHERE uc.user_id = v.user_id AND uc.type_id = v.type_id
+    """
+
+def select_frequency_rows(with_last_time = True):
+    # Each type's name, seasonal targets, stored averages, optionally last activity time, and the user's data version
+    last_time = "(SELECT MAX(a.time) FROM activities a WHERE a.user_id = at.user_id AND a.type_id = at.id)"
+    return f"""
+        SELECT at.id, at.type, at.winter, at.spring, at.summer, at.fall,
+               uc.total, uc.thirty, uc.season,
+               {last_time if with_last_time else "NULL"},
+               u.data_version
+        FROM activity_types at
+        JOIN user_calculations uc ON uc.user_id = at.user_id AND uc.type_id = at.id
+        JOIN users u ON u.id = at.user_id
+        WHERE at.user_id = %s
+        ORDER BY uc.id
+    """
+
+SELECT_FREQUENCY_ROWS = select_frequency_rows()
+SELECT_FREQUENCY_ROWS_WITHOUT_LAST_TIME = select_frequency_rows(with_last_time=False)
+
+def frequency_row(row):
+    return {
+        "type_id": row[0],
+        "type": row[1],
+        "winter": row[2],
+        "spring": row[3],
+        "summer": row[4],
+        "fall": row[5],
+        "total": row[6],
+        "thirty": row[7],
+        "season": row[8],
+        "last_time": row[9],
+        "data_version": row[10]
+    }
+
+# CSV import and export, through COPY. Times are read and written in UTC
+
+SET_UTC = """
+    SET LOCAL TIME ZONE 'UTC'
+"""
+
+def copy_activities_out(user_id):
+    # COPY takes no bind parameters, user_id is inlined as an int
+    return f"""
+        COPY (
+            SELECT at.type, a.time
+            FROM activities a
+            JOIN activity_types at ON at.id = a.type_id
+            WHERE a.user_id = {int(user_id)}
+            ORDER BY a.time, a.id
+        ) TO STDOUT WITH (FORMAT csv, HEADER true)
+    """
+
+def copy_activity_types_out(user_id):
+    return f"""
+        COPY (
+            SELECT type, winter, spring, summer, fall
+            FROM activity_types
+            WHERE user_id = {int(user_id)}
+            ORDER BY type
+        ) TO STDOUT WITH (FORMAT csv, HEADER true)
+    """
+
+# Activities are staged as (type, time) rows, then merged in by type name
+
+CREATE_ACTIVITY_STAGING = """
+    CREATE TEMP TABLE activity_staging (type TEXT, time TIMESTAMPTZ) ON COMMIT DROP
+"""
+
+COPY_ACTIVITIES_IN = """
+    COPY activity_staging (type, time) FROM STDIN WITH (FORMAT csv, HEADER true)
+"""
+
+CREATE_ACTIVITY_STAGING_INSERTED = """
+    CREATE TEMP TABLE activity_staging_inserted (user_id INTEGER, type_id INTEGER, time TIMESTAMPTZ) ON COMMIT DROP
+"""
+
+# Rows of untracked types or without a time are left out, like duplicates of stored activities
+MERGE_ACTIVITY_STAGING = """
+    WITH inserted AS (
+        INSERT INTO activities (user_id, type_id, time)
+        SELECT %(user_id)s, at.id, s.time
+        FROM activity_staging s
+        JOIN activity_types at ON at.user_id = %(user_id)s AND at.type = s.type
+        WHERE s.time IS NOT NULL
+        ON CONFLICT (user_id, type_id, time) DO NOTHING
+        RETURNING user_id, type_id, time
+    )
+    INSERT INTO activity_staging_inserted SELECT user_id, type_id, time FROM inserted
+"""
+
+ACTIVITY_STAGING_INSERTED = "(SELECT user_id, type_id, time FROM activity_staging_inserted)"
+
+ACTIVITY_IMPORT_SUMMARY = """
+    SELECT (SELECT COUNT(*) FROM activity_staging),
+           (SELECT COUNT(*) FROM activity_staging_inserted),
+           (SELECT COUNT(*) FROM activity_staging s
+            WHERE NOT EXISTS (SELECT 1 FROM activity_types at WHERE at.user_id = %(user_id)s AND at.type = s.type))
+"""
+
+def activity_import_summary(row):
+    return {
+        "rows": row[0],
+        "imported": row[1],
+        "unknown_type": row[2],
+        "skipped": row[0] - row[1] - row[2]
+    }
+
+# Activity types are staged as (type, winter, spring, summer, fall) rows, existing types get the new goals
+
+CREATE_ACTIVITY_TYPE_STAGING = """
+    CREATE TEMP TABLE activity_type_staging (type TEXT, winter INTEGER, spring INTEGER, summer INTEGER, fall INTEGER) ON COMMIT DROP
+"""
+
+COPY_ACTIVITY_TYPES_IN = """
+    COPY activity_type_staging (type, winter, spring, summer, fall) FROM STDIN WITH (FORMAT csv, HEADER true)
+"""
+
+# New types get their calculation row like FrequencyTracker.add_activity_type gives them one.
+# Returns how many types were (created, updated)
+MERGE_ACTIVITY_TYPE_STAGING = """
+    WITH merged AS (
+        INSERT INTO activity_types (user_id, type, winter, spring, summer, fall)
+        SELECT DISTINCT ON (type) %(user_id)s, type, winter, spring, summer, fall
+        FROM activity_type_staging
+        WHERE type IS NOT NULL AND winter IS NOT NULL AND spring IS NOT NULL AND summer IS NOT NULL AND fall IS NOT NULL
+        ORDER BY type
+        ON CONFLICT (user_id, type) DO UPDATE
+        SET winter = EXCLUDED.winter, spring = EXCLUDED.spring, summer = EXCLUDED.summer, fall = EXCLUDED.fall
+        RETURNING id, (xmax = 0) AS created
+    ), calculations AS (
+        INSERT INTO user_calculations (user_id, type_id, total, thirty, season, valid)
+        SELECT %(user_id)s, id, 0, 0, 0, TRUE FROM merged WHERE created
+        ON CONFLICT (user_id, type_id) DO NOTHING
+    )
+    SELECT COUNT(*) FILTER (WHERE created), COUNT(*) FILTER (WHERE NOT created) FROM merged
+"""
@@ -0,0 +1,54 @@
+# response_cache.py
+# Serialized read responses kept per user, see cached_read in main.py
+import threading
+from collections import OrderedDict
+
+# Rough per entry cost of the key tuple, the dict slot and the bytes object
+ENTRY_OVERHEAD = 200
+
+
+class ResponseCache:
+    """Response bodies by key, the least recently used evicted once memory_budget bytes are in use.
+
+    Keys carry everything a body depends on (the user's data version and local day), so entries
+    are never updated or invalidated: a write or a new day changes the key and old entries age out.
+    """
+
+    def __init__(self, memory_budget):
+        self.memory_budget = memory_budget
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def _entry_size(self, body):
+        return len(body) + ENTRY_OVERHEAD
+
+    def get(self, key):
+        with self._lock:
+            body = self._entries.get(key)
+            if body is None:
+                self._stats["misses"] += 1
+                return None
+            self._stats["hits"] += 1
+            self._entries.move_to_end(key)
+            return body
+
+    def put(self, key, body: bytes):
+        with self._lock:
+            if self._entry_size(body) > self.memory_budget:
+                return
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= self._entry_size(previous)
+            self._entries[key] = body
+            self._bytes += self._entry_size(body)
+
+            while self._bytes > self.memory_budget:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= self._entry_size(evicted)
+                self._stats["evictions"] += 1
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self._stats, entries=len(self._entries), bytes=self._bytes, memory_budget=self.memory_budget)
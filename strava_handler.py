@@ -1,11 +1,173 @@
+import os
+import random
 import requests
-from datetime import datetime
+from requests.adapters import HTTPAdapter
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import threading
 import time
 import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 
 # https://developers.strava.com/docs/reference/
 
 
+class StravaRateLimitError(Exception):
+    pass
+
+
+class StravaRateLimiter:
+    """Paces requests using the X-RateLimit-Limit / X-RateLimit-Usage headers Strava returns.
+
+    Both headers hold "<15 minute>,<daily>" values. When the 15 minute budget is spent,
+    wait() sleeps until the next quarter hour, when Strava resets it. A spent daily budget
+    raises StravaRateLimitError instead, since it only resets at midnight UTC.
+    """
+
+    def __init__(self, reserve = 0):
+        # Requests to leave unused in each window, for other work sharing the same app limits
+        self.reserve = reserve
+        self.short_limit = None
+        self.daily_limit = None
+        self.short_usage = 0
+        self.daily_usage = 0
+        self._blocked_until = 0
+        self._lock = threading.Lock()
+
+        # Time callers spent held back by a spent window
+        self.waits = 0
+        self.wait_seconds = 0.0
+
+    def update(self, headers):
+        limit = headers.get('X-RateLimit-Limit')
+        usage = headers.get('X-RateLimit-Usage')
+        if not limit or not usage:
+            return
+        with self._lock:
+            self.short_limit, self.daily_limit = (int(value) for value in limit.split(','))
+            self.short_usage, self.daily_usage = (int(value) for value in usage.split(','))
+
+    def exhausted(self):
+        # Whether the last headers seen leave no budget in either window
+        with self._lock:
+            if self.short_limit is None:
+                return False
+            return self.short_usage >= self.short_limit - self.reserve or self.daily_usage >= self.daily_limit - self.reserve
+
+    def _seconds_until_next_window(self):
+        now = datetime.now(timezone.utc)
+        elapsed = (now.minute % 15) * 60 + now.second + now.microsecond / 1000000
+        return 15 * 60 - elapsed
+
+    def wait(self):
+        while True:
+            with self._lock:
+                if self.short_limit is None:
+                    return
+                if self.daily_usage >= self.daily_limit - self.reserve:
+                    raise StravaRateLimitError("Strava daily rate limit reached, try again tomorrow")
+                now = time.monotonic()
+                if now >= self._blocked_until:
+                    if self.short_usage < self.short_limit - self.reserve:
+                        # Count this request now so concurrent callers see it before the response arrives
+                        self.short_usage += 1
+                        self.daily_usage += 1
+                        return
+                    # Budget spent, hold every caller until Strava resets the window
+                    self._blocked_until = now + self._seconds_until_next_window()
+                    self.short_usage = 0
+                    print(f"Strava rate limit reached, waiting {int(self._blocked_until - now)}s for the next window")
+                delay = self._blocked_until - now
+                self.waits += 1
+                self.wait_seconds += delay
+            time.sleep(delay)
+
+
+class StravaTokenError(Exception):
+    pass
+
+
+class StravaTokenManager:
+    """Hands out valid Strava access tokens per user, refreshing them ahead of expiry.
+
+    Tokens are cached in memory after the first load. Refreshes for a user are serialized,
+    so concurrent syncs share one refresh instead of racing to rotate the refresh token, and
+    the stored tokens are reloaded before refreshing, in case another process already did.
+    """
+
+    def __init__(self, load_tokens, save_tokens, refresh_tokens, refresh_margin = 300):
+        # load_tokens(user_id) -> dict or None, save_tokens(user_id, access, refresh, expires_at),
+        # refresh_tokens(refresh_token) -> {"success": True, "data": {...}}
+        self._load_tokens = load_tokens
+        self._save_tokens = save_tokens
+        self._refresh_tokens = refresh_tokens
+        self.refresh_margin = refresh_margin
+        self._tokens = {}
+        self._user_locks = {}
+        self._lock = threading.Lock()
+
+    def _user_lock(self, user_id):
+        with self._lock:
+            return self._user_locks.setdefault(user_id, threading.Lock())
+
+    def get_access_token(self, user_id, rejected_token = None):
+        """A valid access token for the user, or None when no Strava account is linked.
+
+        Pass the token Strava just answered 401 to as rejected_token to force a refresh,
+        unless another caller already replaced it.
+        """
+        with self._user_lock(user_id):
+            tokens = self._tokens.get(user_id)
+            if tokens is not None and self._needs_refresh(tokens, rejected_token):
+                # Another process may have rotated them already, the stored tokens are the ones to trust
+                tokens = None
+            if tokens is None:
+                tokens = self._load_tokens(user_id)
+                if tokens is None:
+                    self._tokens.pop(user_id, None)
+                    return None
+
+            if self._needs_refresh(tokens, rejected_token):
+                try:
+                    tokens = self._refresh(user_id, tokens)
+                except StravaTokenError:
+                    # Reloaded on the next call, in case it was a refresh token another process rotated
+                    self._tokens.pop(user_id, None)
+                    raise
+
+            self._tokens[user_id] = tokens
+            return tokens["access_token"]
+
+    def _needs_refresh(self, tokens, rejected_token):
+        expires_at = tokens.get("expires_at") or 0
+        expiring = expires_at - self.refresh_margin <= time.time()
+        rejected = rejected_token is not None and rejected_token == tokens["access_token"]
+        return expiring or rejected
+
+    def _refresh(self, user_id, tokens):
+        try:
+            refresh_result = self._refresh_tokens(tokens["refresh_token"])
+        except Exception as e:
+            raise StravaTokenError(f"Failed to refresh Strava access token: {str(e)}")
+        if not refresh_result or not refresh_result["success"]:
+            raise StravaTokenError("Failed to refresh Strava access token")
+
+        new_tokens = refresh_result["data"]
+        tokens = {
+            "access_token": new_tokens["access_token"],
+            "refresh_token": new_tokens["refresh_token"],
+            "expires_at": new_tokens.get("expires_at")
+        }
+        self._save_tokens(user_id, tokens["access_token"], tokens["refresh_token"], tokens["expires_at"])
+        print(f"Refreshed Strava access token for user {user_id}")
+        return tokens
+
+    def invalidate(self, user_id):
+        # Call after tokens were changed outside the manager, e.g. when the account is re-linked
+        with self._lock:
+            self._tokens.pop(user_id, None)
+
+
 class StravaHandler:
 
     # Class attributes
@@ -14,61 +176,233 @@ class StravaHandler:
     redirect_uri = 'http://127.0.0.1:8000/strava/callback'
     auth_url = 'https://www.strava.com/oauth/authorize'
     token_url = 'https://www.strava.com/oauth/token'
+    api_url = 'https://www.strava.com/api/v3'
+    activities_url = api_url + '/athlete/activities'
+    activity_url = api_url + '/activities/{}'
+
+    # Strava's maximum page size, and how many pages to have in flight at once
+    per_page = 200
+    max_concurrent_pages = 4
+
+    # Exponential backoff between retries, in seconds, before jitter
+    backoff_base = 0.5
+    backoff_max = 60
 
-    def __init__(self):
-        pass
-    
-    
-    def _fetch_strava_activities(self, access_token: str, since: str = None):
-        if not access_token:
-            return []
-
-        url = 'https://www.strava.com/api/v3/athlete/activities'
-        headers = {'Authorization': f'Bearer {access_token}'}
-        
-        # Convert since date to timestamp if provided
-        since_timestamp = None
+    def __init__(self, pool_size = None, connect_timeout = None, read_timeout = None, max_retries = None, api_url = None):
+        self.rate_limiter = StravaRateLimiter()
+
+        # Point the API elsewhere, e.g. at the stand-in served by strava_webhook_sender.py
+        if api_url is None:
+            api_url = os.environ.get("STRAVA_API_URL")
+        if api_url:
+            self.api_url = api_url.rstrip('/')
+            self.activities_url = self.api_url + '/athlete/activities'
+            self.activity_url = self.api_url + '/activities/{}'
+
+        # Shared with Strava when creating the webhook subscription, None refuses every validation
+        self.webhook_verify_token = os.environ.get("STRAVA_WEBHOOK_VERIFY_TOKEN")
+        self.webhook_subscription_id = os.environ.get("STRAVA_WEBHOOK_SUBSCRIPTION_ID")
+
+        # HTTP settings fall back to the environment, then to defaults
+        if pool_size is None:
+            pool_size = int(os.environ.get("STRAVA_HTTP_POOL_SIZE", max(10, self.max_concurrent_pages)))
+        if connect_timeout is None:
+            connect_timeout = float(os.environ.get("STRAVA_HTTP_CONNECT_TIMEOUT", 5))
+        if read_timeout is None:
+            read_timeout = float(os.environ.get("STRAVA_HTTP_READ_TIMEOUT", 30))
+        if max_retries is None:
+            max_retries = int(os.environ.get("STRAVA_HTTP_MAX_RETRIES", 4))
+        self.http_timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+
+        # One keep-alive session for every Strava call, so TLS connections are reused across pages and syncs
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+
+        self._http_lock = threading.Lock()
+        self._http_stats = {
+            "requests": 0,
+            "retries": 0,
+            "throttled": 0,
+            "server_errors": 0,
+            "connection_errors": 0,
+            "latency_total": 0.0,
+            "latency_max": 0.0
+        }
+
+    def _close_session(self):
+        self.session.close()
+
+    def _get_http_stats(self):
+        with self._http_lock:
+            stats = dict(self._http_stats)
+        latency_total = stats.pop("latency_total")
+        stats["latency_avg_ms"] = round(latency_total / stats["requests"] * 1000, 1) if stats["requests"] else 0
+        stats["latency_max_ms"] = round(stats.pop("latency_max") * 1000, 1)
+        stats["rate_limit_waits"] = self.rate_limiter.waits
+        stats["rate_limit_wait_seconds"] = round(self.rate_limiter.wait_seconds, 1)
+        return stats
+
+    def _record_http(self, latency, **counts):
+        with self._http_lock:
+            self._http_stats["requests"] += 1
+            self._http_stats["latency_total"] += latency
+            self._http_stats["latency_max"] = max(self._http_stats["latency_max"], latency)
+            for name, count in counts.items():
+                self._http_stats[name] += count
+
+    def _backoff(self, attempt):
+        # Full jitter, so concurrent page fetches don't retry in lockstep
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def _retry_after(self, response):
+        # Retry-After holds either seconds or an HTTP date
+        value = response.headers.get('Retry-After')
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+        except (TypeError, ValueError):
+            return None
+
+    def _request(self, method, url, retry_on_error = True, rate_limited = True, **kwargs):
+        """Send a request on the shared session, retrying throttled and failed attempts.
+
+        A 429 waits for Retry-After, or for the rate limit window when the usage headers show
+        it is spent, otherwise retries back off exponentially with jitter. 5xx responses and
+        dropped connections may have reached Strava, so they are only retried when
+        retry_on_error is set. The last response is returned as is once retries run out.
+        """
+        for attempt in range(self.max_retries + 1):
+            if rate_limited:
+                self.rate_limiter.wait()
+            last_attempt = attempt == self.max_retries
+
+            started = time.monotonic()
+            try:
+                response = self.session.request(method, url, timeout=self.http_timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                self._record_http(time.monotonic() - started, connection_errors=1)
+                if last_attempt or not retry_on_error:
+                    raise
+                delay = self._backoff(attempt)
+            else:
+                latency = time.monotonic() - started
+                if rate_limited:
+                    self.rate_limiter.update(response.headers)
+
+                if response.status_code == 429:
+                    self._record_http(latency, throttled=1)
+                    if last_attempt:
+                        return response
+                    delay = self._retry_after(response)
+                    if delay is None:
+                        # rate_limiter.wait() holds the next attempt until the window resets
+                        delay = 0 if rate_limited and self.rate_limiter.exhausted() else self._backoff(attempt)
+                elif response.status_code >= 500:
+                    self._record_http(latency, server_errors=1)
+                    if last_attempt or not retry_on_error:
+                        return response
+                    delay = self._retry_after(response)
+                    if delay is None:
+                        delay = self._backoff(attempt)
+                else:
+                    self._record_http(latency)
+                    return response
+
+            with self._http_lock:
+                self._http_stats["retries"] += 1
+            time.sleep(delay)
+
+    def _get_strava_page(self, access_token: str, page: int, after: int):
+        return self._request(
+            "GET",
+            self.activities_url,
+            headers={'Authorization': f'Bearer {access_token}'},
+            params={'per_page': self.per_page, 'page': page, 'after': after}
+        )
+
+    def _fetch_strava_page(self, get_access_token, page: int, after: int):
+        access_token = get_access_token()
+        response = self._get_strava_page(access_token, page, after)
+        if response.status_code == 401:
+            # The token was revoked or expired early, retry just this page with a fresh one
+            access_token = get_access_token(rejected_token=access_token)
+            response = self._get_strava_page(access_token, page, after)
+        response.raise_for_status()
+        return response.json()
+
+    def _get_strava_activity(self, access_token: str, activity_id: int):
+        return self._request(
+            "GET",
+            self.activity_url.format(activity_id),
+            headers={'Authorization': f'Bearer {access_token}'}
+        )
+
+    def _fetch_strava_activity(self, get_access_token, activity_id: int):
+        # One activity by id, None when it's gone or no longer visible to us
+        access_token = get_access_token()
+        response = self._get_strava_activity(access_token, activity_id)
+        if response.status_code == 401:
+            access_token = get_access_token(rejected_token=access_token)
+            response = self._get_strava_activity(access_token, activity_id)
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        return response.json()
+
+    def _validate_webhook_subscription(self, mode, verify_token, challenge):
+        # Strava echoes back the challenge only if the verify token matches ours
+        if self.webhook_verify_token is None or mode != "subscribe" or verify_token != self.webhook_verify_token:
+            return None
+        return {"hub.challenge": challenge}
+
+    def _is_webhook_event_accepted(self, subscription_id):
+        # Events carry no signature, so only those for our own subscription are trusted, none while it is unset
+        return self.webhook_subscription_id is not None and str(subscription_id) == self.webhook_subscription_id
+
+    def _fetch_strava_activity_pages(self, get_access_token, since: str = None, max_pages: int = None, fetch_state: dict = None):
+        """Yield pages of activities in page order as they arrive.
+
+        get_access_token(rejected_token=None) returns the token to use, see StravaTokenManager.
+        With an after filter Strava returns the oldest activities first, so every
+        page is newer than the ones before it. Only max_concurrent_pages pages are
+        held in memory at once. max_pages caps the requests made, the rest of the
+        history is left for a later sync. fetch_state["truncated"] is set to whether
+        the cap stopped the fetch before a short page showed the history was done.
+        """
+        if fetch_state is None:
+            fetch_state = {}
+        fetch_state["truncated"] = False
+
+        # Let Strava do the filtering, 0 fetches the whole history
+        after = 0
         if since:
-            since_timestamp = int(datetime.fromisoformat(since).timestamp())
-        
-        all_activities = []
+            after = int(datetime.fromisoformat(since).timestamp())
+
+        # Page 1 on its own, an incremental sync usually ends there, then concurrent waves until a page comes back short
         page = 1
-        chunk_size = 20  # Fetch 20 activities at a time
-        
-        while True:
-            params = {
-                'per_page': chunk_size,
-                'page': page
-            }
-            
-            response = requests.get(url, headers=headers, params=params)
-            response.raise_for_status()
-            activities = response.json()
-            
-            # If no activities returned, we're done
-            if not activities:
-                break
-                
-            # Add activities to our list
-            all_activities.extend(activities)
-            
-            # If we have a since date, check if we've gone far enough back
-            if since_timestamp:
-                # Check the last activity in this chunk
-                last_activity = activities[-1]
-                activity_timestamp = int(datetime.fromisoformat(last_activity['start_date'].replace('Z', '+00:00')).timestamp())
-                
-                # If this activity is before our since date, we can stop
-                if activity_timestamp < since_timestamp:
-                    break
-            
-            # Move to next page
-            page += 1
-            
-            # Optional: Add a small delay to avoid hitting rate limits
-            time.sleep(0.5)
-            
-        return all_activities
+        wave = 1
+        with ThreadPoolExecutor(max_workers=self.max_concurrent_pages) as executor:
+            while max_pages is None or page <= max_pages:
+                last_page = page + wave
+                if max_pages is not None:
+                    last_page = min(last_page, max_pages + 1)
+                pages = range(page, last_page)
+                futures = [executor.submit(self._fetch_strava_page, get_access_token, p, after) for p in pages]
+                for future in futures:
+                    activities = future.result()
+                    if activities:
+                        yield activities
+                    if len(activities) < self.per_page:
+                        return
+                page = last_page
+                wave = self.max_concurrent_pages
+        fetch_state["truncated"] = True
 
     def _get_authorization_url(self):
         # The user_id will be passed back in the `state` parameter to identify the user
@@ -94,7 +428,8 @@ class StravaHandler:
             "code": code,
             "grant_type": "authorization_code",
         }
-        response = requests.post(self.token_url, data=payload)
+        # An authorization code can only be exchanged once, so never resend it
+        response = self._request("POST", self.token_url, retry_on_error=False, rate_limited=False, data=payload)
         if response.status_code == 200:
             return {"success": True, "data": response.json()}
         else:
@@ -108,8 +443,9 @@ class StravaHandler:
             'grant_type': 'refresh_token',
             'refresh_token': refresh_token
         }
-        response = requests.post(self.token_url, data=payload)
-        
+        # A refresh that reached Strava may have rotated the refresh token, so only throttled attempts are resent
+        response = self._request("POST", self.token_url, retry_on_error=False, rate_limited=False, data=payload)
+
         if response.status_code == 200:
             return {"success": True, "data": response.json()}
         else:
@@ -123,7 +459,7 @@ class StravaHandler:
             'grant_type': 'refresh_token',
             'refresh_token': self.refresh_token
         }
-        response = requests.post(self.token_url, data=payload)
+        response = self._request("POST", self.token_url, retry_on_error=False, rate_limited=False, data=payload)
         response.raise_for_status()
         self.access_token = response.json()['access_token']
         self.refresh_token = response.json()['refresh_token']
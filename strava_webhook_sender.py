@@ -0,0 +1,98 @@
+# strava_webhook_sender.py
+# Stand-in for Strava's push subscription, to exercise /strava/webhook without network access.
+#
+# Serves the one activity an event is about from a local stub of the Strava API, then posts
+# the event to the app. Start the app pointed at the stub:
+#   STRAVA_API_URL=http://127.0.0.1:8765/api/v3 STRAVA_WEBHOOK_VERIFY_TOKEN=local uvicorn main:app
+# then, for an athlete linked to a user:
+#   python strava_webhook_sender.py create --owner-id 1234 --activity-id 42 --sport-type Run
+#   python strava_webhook_sender.py delete --owner-id 1234 --activity-id 42
+import argparse
+import json
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+
+def serve_activity(port, activity):
+    # Answers GET /api/v3/activities/<id> with the activity, anything else is a 404
+    class StubStravaApi(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if activity is not None and self.path == f"/api/v3/activities/{activity['id']}":
+                body = json.dumps(activity).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("X-RateLimit-Limit", "100,1000")
+                self.send_header("X-RateLimit-Usage", "1,1")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            else:
+                self.send_response(404)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+            print(f"stub: GET {self.path}")
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), StubStravaApi)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Send a Strava webhook event to a local app")
+    parser.add_argument("aspect_type", choices=["create", "update", "delete", "deauthorize", "validate"])
+    parser.add_argument("--app-url", default="http://127.0.0.1:8000")
+    parser.add_argument("--stub-port", type=int, default=8765)
+    parser.add_argument("--owner-id", type=int, default=1)
+    parser.add_argument("--activity-id", type=int, default=1)
+    parser.add_argument("--sport-type", default="Run")
+    parser.add_argument("--start-date", default=datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"))
+    parser.add_argument("--subscription-id", type=int, default=1)
+    parser.add_argument("--verify-token", default="local")
+    parser.add_argument("--wait", type=float, default=3, help="seconds to keep the stub up for the app to fetch")
+    args = parser.parse_args()
+
+    webhook_url = f"{args.app_url}/strava/webhook"
+
+    if args.aspect_type == "validate":
+        # What Strava does when the subscription is created
+        response = requests.get(webhook_url, params={"hub.mode": "subscribe", "hub.verify_token": args.verify_token, "hub.challenge": "challenge"})
+        print(response.status_code, response.text)
+        return
+
+    activity = None
+    if args.aspect_type in ("create", "update"):
+        activity = {"id": args.activity_id, "sport_type": args.sport_type, "type": args.sport_type, "start_date": args.start_date}
+    server = serve_activity(args.stub_port, activity)
+
+    event = {
+        "object_type": "activity",
+        "object_id": args.activity_id,
+        "aspect_type": args.aspect_type,
+        "owner_id": args.owner_id,
+        "subscription_id": args.subscription_id,
+        "event_time": int(time.time()),
+        "updates": {}
+    }
+    if args.aspect_type == "update":
+        event["updates"] = {"type": args.sport_type}
+    if args.aspect_type == "deauthorize":
+        event.update({"object_type": "athlete", "object_id": args.owner_id, "aspect_type": "update", "updates": {"authorized": "false"}})
+
+    response = requests.post(webhook_url, json=event)
+    print(response.status_code, response.text)
+
+    # The app fetches the activity after it has responded
+    time.sleep(args.wait)
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+# sync_jobs.py
+# Runs user started Strava syncs in the background, see POST /sync/ and GET /sync/{job_id} in main.py
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+class SyncJobManager:
+    """Queues sync_strava calls as jobs and tracks their progress.
+
+    A user has at most one job queued or running. Asking again while it is in flight
+    returns that job instead of starting another, whatever since it was asked with.
+    The in-process scheduler submits its syncs here too, so they coalesce with the ones
+    users start. Finished jobs are kept in memory for polling, oldest dropped first.
+    """
+
+    def __init__(self, frequency_tracker, workers = None, max_finished_jobs = 1000):
+        self.frequency_tracker = frequency_tracker
+        if workers is None:
+            workers = int(os.environ.get("STRAVA_SYNC_JOB_WORKERS", 4))
+        self.max_finished_jobs = max_finished_jobs
+
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="strava-sync-job")
+        self._jobs = OrderedDict()
+        self._finished = {}
+        self._active = {}
+        self._lock = threading.Lock()
+
+    def submit(self, user_id, since = None, max_pages = None):
+        """Start a sync for the user, or join the one in flight. Returns the job and whether it was coalesced."""
+        with self._lock:
+            job_id = self._active.get(user_id)
+            if job_id is not None:
+                return dict(self._jobs[job_id], coalesced=True)
+
+            job_id = uuid.uuid4().hex
+            job = {
+                "job_id": job_id,
+                "user_id": user_id,
+                "status": "queued",
+                "phase": None,
+                "pages_fetched": 0,
+                "activities_fetched": 0,
+                "activities_inserted": 0,
+                "complete": None,
+                "message": None,
+                "error": None,
+                "created_at": int(time.time()),
+                "finished_at": None
+            }
+            self._jobs[job_id] = job
+            self._finished[job_id] = threading.Event()
+            self._active[user_id] = job_id
+            self._prune()
+            submitted = dict(job, coalesced=False)
+
+        self._executor.submit(self._run, job_id, user_id, since, max_pages)
+        return submitted
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def wait(self, job_id, timeout = None):
+        """Block until the job finished and return it, None for an unknown job or on timeout."""
+        with self._lock:
+            finished = self._finished.get(job_id)
+            if job_id not in self._jobs:
+                return None
+        if finished is not None and not finished.wait(timeout):
+            return None
+        return self.get(job_id)
+
+    def _update(self, job_id, **fields):
+        with self._lock:
+            self._jobs[job_id].update(fields)
+
+    def _run(self, job_id, user_id, since, max_pages):
+        self._update(job_id, status="running", phase="fetching")
+
+        def progress(sync_progress):
+            self._update(
+                job_id,
+                phase=sync_progress["phase"],
+                pages_fetched=sync_progress["pages_fetched"],
+                activities_fetched=sync_progress["activities_fetched"],
+                activities_inserted=sync_progress["activities_inserted"]
+            )
+
+        try:
+            result = self.frequency_tracker.sync_strava(user_id, since, progress, max_pages)
+        except Exception as e:
+            result = {"success": False, "message": f"Error syncing Strava activities: {str(e)}"}
+
+        # Failed syncs still report how far they got
+        counts = {key: result[key] for key in ("pages_fetched", "activities_fetched", "activities_inserted") if key in result}
+        with self._lock:
+            self._jobs[job_id].update(
+                counts,
+                status="succeeded" if result["success"] else "failed",
+                complete=result.get("complete"),
+                phase="done",
+                message=result["message"],
+                error=None if result["success"] else result["message"],
+                finished_at=int(time.time())
+            )
+            self._active.pop(user_id, None)
+            self._finished.pop(job_id).set()
+
+    def _prune(self):
+        # Drop the oldest finished jobs once there are too many, caller holds the lock
+        finished = [job_id for job_id, job in self._jobs.items() if job["finished_at"] is not None]
+        for job_id in finished[:max(0, len(finished) - self.max_finished_jobs)]:
+            del self._jobs[job_id]
+
+    def shutdown(self):
+        # Queued jobs are dropped, running ones are left to finish
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,133 @@
+# sync_scheduler.py
+# Keeps every linked user's Strava activities up to date in the background.
+# Runs inside the API process (STRAVA_SYNC_SCHEDULER=1, see main.py) or on its own:
+#   python sync_scheduler.py
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from frequency_tracker import FrequencyTracker
+
+
+class StravaSyncScheduler:
+    """Periodically syncs users with stored Strava tokens, sharing the app's rate limit fairly.
+
+    Each round takes budget_share of the requests left in the current rate limit window and
+    splits them evenly over the users that are due, longest waiting first. A user whose history
+    doesn't fit in their share isn't marked synced, so they stay due and pick up from the sync
+    watermark next round. The rest of the window is left for syncs users start themselves.
+    """
+
+    # Requests assumed per 15 minute window until Strava has sent its rate limit headers
+    default_window_budget = 100
+
+    def __init__(self, frequency_tracker, sync_interval = None, round_interval = None, workers = None, budget_share = None, sync_jobs = None):
+        self.frequency_tracker = frequency_tracker
+        # Inside the API process syncs go through its SyncJobManager, so they coalesce with user started ones
+        self.sync_jobs = sync_jobs
+
+        # Scheduler settings fall back to the environment, then to defaults
+        if sync_interval is None:
+            sync_interval = int(os.environ.get("STRAVA_SYNC_INTERVAL", 3600))
+        if round_interval is None:
+            round_interval = float(os.environ.get("STRAVA_SYNC_ROUND_INTERVAL", 60))
+        if workers is None:
+            workers = int(os.environ.get("STRAVA_SYNC_WORKERS", 2))
+        if budget_share is None:
+            budget_share = float(os.environ.get("STRAVA_SYNC_BUDGET_SHARE", 0.5))
+        self.sync_interval = sync_interval
+        self.round_interval = round_interval
+        self.workers = workers
+        self.budget_share = budget_share
+
+        # Users whose last sync failed are left alone until their retry time
+        self._retry_at = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _round_budget(self):
+        # Requests this round may spend, from what is left of both Strava windows
+        rate_limiter = self.frequency_tracker.rate_limiter
+        if rate_limiter.short_limit is None:
+            available = self.default_window_budget
+        else:
+            short_left = rate_limiter.short_limit - rate_limiter.short_usage
+            daily_left = rate_limiter.daily_limit - rate_limiter.daily_usage
+            available = min(short_left, daily_left) - rate_limiter.reserve
+        return max(0, int(available * self.budget_share))
+
+    def run_once(self):
+        """Sync the users that are due, within this round's budget. Returns each user's result."""
+        budget = self._round_budget()
+        if budget == 0:
+            return {}
+
+        now = time.time()
+        candidates = self.frequency_tracker.get_strava_sync_candidates(int(now) - self.sync_interval, budget + len(self._retry_at))
+        user_ids = [candidate["user_id"] for candidate in candidates if self._retry_at.get(candidate["user_id"], 0) <= now]
+
+        # At least one page each, so a round never starts more users than it has requests for
+        user_ids = user_ids[:budget]
+        if not user_ids:
+            return {}
+        pages_per_user = budget // len(user_ids)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {user_id: executor.submit(self._sync, user_id, pages_per_user) for user_id in user_ids}
+            results = {}
+            for user_id, future in futures.items():
+                try:
+                    results[user_id] = future.result()
+                except Exception as e:
+                    results[user_id] = {"success": False, "message": str(e)}
+
+        for user_id, result in results.items():
+            if result["success"]:
+                self._retry_at.pop(user_id, None)
+            else:
+                print(f"Background Strava sync failed for user {user_id}: {result['message']}")
+                self._retry_at[user_id] = now + self.sync_interval
+
+        unfinished = sum(1 for result in results.values() if result["success"] and not result["complete"])
+        print(f"Background Strava sync round: {len(user_ids)} users, {pages_per_user} pages each, {unfinished} left unfinished")
+        return results
+
+    def _sync(self, user_id, max_pages):
+        if self.sync_jobs is None:
+            return self.frequency_tracker.sync_strava(user_id, None, None, max_pages)
+
+        # A sync already in flight for the user is waited for instead of started again
+        job = self.sync_jobs.wait(self.sync_jobs.submit(user_id, max_pages=max_pages)["job_id"])
+        return {"success": job["status"] == "succeeded", "message": job["message"], "complete": job["complete"]}
+
+    def run_forever(self):
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                print(f"Background Strava sync round failed: {str(e)}")
+            self._stop.wait(self.round_interval)
+
+    def start(self):
+        # Run rounds on a daemon thread inside this process
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run_forever, name="strava-sync-scheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+if __name__ == "__main__":
+    frequency_tracker = FrequencyTracker()
+    scheduler = StravaSyncScheduler(frequency_tracker)
+    try:
+        scheduler.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        frequency_tracker.close()
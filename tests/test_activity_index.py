@@ -0,0 +1,95 @@
+import pytest
+from datetime import datetime, timedelta, timezone
+from activity_index import ActivityIndex, ENTRY_OVERHEAD, to_epoch_us, from_epoch_us
+
+START = datetime(2025, 3, 1, 12, 0, 0, 250000, tzinfo=timezone.utc)
+
+def day(n):
+    return START + timedelta(days=n)
+
+def epochs(*days):
+    return [to_epoch_us(day(n)) for n in days]
+
+@pytest.fixture
+def activity_index():
+    yield ActivityIndex(1024 * 1024)
+
+def test_epoch_round_trip():
+    assert from_epoch_us(to_epoch_us(START)) == START
+    assert from_epoch_us(to_epoch_us(START + timedelta(microseconds=1))) == START + timedelta(microseconds=1)
+
+def test_last_times(activity_index):
+
+    # Nothing cached yet
+    assert activity_index.last_times(1, 5) is None
+
+    # Types without activities are left out
+    assert activity_index.store(1, 5, {1: epochs(0, 3, 7), 2: epochs(2), 3: []})
+    assert activity_index.last_times(1, 5) == {1: day(7), 2: day(2)}
+
+def test_first_and_count_since(activity_index):
+    activity_index.store(1, 5, {1: epochs(0, 3, 7), 2: []})
+    assert activity_index.first(1, 1, 5) == day(0)
+    assert activity_index.first(1, 2, 5) == -1
+    assert activity_index.count_since(1, 1, 5) == 3
+
+    # Strictly after, like the thirty and season cutoffs
+    assert activity_index.count_since(1, 1, 5, day(3)) == 1
+    assert activity_index.count_since(1, 1, 5, day(-1)) == 3
+    assert activity_index.count_since(1, 3, 5, day(-1)) == 0
+    assert activity_index.first(1, 1, 6) is None
+
+def test_apply_next_version_in_place(activity_index):
+    activity_index.store(1, 5, {1: epochs(0, 7)})
+
+    # The write right after the cached version is applied, repeats and misses change nothing
+    activity_index.apply(1, 6, added=[(1, day(3)), (1, day(3)), (2, day(1))], removed=[(1, day(7)), (3, day(0))])
+    assert activity_index.count_since(1, 1, 6) == 2
+    assert activity_index.last_times(1, 6) == {1: day(3), 2: day(1)}
+
+    # A version the entry already has is left alone
+    activity_index.apply(1, 6, removed=[(1, day(3))])
+    assert activity_index.count_since(1, 1, 6) == 2
+
+    # A skipped version means a write this process didn't see
+    activity_index.apply(1, 8, added=[(1, day(9))])
+    assert activity_index.get_stats()["entries"] == 0
+
+def test_other_versions_are_dropped(activity_index):
+    activity_index.store(1, 5, {1: epochs(0)})
+
+    # Any write, from this process or another, bumps the version past the entry
+    assert activity_index.last_times(1, 6) is None
+    assert activity_index.get_stats()["entries"] == 0
+    assert activity_index.get_stats()["stale"] == 1
+
+    # A load finishing after a newer one is not kept
+    assert activity_index.store(1, 7, {1: epochs(0, 1)})
+    assert not activity_index.store(1, 6, {1: epochs(0)})
+    assert activity_index.last_times(1, 7) == {1: day(1)}
+
+def test_evicts_least_recently_used():
+    entry_size = 10 * 8 + ENTRY_OVERHEAD * 2
+    activity_index = ActivityIndex(entry_size * 2)
+    times = {1: epochs(*range(10))}
+
+    activity_index.store(1, 1, times)
+    activity_index.store(2, 1, times)
+    activity_index.last_times(1, 1)
+    activity_index.store(3, 1, times)
+
+    # User 2 was used least recently
+    assert activity_index.last_times(2, 1) is None
+    assert activity_index.last_times(1, 1) is not None
+    stats = activity_index.get_stats()
+    assert stats["evictions"] == 1
+    assert stats["bytes"] <= stats["memory_budget"]
+
+def test_invalidate(activity_index):
+    activity_index.store(1, 1, {1: epochs(0)})
+    activity_index.store(2, 1, {1: epochs(0)})
+
+    activity_index.invalidate(1)
+    assert activity_index.last_times(1, 1) is None
+    assert activity_index.last_times(2, 1) is not None
+    assert activity_index.get_stats()["entries"] == 1
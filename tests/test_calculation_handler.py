@@ -1,6 +1,8 @@
 import pytest
 import os
-from calculation_handler import CalculationHandler
+import numpy as np
+from datetime import datetime, timezone, timedelta
+from calculation_handler import CalculationHandler, ClockContext
 
 @pytest.fixture(scope="module")
 def calculation_handler():
@@ -17,4 +19,96 @@ def test_hash_password(calculation_handler):
 def test_hash_password_invalid(calculation_handler):
     password = "password"
     hashed_password = calculation_handler.hash_password(password)
-    assert hashed_password is not None
\ No newline at end of file
+    assert hashed_password is not None
+
+def test_frequency_averages(calculation_handler):
+    clock = calculation_handler._clock_context("America/Denver")
+
+    # No activities gives no averages
+    result = calculation_handler._frequency_averages(0, None, 0, 0, clock)
+    assert result == (-1, -1, -1)
+
+    # Averages are days per activity
+    first_time = datetime.now(timezone.utc) - timedelta(days=40)
+    total, thirty, season = calculation_handler._frequency_averages(4, first_time, 4, 2, clock)
+    assert total == round(calculation_handler._days_ago(first_time, clock) / 4, 2)
+    assert thirty == 7.5
+    assert season == round(calculation_handler._days_ago(clock.season_start, clock) / 2, 2)
+
+def test_clock_context():
+
+    # 08:00 UTC is 1 AM on January 15th in Denver, whose midnight was at 07:00 UTC
+    now = datetime(2025, 1, 15, 8, 0, tzinfo=timezone.utc)
+    clock = ClockContext("America/Denver", now)
+    assert clock.local_midnight == datetime(2025, 1, 15, 7, 0, tzinfo=timezone.utc)
+    assert clock.next_midnight == datetime(2025, 1, 16, 7, 0, tzinfo=timezone.utc)
+    assert clock.thirty_cutoff == datetime(2024, 12, 16, 7, 0, tzinfo=timezone.utc)
+
+    # January belongs to the winter that started last December
+    assert clock.season == "winter"
+    assert clock.season_start == datetime(2024, 12, 1, 7, 0, tzinfo=timezone.utc)
+
+    # Days are counted back from local midnight
+    handler = CalculationHandler()
+    assert handler._days_ago(datetime(2025, 1, 15, 7, 30, tzinfo=timezone.utc), clock) == 0
+    assert handler._days_ago(datetime(2025, 1, 15, 6, 30, tzinfo=timezone.utc), clock) == 1
+    assert handler._days_ago(clock.season_start, clock) == 46
+    assert clock.is_current(now)
+    assert not clock.is_current(clock.next_midnight)
+
+def test_clock_context_thirty_cutoff_across_dst():
+
+    # Thirty local days before March 20th is midnight on February 18th, still in standard time
+    clock = ClockContext("America/Denver", datetime(2025, 3, 20, 18, 0, tzinfo=timezone.utc))
+    assert clock.local_midnight == datetime(2025, 3, 20, 6, 0, tzinfo=timezone.utc)
+    assert clock.thirty_cutoff == datetime(2025, 2, 18, 7, 0, tzinfo=timezone.utc)
+
+    # And the other way, back across the end of daylight saving time
+    clock = ClockContext("America/Denver", datetime(2025, 11, 10, 18, 0, tzinfo=timezone.utc))
+    assert clock.thirty_cutoff == datetime(2025, 10, 11, 6, 0, tzinfo=timezone.utc)
+
+def test_clock_context_is_cached(calculation_handler):
+    clock = calculation_handler._clock_context("Asia/Tokyo")
+    assert calculation_handler._clock_context("Asia/Tokyo") is clock
+    assert calculation_handler._clock_context("UTC") is not clock
+
+def test_frequency_stats_matches_scalar_averages(calculation_handler):
+    clock = calculation_handler._clock_context("America/Denver")
+
+    # Two types with activities spread over the last 200 days, in no particular order
+    now = datetime.now(timezone.utc)
+    activities = {7: [now - timedelta(days=days, hours=3) for days in (150, 2, 45, 11)],
+                  3: [now - timedelta(days=days) for days in (200, 90)]}
+    type_ids = [type_id for type_id, times in activities.items() for _ in times]
+    times = [int(time.timestamp()) for times in activities.values() for time in times]
+
+    stats = calculation_handler._frequency_stats(type_ids, times, clock.local_midnight.timestamp(),
+                                                 clock.thirty_cutoff.timestamp(), clock.season_start.timestamp())
+    assert stats["type_ids"].tolist() == [3, 7]
+
+    for position, type_id in enumerate(stats["type_ids"].tolist()):
+        type_times = activities[type_id]
+        thirty_count = sum(time > clock.thirty_cutoff for time in type_times)
+        season_count = sum(time > clock.season_start for time in type_times)
+        expected = calculation_handler._frequency_averages(len(type_times), min(type_times), thirty_count, season_count, clock)
+
+        assert stats["total_count"][position] == len(type_times)
+        assert stats["thirty_count"][position] == thirty_count
+        assert stats["season_count"][position] == season_count
+        assert (stats["total"][position], stats["thirty"][position], stats["season"][position]) == expected
+        assert stats["current"][position] == calculation_handler._days_ago(max(type_times), clock)
+
+def test_frequency_stats_per_activity_boundaries(calculation_handler):
+
+    # Boundaries can differ per activity, e.g. for users in different time zones
+    times = np.array(["2025-01-10T00:00:00", "2025-01-20T00:00:00", "2025-01-20T00:00:00"], dtype="datetime64[s]")
+    cutoffs = np.array(["2025-01-15", "2025-01-15", "2025-01-25"], dtype="datetime64[s]").astype(np.int64)
+    midnight = np.datetime64("2025-01-31", "s").astype(np.int64)
+
+    stats = calculation_handler._frequency_stats([1, 1, 2], times, midnight, cutoffs, cutoffs)
+    assert stats["thirty_count"].tolist() == [1, 0]
+    assert stats["thirty"].tolist() == [30.0, -1.0]
+    assert stats["total"].tolist() == [11.0, 12.0]
+
+    # Nothing in, nothing out
+    assert calculation_handler._frequency_stats([], [], midnight, 0, 0)["type_ids"].size == 0
@@ -0,0 +1,102 @@
+import threading
+import pytest
+from connection_pool import ConnectionPool, PoolTimeoutError
+
+
+class FakeCursor:
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, query, params = None):
+        if self.conn.broken:
+            raise RuntimeError("connection lost")
+
+    def fetchone(self):
+        return (1,)
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+
+    def __init__(self):
+        self.closed = 0
+        self.broken = False
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = 1
+
+
+@pytest.fixture
+def pool():
+    pool = ConnectionPool(FakeConnection, min_size=1, max_size=2, timeout=0.1, health_check_interval=0)
+    yield pool
+    pool.closeall()
+
+def test_reuses_connections(pool):
+
+    # Borrow and return the same connection
+    conn = pool.getconn()
+    pool.putconn(conn)
+    assert pool.getconn() is conn
+
+    stats = pool.get_stats()
+    assert stats["connections_created"] == 1
+    assert stats["checkouts"] == 2
+    assert stats["in_use"] == 1
+
+def test_checkout_timeout(pool):
+
+    # Exhaust the pool
+    conn_1 = pool.getconn()
+    conn_2 = pool.getconn()
+    assert conn_1 is not conn_2
+
+    with pytest.raises(PoolTimeoutError):
+        pool.getconn()
+    assert pool.get_stats()["timeouts"] == 1
+
+    # A returned connection wakes up a waiting borrower
+    waiter = {}
+    thread = threading.Thread(target=lambda: waiter.setdefault("conn", pool.getconn()))
+    pool.timeout = 5
+    thread.start()
+    pool.putconn(conn_1)
+    thread.join()
+    assert waiter["conn"] is conn_1
+
+def test_health_check_replaces_broken_connection(pool):
+
+    conn = pool.getconn()
+    conn.broken = True
+    pool.putconn(conn)
+
+    replacement = pool.getconn()
+    assert replacement is not conn
+    assert conn.closed
+
+    stats = pool.get_stats()
+    assert stats["failed_health_checks"] == 1
+    assert stats["size"] == 1
+
+def test_discard_frees_slot(pool):
+
+    conn_1 = pool.getconn()
+    conn_2 = pool.getconn()
+    pool.putconn(conn_1, discard=True)
+    assert pool.get_stats()["size"] == 1
+
+    # The freed slot can be filled with a new connection
+    conn_3 = pool.getconn()
+    assert conn_3 is not conn_1
+    pool.putconn(conn_2)
+    pool.putconn(conn_3)
+    assert pool.get_stats()["idle"] == 2
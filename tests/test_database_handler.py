@@ -1,6 +1,8 @@
+import io
 import os
 import pytest
 import datetime
+import queries
 from database_handler import DatabaseHandler
 from dotenv import load_dotenv
 
@@ -186,3 +188,270 @@ def test_user_calculations_table(db_handler):
     # Ensure all user calculations are removed
     result = db_handler._get_user_calculations(user_id=user_id)
     assert result == []
+
+def test_add_activities_bulk(db_handler):
+
+    # Add a dummy user
+    purge_dummy_user(db_handler)
+    result = db_handler._create_user(email=dummy_user_email, password="password", name="Test", timezone="America/Denver")
+    assert result["success"] == True
+    user_id = result["id"]
+
+    # Add an activity type and its calculation row
+    activity_type_id = db_handler._create_activity_type(user_id=user_id, type="Running", winter=1, spring=2, summer=3, fall=4)
+    db_handler._add_user_calculation(user_id=user_id, type_id=activity_type_id, valid=True)
+
+    # Insert several activities at once, including a duplicate
+    rows = [
+        (activity_type_id, "2025-01-01 12:00:00+00"),
+        (activity_type_id, "2025-01-02 12:00:00+00"),
+        (activity_type_id, "2025-01-02 12:00:00+00")
+    ]
+    assert db_handler._add_activities_bulk(user_id, rows) == 2
+    assert len(db_handler._get_activities(user_id=user_id)) == 2
+
+    # Re-inserting the same rows adds nothing
+    assert db_handler._add_activities_bulk(user_id, rows) == 0
+
+    # The running aggregates of the affected calculation are updated in place
+    result = db_handler._get_user_calculations(user_id=user_id)
+    assert result[0]["total_count"] == 2
+    assert result[0]["first_time"] == datetime.datetime(2025, 1, 1, 12, tzinfo=datetime.timezone.utc)
+
+    # Removing the first activity moves the first time forward
+    db_handler._remove_activity(user_id=user_id, type_id=activity_type_id, time="2025-01-01 12:00:00+00")
+    result = db_handler._get_user_calculations(user_id=user_id)
+    assert result[0]["total_count"] == 1
+    assert result[0]["first_time"] == datetime.datetime(2025, 1, 2, 12, tzinfo=datetime.timezone.utc)
+
+    # Remove the dummy user
+    db_handler._remove_user(user_id)
+
+def test_strava_activity_upsert(db_handler):
+
+    # Add a dummy user with two tracked types
+    purge_dummy_user(db_handler)
+    result = db_handler._create_user(email=dummy_user_email, password="password", name="Test", timezone="America/Denver")
+    user_id = result["id"]
+    run_id = db_handler._create_activity_type(user_id=user_id, type="Running", winter=1, spring=2, summer=3, fall=4)
+    ride_id = db_handler._create_activity_type(user_id=user_id, type="Riding", winter=1, spring=2, summer=3, fall=4)
+    db_handler._add_user_calculation(user_id=user_id, type_id=run_id, valid=True)
+    db_handler._add_user_calculation(user_id=user_id, type_id=ride_id, valid=True)
+
+    # A synced activity is linked to its Strava id
+    assert db_handler._add_strava_activities_bulk(user_id, [(run_id, "2025-01-01 12:00:00+00", 12345678901)]) == 1
+
+    # Re-delivering the same activity changes nothing
+    assert db_handler._upsert_strava_activity(user_id, 12345678901, run_id, "2025-01-01 12:00:00+00") == (0, 0)
+
+    # A retyped activity moves between calculations
+    assert db_handler._upsert_strava_activity(user_id, 12345678901, ride_id, "2025-01-01 12:00:00+00") == (1, 1)
+    counts = {row["type_id"]: row["total_count"] for row in db_handler._get_user_calculations(user_id=user_id)}
+    assert counts == {run_id: 0, ride_id: 1}
+
+    # Deleting by Strava id removes it
+    assert db_handler._remove_strava_activity(user_id, 12345678901) == 1
+    assert db_handler._get_activities(user_id=user_id) == []
+
+    # Remove the dummy user
+    db_handler._remove_user(user_id)
+
+def test_strava_sync_state(db_handler):
+
+    # Add a dummy user that has never synced
+    purge_dummy_user(db_handler)
+    result = db_handler._create_user(email=dummy_user_email, password="password", name="Test", timezone="America/Denver")
+    user_id = result["id"]
+    assert db_handler._get_strava_sync_state(user_id) == {"watermark": None, "last_synced_at": None}
+
+    # The watermark only moves forward
+    db_handler._set_strava_sync_state(user_id, 2000)
+    db_handler._set_strava_sync_state(user_id, 1000)
+    assert db_handler._get_strava_sync_state(user_id) == {"watermark": 2000, "last_synced_at": None}
+
+    # Finishing a sync stamps last_synced_at and keeps the watermark, a page without one keeps the stamp
+    db_handler._set_strava_sync_state(user_id, None, 5000)
+    db_handler._set_strava_sync_state(user_id, 3000)
+    assert db_handler._get_strava_sync_state(user_id) == {"watermark": 3000, "last_synced_at": 5000}
+
+    # A reset clears only the watermark
+    db_handler._reset_strava_sync_watermark(user_id)
+    assert db_handler._get_strava_sync_state(user_id) == {"watermark": None, "last_synced_at": 5000}
+
+    # Remove the dummy user
+    db_handler._remove_user(user_id)
+
+def test_daily_counts(db_handler):
+
+    # Add a dummy user whose evening activities fall on the previous local day
+    purge_dummy_user(db_handler)
+    result = db_handler._create_user(email=dummy_user_email, password="password", name="Test", timezone="America/Denver")
+    user_id = result["id"]
+    type_id = db_handler._create_activity_type(user_id=user_id, type="Running", winter=1, spring=2, summer=3, fall=4)
+    db_handler._add_user_calculation(user_id=user_id, type_id=type_id, valid=True)
+
+    db_handler._add_activities_bulk(user_id, [(type_id, "2025-01-02 03:00:00+00"), (type_id, "2025-01-02 05:00:00+00")])
+    db_handler._add_activity(user_id, type_id, "2025-01-02 12:00:00+00")
+    assert db_handler._get_daily_counts(user_id) == [(type_id, datetime.date(2025, 1, 1), 2), (type_id, datetime.date(2025, 1, 2), 1)]
+
+    # Days without activities left are dropped
+    db_handler._remove_activity(user_id, type_id, "2025-01-02 12:00:00+00")
+    assert db_handler._get_daily_counts(user_id) == [(type_id, datetime.date(2025, 1, 1), 2)]
+
+    # Changing time zone moves the activities to their new local day
+    db_handler._set_user_timezone(user_id, "UTC")
+    assert db_handler._get_daily_counts(user_id) == [(type_id, datetime.date(2025, 1, 2), 2)]
+
+    # Repairs change what reads return, so they bump the data version too
+    version = db_handler._get_data_version(user_id)["version"]
+    db_handler._rebuild_daily_counts([user_id])
+    assert db_handler._get_data_version(user_id)["version"] == version + 1
+    db_handler._rebuild_user_calculations_bulk([user_id], lambda calculations, activities: [])
+    assert db_handler._get_data_version(user_id)["version"] == version + 2
+
+    # Remove the dummy user
+    db_handler._remove_user(user_id)
+
+def test_window_counts_off_midnight(db_handler):
+
+    # Add a dummy user with activities around a boundary that isn't a local midnight
+    purge_dummy_user(db_handler)
+    result = db_handler._create_user(email=dummy_user_email, password="password", name="Test", timezone="America/Denver")
+    user_id = result["id"]
+    type_id = db_handler._create_activity_type(user_id=user_id, type="Running", winter=1, spring=2, summer=3, fall=4)
+    db_handler._add_user_calculation(user_id=user_id, type_id=type_id)
+    utc = datetime.timezone.utc
+    db_handler._add_activities_bulk(user_id, [
+        (type_id, datetime.datetime(2025, 2, 18, 8, 0, tzinfo=utc)),
+        (type_id, datetime.datetime(2025, 2, 18, 12, 0, tzinfo=utc)),
+        (type_id, datetime.datetime(2025, 2, 18, 13, 0, tzinfo=utc)),
+        (type_id, datetime.datetime(2025, 2, 19, 12, 0, tzinfo=utc))
+    ])
+
+    # Only activities strictly after the boundary count, also on the boundary's own day
+    boundary = datetime.datetime(2025, 2, 18, 12, 0, tzinfo=utc)
+    db_handler._refresh_user_calculations(user_id, boundary, boundary)
+    calculation = db_handler._get_user_calculations(user_id=user_id)[0]
+    assert calculation["total_count"] == 4
+    assert calculation["thirty_count"] == 2
+    assert calculation["season_count"] == 2
+
+    # Rolling the window to a local midnight counts the whole day after it
+    midnight = datetime.datetime(2025, 2, 18, 7, 0, tzinfo=utc)
+    db_handler._refresh_user_calculations(user_id, midnight, midnight)
+    assert db_handler._get_user_calculations(user_id=user_id)[0]["thirty_count"] == 4
+
+    # Remove the dummy user
+    db_handler._remove_user(user_id)
+
+def test_activities_pages(db_handler):
+
+    # Add a dummy user with activities on two types, some at the same time
+    purge_dummy_user(db_handler)
+    result = db_handler._create_user(email=dummy_user_email, password="password", name="Test", timezone="America/Denver")
+    user_id = result["id"]
+    run_id = db_handler._create_activity_type(user_id=user_id, type="Running", winter=1, spring=2, summer=3, fall=4)
+    ride_id = db_handler._create_activity_type(user_id=user_id, type="Riding", winter=1, spring=2, summer=3, fall=4)
+    times = [f"2025-01-{day:02d} 12:00:00+00" for day in range(1, 11)]
+    db_handler._add_activities_bulk(user_id, [(run_id, time) for time in times] + [(ride_id, time) for time in times[::2]])
+
+    # Walking the pages from each last row visits every activity once, in (time, id) order
+    filters = {"activity_type": None, "since": None, "until": None, "after_time": None, "after_id": None}
+    pages = []
+    while True:
+        page = db_handler._get_activities_page(user_id, filters, 4)
+        if not page:
+            break
+        pages.append(page)
+        filters = dict(filters, after_time=page[-1]["time"], after_id=page[-1]["id"])
+    activities = [activity for page in pages for activity in page]
+    assert len(activities) == 15
+    assert [(a["time"], a["id"]) for a in activities] == sorted((a["time"], a["id"]) for a in activities)
+
+    # Filters narrow the pages and the stream alike
+    filters = {"activity_type": "Riding", "since": "2025-01-03 00:00:00+00", "until": "2025-01-09 00:00:00+00", "after_time": None, "after_id": None}
+    page = db_handler._get_activities_page(user_id, filters, 100)
+    assert [a["time"].day for a in page] == [3, 5, 7]
+    streamed = [activity for batch in db_handler._stream_activities(user_id, filters, batch_size=2) for activity in batch]
+    assert streamed == page
+
+    # Remove the dummy user
+    db_handler._remove_user(user_id)
+
+def test_apply_activity_batch(db_handler):
+
+    # Add a dummy user with one activity
+    purge_dummy_user(db_handler)
+    result = db_handler._create_user(email=dummy_user_email, password="password", name="Test", timezone="America/Denver")
+    user_id = result["id"]
+    type_id = db_handler._create_activity_type(user_id=user_id, type="Running", winter=1, spring=2, summer=3, fall=4)
+    db_handler._add_user_calculation(user_id=user_id, type_id=type_id, valid=True)
+    db_handler._add_activity(user_id, type_id, "2025-01-01 12:00:00+00")
+    assert db_handler._get_activity_type_ids(user_id, ["Running", "Chess"]) == {"Running": type_id}
+
+    # Deletes apply first, then adds, repeats and misses only come back once or not at all
+    inserted, deleted, version = db_handler._apply_activity_batch(
+        user_id,
+        [(type_id, "2025-01-02 12:00:00+00"), (type_id, "2025-01-02 12:00:00+00"), (type_id, "2025-01-03 12:00:00+00")],
+        [(type_id, "2025-01-01 12:00:00+00"), (type_id, "2024-01-01 12:00:00+00")]
+    )
+    assert len(inserted) == 2
+    assert len(deleted) == 1
+    assert version == db_handler._get_data_version(user_id)["version"]
+    calculation = db_handler._get_user_calculations(user_id=user_id)[0]
+    assert calculation["total_count"] == 2
+    assert calculation["first_time"].day == 2
+
+    # Remove the dummy user
+    db_handler._remove_user(user_id)
+
+def test_csv_import_export(db_handler):
+
+    # Add a dummy user with one activity type
+    purge_dummy_user(db_handler)
+    result = db_handler._create_user(email=dummy_user_email, password="password", name="Test", timezone="America/Denver")
+    user_id = result["id"]
+    type_id = db_handler._create_activity_type(user_id=user_id, type="Running", winter=1, spring=2, summer=3, fall=4)
+    db_handler._add_user_calculation(user_id=user_id, type_id=type_id, valid=True)
+
+    # One type is updated, one created with a calculation row
+    types_csv = "type,winter,spring,summer,fall\nRunning,2,2,2,2\nSwimming,1,1,1,1\n"
+    assert db_handler._import_activity_types_csv(user_id, io.StringIO(types_csv)) == (1, 1)
+    assert len(db_handler._get_user_calculations(user_id=user_id)) == 2
+
+    # Repeated rows, existing activities and unknown types are skipped
+    db_handler._add_activity(user_id, type_id, "2025-01-01 12:00:00+00")
+    activities_csv = (
+        "type,time\n"
+        "Running,2025-01-01 12:00:00+00\n"
+        "Running,2025-01-02 12:00:00+00\n"
+        "Running,2025-01-02 12:00:00+00\n"
+        "Swimming,2025-01-03 03:00:00+00\n"
+        "Chess,2025-01-03 12:00:00+00\n"
+    )
+    summary = db_handler._import_activities_csv(user_id, io.StringIO(activities_csv))
+    assert summary == {"rows": 5, "imported": 2, "unknown_type": 1, "skipped": 2}
+    calculations = {row["type_id"]: row for row in db_handler._get_user_calculations(user_id=user_id)}
+    assert calculations[type_id]["total_count"] == 2
+
+    # Swimming lands on its local day
+    daily_counts = db_handler._get_daily_counts(user_id)
+    assert sum(count for _, _, count in daily_counts) == 3
+    assert (type_id, datetime.date(2025, 1, 2), 1) in daily_counts
+    assert any(local_day == datetime.date(2025, 1, 2) for tid, local_day, _ in daily_counts if tid != type_id)
+
+    # Exports come back in UTC, ordered by time
+    exported = io.StringIO()
+    db_handler._export_csv(queries.copy_activities_out(user_id), exported)
+    assert exported.getvalue().splitlines() == [
+        "type,time",
+        "Running,2025-01-01 12:00:00+00",
+        "Running,2025-01-02 12:00:00+00",
+        "Swimming,2025-01-03 03:00:00+00"
+    ]
+    exported = io.StringIO()
+    db_handler._export_csv(queries.copy_activity_types_out(user_id), exported)
+    assert exported.getvalue() == types_csv
+
+    # Remove the dummy user
+    db_handler._remove_user(user_id)
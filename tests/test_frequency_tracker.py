@@ -0,0 +1,112 @@
+import os
+import time
+import pytest
+from datetime import datetime, timezone
+from frequency_tracker import FrequencyTracker, Activity, ActivityBatch
+from dotenv import load_dotenv
+
+load_dotenv()
+
+dummy_user_email = "tracker_test@example.com"
+
+@pytest.fixture(scope="module")
+def frequency_tracker():
+
+    tracker = FrequencyTracker(db_url = os.environ.get("DATABASE_URL"))
+    tracker._initialize_tables()
+    purge_dummy_user(tracker)
+    yield tracker
+
+def purge_dummy_user(frequency_tracker):
+    result = frequency_tracker._find_user_by_email(email=dummy_user_email)
+    if result is not None:
+        frequency_tracker._remove_user(id=result["id"])
+
+@pytest.fixture
+def user_id(frequency_tracker):
+
+    # A dummy user with one activity type, removed again after the test
+    purge_dummy_user(frequency_tracker)
+    user_id = frequency_tracker._create_user(email=dummy_user_email, password="password", name="Test", timezone="America/Denver")["id"]
+    type_id = frequency_tracker._create_activity_type(user_id=user_id, type="Running", winter=1, spring=2, summer=3, fall=4)
+    frequency_tracker._add_user_calculation(user_id=user_id, type_id=type_id, valid=True)
+    yield user_id
+    frequency_tracker._remove_user(user_id)
+
+def link_strava(frequency_tracker, user_id):
+    # Tokens far from expiry, so a sync never tries to refresh them
+    frequency_tracker.store_strava_tokens(user_id, 9000000 + user_id, "access", "refresh", int(time.time()) + 3600)
+
+def strava_activity(activity_id, start_date, sport_type = "Running"):
+    return {"id": activity_id, "start_date": start_date, "sport_type": sport_type}
+
+def test_apply_activity_batch_offsets(frequency_tracker, user_id):
+
+    # Times with an offset are converted to UTC, times without one are taken as UTC
+    batch = ActivityBatch(add=[Activity(type="Running", time="2025-01-01T10:00:00-07:00"), Activity(type="Running", time="2025-01-02T10:00:00")])
+    result = frequency_tracker.apply_activity_batch(user_id, batch)
+    assert result["added"] == 2
+    times = [activity["time"] for activity in frequency_tracker.get_activities(user_id)]
+    assert sorted(times) == [datetime(2025, 1, 1, 17, tzinfo=timezone.utc), datetime(2025, 1, 2, 10, tzinfo=timezone.utc)]
+
+    # And the same instant written with another offset finds the activity to delete
+    batch = ActivityBatch(delete=[Activity(type="Running", time="2025-01-01T17:00:00+00:00")])
+    assert frequency_tracker.apply_activity_batch(user_id, batch)["results"]["delete"][0]["status"] == "deleted"
+
+def test_sync_strava_watermark(frequency_tracker, user_id, monkeypatch):
+    link_strava(frequency_tracker, user_id)
+    afters = []
+
+    def fetch_strava_page(get_access_token, page, after):
+        afters.append(after)
+        return [strava_activity(1, "2025-01-01T12:00:00Z")] if after == 0 else []
+
+    monkeypatch.setattr(frequency_tracker, "_fetch_strava_page", fetch_strava_page)
+
+    # The first sync fetches the whole history and moves the watermark to the newest start date
+    assert frequency_tracker.sync_strava(user_id)["activities_inserted"] == 1
+    watermark = int(datetime(2025, 1, 1, 12, tzinfo=timezone.utc).timestamp())
+    assert frequency_tracker._get_strava_sync_state(user_id)["watermark"] == watermark
+
+    # A default sync only asks for activities after it
+    frequency_tracker.sync_strava(user_id)
+    assert afters == [0, watermark]
+
+    # A new type resets it, so its older Strava activities are fetched again
+    frequency_tracker.add_activity_type(user_id, "Riding", 1, 2, 3, 4)
+    assert frequency_tracker._get_strava_sync_state(user_id)["watermark"] is None
+    frequency_tracker.sync_strava(user_id)
+    assert afters[-1] == 0
+
+def test_sync_strava_resumes_after_failure(frequency_tracker, user_id, monkeypatch):
+    link_strava(frequency_tracker, user_id)
+    history = [strava_activity(day, f"2025-01-0{day}T12:00:00Z") for day in range(1, 6)]
+    failing = True
+
+    def fetch_strava_page(get_access_token, page, after):
+        # Like Strava with an after filter, oldest first
+        if failing and page == 3:
+            raise RuntimeError("Strava is down")
+        newer = [activity for activity in history if frequency_tracker._parse_activity_time(activity["start_date"]).timestamp() > after]
+        return newer[(page - 1) * 2:page * 2]
+
+    monkeypatch.setattr(frequency_tracker, "per_page", 2)
+    monkeypatch.setattr(frequency_tracker, "_fetch_strava_page", fetch_strava_page)
+
+    # The two pages before the failure stay committed, and the watermark is at the last of them
+    updates = []
+    result = frequency_tracker.sync_strava(user_id, progress=updates.append)
+    assert not result["success"]
+    assert result["activities_inserted"] == 4
+    assert len(frequency_tracker.get_activities(user_id)) == 4
+    watermark = int(datetime(2025, 1, 4, 12, tzinfo=timezone.utc).timestamp())
+    assert frequency_tracker._get_strava_sync_state(user_id) == {"watermark": watermark, "last_synced_at": None}
+    assert updates[-1]["resume_since"] == datetime.fromtimestamp(watermark, timezone.utc).isoformat()
+
+    # The next sync picks up from there and only fetches what is left
+    failing = False
+    result = frequency_tracker.sync_strava(user_id)
+    assert result["success"] and result["complete"]
+    assert result["activities_fetched"] == 1
+    assert len(frequency_tracker.get_activities(user_id)) == 5
+    assert frequency_tracker._get_strava_sync_state(user_id)["last_synced_at"] is not None
@@ -0,0 +1,34 @@
+from response_cache import ResponseCache, ENTRY_OVERHEAD
+
+def test_get_and_put():
+    response_cache = ResponseCache(1024 * 1024)
+    assert response_cache.get(("frequencies", 1, 3, "2025-01-01")) is None
+
+    response_cache.put(("frequencies", 1, 3, "2025-01-01"), b'{"activities": []}')
+    assert response_cache.get(("frequencies", 1, 3, "2025-01-01")) == b'{"activities": []}'
+
+    # A new data version or local day is a different entry
+    assert response_cache.get(("frequencies", 1, 4, "2025-01-01")) is None
+    assert response_cache.get(("frequencies", 1, 3, "2025-01-02")) is None
+
+    stats = response_cache.get_stats()
+    assert (stats["hits"], stats["misses"], stats["entries"]) == (1, 3, 1)
+
+def test_evicts_least_recently_used():
+    body = b"x" * 100
+    response_cache = ResponseCache((len(body) + ENTRY_OVERHEAD) * 2)
+
+    response_cache.put(1, body)
+    response_cache.put(2, body)
+    response_cache.get(1)
+    response_cache.put(3, body)
+
+    # Entry 2 was used least recently
+    assert response_cache.get(2) is None
+    assert response_cache.get(1) == body
+    assert response_cache.get_stats()["evictions"] == 1
+
+    # Bodies bigger than the whole budget aren't kept
+    response_cache.put(4, b"x" * 1000)
+    assert response_cache.get(4) is None
+    assert response_cache.get(3) == body
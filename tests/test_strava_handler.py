@@ -0,0 +1,283 @@
+import pytest
+import requests
+import threading
+import time
+from strava_handler import StravaHandler, StravaRateLimiter, StravaRateLimitError, StravaTokenManager, StravaTokenError
+
+@pytest.fixture
+def strava_handler():
+    handler = StravaHandler()
+    handler.per_page = 2
+    handler.max_concurrent_pages = 3
+    yield handler
+
+def test_fetch_activities_pages_until_short_page(strava_handler):
+
+    # Five activities served two per page
+    history = [{"id": i} for i in range(5)]
+    requested = []
+
+    def fetch_page(get_access_token, page, after):
+        requested.append((page, after))
+        start = (page - 1) * strava_handler.per_page
+        return history[start:start + strava_handler.per_page]
+
+    strava_handler._fetch_strava_page = fetch_page
+    pages = list(strava_handler._fetch_strava_activity_pages(lambda rejected_token=None: "token", "2025-01-01T00:00:00+00:00"))
+
+    # Pages arrive in order, without the empty tail, page 1 alone and then a wave of three
+    assert pages == [history[0:2], history[2:4], history[4:5]]
+    assert sorted(page for page, _ in requested) == [1, 2, 3, 4]
+    assert all(after == 1735689600 for _, after in requested)
+
+def test_fetch_activities_short_first_page_is_one_request(strava_handler):
+    requested = []
+
+    def fetch_page(get_access_token, page, after):
+        requested.append(page)
+        return [{"id": 1}] if page == 1 else []
+
+    # An incremental sync with less than a page of new activities spends a single request
+    strava_handler._fetch_strava_page = fetch_page
+    pages = list(strava_handler._fetch_strava_activity_pages(lambda rejected_token=None: "token", "2025-01-01T00:00:00+00:00"))
+    assert pages == [[{"id": 1}]]
+    assert requested == [1]
+
+def test_fetch_activities_pages_reports_cap(strava_handler):
+    history = [{"id": i} for i in range(5)]
+
+    def fetch_page(get_access_token, page, after):
+        start = (page - 1) * strava_handler.per_page
+        return history[start:start + strava_handler.per_page]
+
+    strava_handler._fetch_strava_page = fetch_page
+
+    # Stopped by max_pages with history left
+    fetch_state = {}
+    pages = list(strava_handler._fetch_strava_activity_pages(lambda rejected_token=None: "token", None, 2, fetch_state))
+    assert pages == [history[0:2], history[2:4]]
+    assert fetch_state["truncated"]
+
+    # Stopped by the short last page
+    list(strava_handler._fetch_strava_activity_pages(lambda rejected_token=None: "token", None, 5, fetch_state))
+    assert not fetch_state["truncated"]
+
+def test_fetch_page_retries_unauthorized_page(strava_handler):
+
+    class Response:
+        def __init__(self, status_code):
+            self.status_code = status_code
+        def raise_for_status(self):
+            pass
+        def json(self):
+            return [{"id": 1}]
+
+    # The first token is rejected, the page is retried once with a refreshed one
+    tokens_used = []
+    def get_page(access_token, page, after):
+        tokens_used.append(access_token)
+        return Response(401 if access_token == "old" else 200)
+
+    rejected = []
+    def get_access_token(rejected_token = None):
+        rejected.append(rejected_token)
+        return "new" if rejected_token else "old"
+
+    strava_handler._get_strava_page = get_page
+    assert strava_handler._fetch_strava_page(get_access_token, 1, 0) == [{"id": 1}]
+    assert tokens_used == ["old", "new"]
+    assert rejected == [None, "old"]
+
+@pytest.fixture
+def token_store():
+    store = {
+        "tokens": {1: {"access_token": "a1", "refresh_token": "r1", "expires_at": int(time.time()) + 3600}},
+        "refreshes": 0
+    }
+    yield store
+
+def make_token_manager(token_store, delay = 0):
+
+    def load_tokens(user_id):
+        return token_store["tokens"].get(user_id)
+
+    def save_tokens(user_id, access_token, refresh_token, expires_at):
+        token_store["tokens"][user_id] = {"access_token": access_token, "refresh_token": refresh_token, "expires_at": expires_at}
+
+    def refresh_tokens(refresh_token):
+        if refresh_token == "revoked":
+            raise RuntimeError("400 Bad Request")
+        time.sleep(delay)
+        token_store["refreshes"] += 1
+        n = token_store["refreshes"] + 1
+        return {"success": True, "data": {"access_token": f"a{n}", "refresh_token": f"r{n}", "expires_at": int(time.time()) + 3600}}
+
+    return StravaTokenManager(load_tokens, save_tokens, refresh_tokens)
+
+def test_token_manager_caches_valid_token(token_store):
+    token_manager = make_token_manager(token_store)
+    assert token_manager.get_access_token(1) == "a1"
+
+    # Served from memory afterwards
+    token_store["tokens"][1] = None
+    assert token_manager.get_access_token(1) == "a1"
+    assert token_manager.get_access_token(2) is None
+
+def test_token_manager_refreshes_ahead_of_expiry(token_store):
+    token_store["tokens"][1]["expires_at"] = int(time.time()) + 60
+    token_manager = make_token_manager(token_store)
+
+    assert token_manager.get_access_token(1) == "a2"
+    assert token_store["tokens"][1]["refresh_token"] == "r2"
+    assert token_store["refreshes"] == 1
+
+def test_token_manager_shares_refresh(token_store):
+    token_manager = make_token_manager(token_store, delay=0.05)
+    token_manager.get_access_token(1)
+
+    # Every caller that saw a1 rejected ends up with the one refreshed token
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(token_manager.get_access_token(1, rejected_token="a1"))) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == ["a2"] * 5
+    assert token_store["refreshes"] == 1
+
+def test_token_manager_refresh_failure(token_store):
+    token_store["tokens"][1] = {"access_token": "a1", "refresh_token": "revoked", "expires_at": 0}
+    token_manager = make_token_manager(token_store)
+    with pytest.raises(StravaTokenError):
+        token_manager.get_access_token(1)
+
+def test_token_manager_uses_tokens_refreshed_elsewhere(token_store):
+    token_store["tokens"][1]["expires_at"] = int(time.time()) + 60
+    token_manager = make_token_manager(token_store)
+    assert token_manager.get_access_token(1) == "a2"
+
+    # Another process rotated the tokens after ours, the stored ones are picked up without a refresh
+    token_store["tokens"][1] = {"access_token": "b1", "refresh_token": "rb1", "expires_at": int(time.time()) + 3600}
+    assert token_manager.get_access_token(1, rejected_token="a2") == "b1"
+    assert token_store["refreshes"] == 1
+
+def test_token_manager_forgets_tokens_after_failed_refresh(token_store):
+    token_store["tokens"][1] = {"access_token": "a1", "refresh_token": "revoked", "expires_at": 0}
+    token_manager = make_token_manager(token_store)
+    with pytest.raises(StravaTokenError):
+        token_manager.get_access_token(1)
+
+    # Re-linked in the meantime, the next call loads the new tokens
+    token_store["tokens"][1] = {"access_token": "c1", "refresh_token": "rc1", "expires_at": int(time.time()) + 3600}
+    assert token_manager.get_access_token(1) == "c1"
+
+def test_rate_limiter_counts_requests():
+    rate_limiter = StravaRateLimiter()
+
+    # No headers seen yet, nothing to pace
+    rate_limiter.wait()
+
+    rate_limiter.update({"X-RateLimit-Limit": "100,1000", "X-RateLimit-Usage": "10,20"})
+    rate_limiter.wait()
+    assert rate_limiter.short_usage == 11
+    assert rate_limiter.daily_usage == 21
+
+def test_rate_limiter_daily_limit():
+    rate_limiter = StravaRateLimiter()
+    rate_limiter.update({"X-RateLimit-Limit": "100,1000", "X-RateLimit-Usage": "10,1000"})
+    with pytest.raises(StravaRateLimitError):
+        rate_limiter.wait()
+
+def test_rate_limiter_waits_for_next_window(monkeypatch):
+    rate_limiter = StravaRateLimiter()
+    rate_limiter.update({"X-RateLimit-Limit": "100,1000", "X-RateLimit-Usage": "100,200"})
+
+    sleeps = []
+    monkeypatch.setattr("strava_handler.time.sleep", sleeps.append)
+    monkeypatch.setattr(rate_limiter, "_seconds_until_next_window", lambda: 0)
+    rate_limiter.wait()
+
+    # The spent window is waited out, then counting starts over
+    assert len(sleeps) == 1
+    assert rate_limiter.short_usage == 1
+
+class FakeResponse:
+
+    def __init__(self, status_code, headers = None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+class FakeSession:
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.calls = 0
+
+    def request(self, method, url, timeout = None, **kwargs):
+        self.calls += 1
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+def test_request_retries_with_backoff(strava_handler, monkeypatch):
+    sleeps = []
+    monkeypatch.setattr("strava_handler.time.sleep", sleeps.append)
+
+    # A throttled response honours Retry-After, a server error and a dropped connection back off
+    strava_handler.session = FakeSession([
+        FakeResponse(429, {"Retry-After": "7"}),
+        FakeResponse(503),
+        requests.ConnectionError("reset"),
+        FakeResponse(200)
+    ])
+    response = strava_handler._request("GET", strava_handler.activities_url)
+
+    assert response.status_code == 200
+    assert sleeps[0] == 7
+    assert all(0 <= delay <= strava_handler.backoff_max for delay in sleeps[1:])
+    assert len(sleeps) == 3
+
+    stats = strava_handler._get_http_stats()
+    assert stats["requests"] == 4
+    assert stats["retries"] == 3
+    assert stats["throttled"] == 1
+    assert stats["server_errors"] == 1
+    assert stats["connection_errors"] == 1
+
+def test_request_gives_up_after_max_retries(strava_handler, monkeypatch):
+    monkeypatch.setattr("strava_handler.time.sleep", lambda delay: None)
+    strava_handler.max_retries = 2
+    strava_handler.session = FakeSession([FakeResponse(500)] * 3)
+
+    assert strava_handler._request("GET", strava_handler.activities_url).status_code == 500
+    assert strava_handler.session.calls == 3
+
+def test_request_does_not_resend_token_refresh(strava_handler, monkeypatch):
+    monkeypatch.setattr("strava_handler.time.sleep", lambda delay: None)
+
+    # The refresh may have rotated the refresh token, so a server error is not retried
+    strava_handler.session = FakeSession([FakeResponse(502), FakeResponse(200)])
+    response = strava_handler._request("POST", strava_handler.token_url, retry_on_error=False, rate_limited=False)
+    assert response.status_code == 502
+    assert strava_handler.session.calls == 1
+
+def test_fetch_missing_activity(strava_handler):
+    strava_handler.session = FakeSession([FakeResponse(404)])
+    assert strava_handler._fetch_strava_activity(lambda rejected_token=None: "token", 42) is None
+
+def test_webhook_validation(strava_handler):
+    strava_handler.webhook_verify_token = "secret"
+    assert strava_handler._validate_webhook_subscription("subscribe", "secret", "abc") == {"hub.challenge": "abc"}
+    assert strava_handler._validate_webhook_subscription("subscribe", "wrong", "abc") is None
+
+def test_webhook_events_need_our_subscription(strava_handler):
+
+    # Nothing is accepted until the subscription id is configured
+    strava_handler.webhook_subscription_id = None
+    assert not strava_handler._is_webhook_event_accepted(123)
+
+    strava_handler.webhook_subscription_id = "123"
+    assert strava_handler._is_webhook_event_accepted(123)
+    assert not strava_handler._is_webhook_event_accepted(456)
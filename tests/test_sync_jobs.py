@@ -0,0 +1,100 @@
+import threading
+import pytest
+from sync_jobs import SyncJobManager
+
+
+class FakeTracker:
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.calls = 0
+
+    def sync_strava(self, user_id, since = None, progress = None, max_pages = None):
+        self.calls += 1
+        progress({"phase": "fetching", "pages_fetched": 1, "activities_fetched": 200, "activities_inserted": 150})
+        self.release.wait(5)
+        if user_id == 13:
+            raise RuntimeError("connection reset")
+        return {"success": True, "message": "Successfully synced 200 activities from Strava",
+                "pages_fetched": 1, "activities_fetched": 200, "activities_inserted": 150}
+
+@pytest.fixture
+def tracker():
+    yield FakeTracker()
+
+def wait_for(sync_jobs, job_id):
+    for _ in range(500):
+        job = sync_jobs.get(job_id)
+        if job["finished_at"] is not None:
+            return job
+        threading.Event().wait(0.01)
+    raise AssertionError("job did not finish")
+
+def test_duplicate_syncs_are_coalesced(tracker):
+    sync_jobs = SyncJobManager(tracker, workers=2)
+
+    # A second request while the first is running joins it
+    job = sync_jobs.submit(1)
+    assert not job["coalesced"]
+    duplicate = sync_jobs.submit(1)
+    assert duplicate["coalesced"]
+    assert duplicate["job_id"] == job["job_id"]
+
+    # Progress is visible while it runs
+    for _ in range(500):
+        if sync_jobs.get(job["job_id"])["pages_fetched"] == 1:
+            break
+        threading.Event().wait(0.01)
+    assert sync_jobs.get(job["job_id"])["status"] == "running"
+
+    tracker.release.set()
+    finished = wait_for(sync_jobs, job["job_id"])
+    assert finished["status"] == "succeeded"
+    assert finished["activities_inserted"] == 150
+    assert tracker.calls == 1
+
+    # Once finished, a new request starts a new job
+    assert sync_jobs.submit(1)["job_id"] != job["job_id"]
+    sync_jobs.shutdown()
+
+def test_scheduled_sync_waits_for_running_job(tracker):
+    sync_jobs = SyncJobManager(tracker, workers=2)
+
+    # The scheduler's sync for a user already syncing joins that job and waits for its outcome
+    job = sync_jobs.submit(1)
+    scheduled = sync_jobs.submit(1, max_pages=2)
+    assert scheduled["coalesced"]
+    waited = []
+    waiter = threading.Thread(target=lambda: waited.append(sync_jobs.wait(scheduled["job_id"])))
+    waiter.start()
+
+    tracker.release.set()
+    waiter.join(5)
+    assert waited[0]["job_id"] == job["job_id"]
+    assert waited[0]["status"] == "succeeded"
+    assert tracker.calls == 1
+
+    # Finished jobs return right away, unknown ones not at all
+    assert sync_jobs.wait(job["job_id"])["status"] == "succeeded"
+    assert sync_jobs.wait("unknown") is None
+    sync_jobs.shutdown()
+
+def test_failed_sync_reports_error(tracker):
+    sync_jobs = SyncJobManager(tracker, workers=1)
+    tracker.release.set()
+
+    job = wait_for(sync_jobs, sync_jobs.submit(13)["job_id"])
+    assert job["status"] == "failed"
+    assert "connection reset" in job["error"]
+    assert job["pages_fetched"] == 1
+    sync_jobs.shutdown()
+
+def test_finished_jobs_are_pruned(tracker):
+    sync_jobs = SyncJobManager(tracker, workers=1, max_finished_jobs=2)
+    tracker.release.set()
+
+    job_ids = [wait_for(sync_jobs, sync_jobs.submit(user_id)["job_id"])["job_id"] for user_id in range(3)]
+    sync_jobs.submit(3)
+    assert sync_jobs.get(job_ids[0]) is None
+    assert sync_jobs.get(job_ids[2]) is not None
+    sync_jobs.shutdown()
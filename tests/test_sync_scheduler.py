@@ -0,0 +1,65 @@
+import pytest
+from strava_handler import StravaRateLimiter
+from sync_jobs import SyncJobManager
+from sync_scheduler import StravaSyncScheduler
+
+
+class FakeTracker:
+
+    def __init__(self, candidates):
+        self.rate_limiter = StravaRateLimiter()
+        self.candidates = candidates
+        self.synced = {}
+
+    def get_strava_sync_candidates(self, synced_before, limit):
+        return [{"user_id": user_id} for user_id in self.candidates[:limit]]
+
+    def sync_strava(self, user_id, since = None, progress = None, max_pages = None):
+        self.synced[user_id] = max_pages
+        if user_id == 13:
+            return {"success": False, "message": "Failed to refresh Strava access token"}
+        return {"success": True, "message": "Synced", "complete": True}
+
+@pytest.fixture
+def tracker():
+    yield FakeTracker([1, 2, 3, 13])
+
+def test_round_splits_budget_between_users(tracker):
+    tracker.rate_limiter.update({"X-RateLimit-Limit": "100,1000", "X-RateLimit-Usage": "20,500"})
+    scheduler = StravaSyncScheduler(tracker, sync_interval=3600, workers=2, budget_share=0.5)
+
+    # Half of the 80 requests left in the window, split over the four users that are due
+    results = scheduler.run_once()
+    assert tracker.synced == {1: 10, 2: 10, 3: 10, 13: 10}
+    assert not results[13]["success"]
+
+    # The failed user sits out the next round, the others share its pages
+    tracker.synced = {}
+    scheduler.run_once()
+    assert tracker.synced == {1: 13, 2: 13, 3: 13}
+
+def test_round_never_exceeds_budget(tracker):
+    tracker.rate_limiter.update({"X-RateLimit-Limit": "100,1000", "X-RateLimit-Usage": "96,500"})
+    scheduler = StravaSyncScheduler(tracker, budget_share=0.5)
+
+    # Two requests to spend, so only the two longest waiting users get a page
+    scheduler.run_once()
+    assert tracker.synced == {1: 1, 2: 1}
+
+    # Nothing is left to share once the window is spent
+    tracker.synced = {}
+    tracker.rate_limiter.update({"X-RateLimit-Limit": "100,1000", "X-RateLimit-Usage": "100,500"})
+    assert scheduler.run_once() == {}
+    assert tracker.synced == {}
+
+def test_round_goes_through_sync_jobs(tracker):
+    tracker.rate_limiter.update({"X-RateLimit-Limit": "100,1000", "X-RateLimit-Usage": "20,500"})
+    sync_jobs = SyncJobManager(tracker, workers=2)
+    scheduler = StravaSyncScheduler(tracker, budget_share=0.5, sync_jobs=sync_jobs)
+
+    # Each sync runs as a job, with the round's page budget, and reports back like a direct call
+    results = scheduler.run_once()
+    assert tracker.synced == {1: 10, 2: 10, 3: 10, 13: 10}
+    assert results[1] == {"success": True, "message": "Synced", "complete": True}
+    assert not results[13]["success"]
+    sync_jobs.shutdown()